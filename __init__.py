@@ -1,5 +1,15 @@
 import rmq_controller
 import ssh_controller
+import ssh_fleet
 
 RMQ = rmq_controller.RMQ
 SSH = ssh_controller.SSH
+SSHFleet = ssh_fleet.SSHFleet
+
+
+def __getattr__(name):
+    # only AsyncRMQ needs aio_pika, so it isn't imported until it's used
+    if name == 'AsyncRMQ':
+        import rmq_async
+        return rmq_async.AsyncRMQ
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,543 @@
+"""
+throughput / latency benchmarks for RMQ, RMQAdmin and SSH, runnable on a single linux box
+*   SSH runs against an in-process paramiko server (exec via the local shell, sftp via the local filesystem)
+*   RMQAdmin runs against an in-process stub of the management http api
+*   RMQ needs a real broker, by default on localhost:5672 (guest/guest), and is skipped if none is reachable
+
+results are printed (and optionally appended to a file) as json lines, one per benchmark, tagged with the commit
+
+usage:
+    python benchmark.py [--only ssh,http,rmq] [--output bench_output.txt] [--scale 1.0]
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import paramiko
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Result:
+    def __init__(self, benchmark, n_ops, seconds, n_bytes=0, latencies=None, n_connections=None):
+        latencies = sorted(latencies or [])
+        self.record = {
+            'benchmark':          benchmark,
+            'n_ops':              n_ops,
+            'seconds':            seconds,
+            'ops_per_second':     n_ops / seconds if seconds else float('nan'),
+            'mb_per_second':      n_bytes / seconds / 1024 / 1024 if seconds and n_bytes else None,
+            'p50_ms':             _percentile(latencies, 0.50) * 1000 if latencies else None,
+            'p99_ms':             _percentile(latencies, 0.99) * 1000 if latencies else None,
+            'connections_per_op': n_connections / n_ops if n_connections is not None and n_ops else None,
+        }
+
+    def __str__(self):
+        parts = [f'{self.record["ops_per_second"]:,.1f} ops/s']
+        if self.record['mb_per_second'] is not None:
+            parts.append(f'{self.record["mb_per_second"]:,.1f} MB/s')
+        if self.record['p50_ms'] is not None:
+            parts.append(f'p50={self.record["p50_ms"]:,.2f}ms p99={self.record["p99_ms"]:,.2f}ms')
+        if self.record['connections_per_op'] is not None:
+            parts.append(f'{self.record["connections_per_op"]:,.3f} connections/op')
+        return f'{self.record["benchmark"]:<32} {", ".join(parts)}'
+
+
+def timed_ops(benchmark, n_ops, op, n_bytes_per_op=0, count_connections=None):
+    """
+    run `op(i)` n_ops times, recording per-op latency and (optionally) connections opened
+    """
+    n_connections_start = count_connections() if count_connections is not None else None
+    latencies = []
+    time_start = time.perf_counter()
+    for i in range(n_ops):
+        op_start = time.perf_counter()
+        op(i)
+        latencies.append(time.perf_counter() - op_start)
+    seconds = time.perf_counter() - time_start
+
+    n_connections = None
+    if count_connections is not None:
+        n_connections = count_connections() - n_connections_start
+    return Result(benchmark, n_ops, seconds, n_bytes_per_op * n_ops, latencies, n_connections)
+
+
+def timed_bulk(benchmark, n_ops, bulk_op, n_bytes=0, count_connections=None):
+    """
+    run `bulk_op()` once, which performs n_ops operations (e.g. publishing n_ops messages)
+    """
+    n_connections_start = count_connections() if count_connections is not None else None
+    time_start = time.perf_counter()
+    bulk_op()
+    seconds = time.perf_counter() - time_start
+
+    n_connections = None
+    if count_connections is not None:
+        n_connections = count_connections() - n_connections_start
+    return Result(benchmark, n_ops, seconds, n_bytes, None, n_connections)
+
+
+# ssh stand-in
+
+class _StubSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class _StubSFTPServer(paramiko.SFTPServerInterface):
+    """
+    sftp on the local filesystem, with no chroot (remote paths are local paths)
+    """
+
+    def list_folder(self, path):
+        try:
+            attributes = []
+            for filename in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, filename)))
+                attr.filename = filename
+                attributes.append(attr)
+            return attributes
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            paramiko.SFTPServer.set_file_attr(path, attr)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+
+        handle = _StubSFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class _StubSSHServerInterface(paramiko.ServerInterface):
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (self.username, self.password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        # paramiko answers the request after this returns, and a command that closes its channel before that
+        # looks like a refused exec to the client (sshd always answers first), so commands wait for the answer
+        answered = channel.get_transport().expect_answer(channel.remote_chanid)
+
+        def run():
+            answered.wait()
+            self._exec(channel, command)
+
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+    @staticmethod
+    def _exec(channel, command):
+        proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # forward stderr on its own thread, so neither pipe can fill up and block the command
+        def forward_stderr():
+            for chunk in iter(lambda: proc.stderr.read1(65536), b''):
+                channel.sendall_stderr(chunk)
+
+        stderr_thread = threading.Thread(target=forward_stderr, daemon=True)
+        stderr_thread.start()
+        for chunk in iter(lambda: proc.stdout.read1(65536), b''):
+            channel.sendall(chunk)
+        stderr_thread.join()
+
+        channel.send_exit_status(proc.wait())
+        channel.close()
+
+
+class _StubTransport(paramiko.Transport):
+    """
+    server transport signalling when a channel request has been answered
+    """
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self._answers = dict()  # remote channel id -> event, only touched by the transport's own thread
+
+    def expect_answer(self, remote_chanid):
+        self._answers[remote_chanid] = threading.Event()
+        return self._answers[remote_chanid]
+
+    def _send_user_message(self, data):
+        super()._send_user_message(data)
+        packet = data.asbytes()
+        if packet[0] in (paramiko.common.MSG_CHANNEL_SUCCESS, paramiko.common.MSG_CHANNEL_FAILURE):
+            answered = self._answers.pop(int.from_bytes(packet[1:5], 'big'), None)
+            if answered is not None:
+                answered.set()
+
+
+logging.getLogger('benchmark.stub_ssh').addHandler(logging.NullHandler())
+logging.getLogger('benchmark.stub_ssh').propagate = False
+
+
+class StubSSHServer:
+    """
+    in-process ssh + sftp server on localhost, counting the connections it accepts
+    """
+
+    def __init__(self, username='bench', password='bench'):
+        self.username = username
+        self.password = password
+        self.n_connections = 0
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client_sock, _ = self.sock.accept()
+            except OSError:
+                return
+            self.n_connections += 1
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # like sshd does for sessions
+            transport = _StubTransport(client_sock)
+            transport.set_log_channel('benchmark.stub_ssh')  # clients disconnecting abruptly is not an error here
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _StubSFTPServer)
+            transport.start_server(server=_StubSSHServerInterface(self.username, self.password))
+
+    def close(self):
+        self.sock.close()
+
+
+# management api stand-in
+
+class StubManagementAPI:
+    """
+    in-process stub of the parts of the rabbitmq management api used by RMQAdmin, counting connections
+    """
+
+    def __init__(self, n_queues=200):
+        stub = self
+        self.n_connections = 0
+        self.n_published = 0
+        self.queues = [{'name':           f'queue-{i}',
+                        'messages_ready': i,
+                        'consumers':      1,
+                        'memory':         1024,
+                        'message_stats':  {'publish_details': {'rate': 1.0}}}
+                       for i in range(n_queues)]
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+            # headers and body go out in separate writes, which nagle's algorithm would hold back
+            # for a delayed ack (like the ssh stub, and like a real management api behind a web server)
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                stub.n_connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, json_obj):
+                data = json.dumps(json_obj).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.startswith('/api/queues/'):
+                    self._reply({'items': stub.queues, 'page': 1, 'page_count': 1})
+                else:
+                    self._reply({'status': 'ok'})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                stub.n_published += 1
+                self._reply({'routed': True})
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# benchmarks
+
+def bench_ssh(scale):
+    from ssh_controller import SSH
+
+    server = StubSSHServer()
+    results = []
+    try:
+        ssh = SSH('127.0.0.1', server.port, server.username, server.password, logfile=None)
+
+        results.append(timed_ops('ssh.execute', max(1, int(50 * scale)),
+                                 lambda i: ssh.execute('echo 123'),
+                                 count_connections=lambda: server.n_connections))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            n_bytes = max(1, int(32 * 1024 * 1024 * scale))
+            local_path = os.path.join(tmp_dir, 'local.bin')
+            with open(local_path, mode='wb') as f:
+                f.write(os.urandom(n_bytes))
+
+            remote_path = os.path.join(tmp_dir, 'remote', 'remote.bin')
+            results.append(timed_ops('ssh.scp_local_to_remote', 3,
+                                     lambda i: ssh.scp_local_to_remote(local_path, remote_path, overwrite=True,
+                                                                       verbose=False),
+                                     n_bytes_per_op=n_bytes,
+                                     count_connections=lambda: server.n_connections))
+
+            round_trip_path = os.path.join(tmp_dir, 'round_trip.bin')
+            results.append(timed_ops('ssh.scp_remote_to_local', 3,
+                                     lambda i: ssh.scp_remote_to_local(remote_path, round_trip_path, overwrite=True,
+                                                                       verbose=False),
+                                     n_bytes_per_op=n_bytes,
+                                     count_connections=lambda: server.n_connections))
+    finally:
+        server.close()
+
+    return results
+
+
+def bench_http(scale):
+    from rmq_http import RMQAdmin
+
+    stub = StubManagementAPI()
+    results = []
+    try:
+        admin = RMQAdmin('127.0.0.1', stub.port, '/', 'guest', 'guest')
+
+        n_messages = max(1, int(2000 * scale))
+        results.append(timed_bulk('rmq_admin.write_jsons', n_messages,
+                                  lambda: admin.write_jsons('queue-0', ({'i': i} for i in range(n_messages))),
+                                  count_connections=lambda: stub.n_connections))
+
+        results.append(timed_ops('rmq_admin.snapshot', max(1, int(100 * scale)),
+                                 lambda i: admin.snapshot(max_age_seconds=0),
+                                 count_connections=lambda: stub.n_connections))
+        admin.close()
+    finally:
+        stub.close()
+
+    return results
+
+
+def bench_rmq(scale, host, port, virtual_host, username, password):
+    from rmq_controller import RMQ
+    from rmq_controller import check_pika_internals
+
+    # runs without a broker too, so a pika upgrade that breaks RPublisher is caught here
+    check_pika_internals()
+
+    try:
+        socket.create_connection((host, port), timeout=2).close()
+    except OSError:
+        print(f'no broker reachable at {host}:{port}, skipping rmq benchmarks')
+        return []
+
+    rmq = RMQ(host, port, virtual_host, username, password, logfile=None)
+    queue_name = f'benchmark-{os.getpid()}'
+    with rmq._pool.channel() as rmq_channel:
+        rmq_channel.queue_declare(queue=queue_name, durable=True)
+
+    def count_connections():
+        return rmq._pool.n_connections_opened
+
+    results = []
+    try:
+        n_messages = max(1, int(20000 * scale))
+        message = {'payload': 'x' * 200}
+        n_bytes = n_messages * len(json.dumps(message))
+
+        # read exactly what was written, so a reader never sits out its inactivity timeout inside the timed section
+        # (the short timeout only matters if messages go missing, in which case we'd rather fail fast than hang)
+        read_timeout_seconds = 5
+
+        results.append(timed_bulk('rmq.write_jsons', n_messages,
+                                  lambda: rmq.write_jsons(queue_name, (message for _ in range(n_messages))),
+                                  n_bytes=n_bytes,
+                                  count_connections=count_connections))
+
+        results.append(timed_bulk('rmq.read_jsons', n_messages,
+                                  lambda: sum(1 for _ in rmq.read_jsons(queue_name, n=n_messages, auto_ack=True,
+                                                                        timeout_seconds=read_timeout_seconds,
+                                                                        verbose=False)),
+                                  n_bytes=n_bytes,
+                                  count_connections=count_connections))
+
+        results.append(timed_bulk('rmq.write_jsons_confirmed', n_messages,
+                                  lambda: rmq.write_jsons_confirmed(queue_name,
+                                                                    (message for _ in range(n_messages)),
+                                                                    verbose=False),
+                                  n_bytes=n_bytes,
+                                  count_connections=count_connections))
+
+        results.append(timed_bulk('rmq.read_json_batches', n_messages,
+                                  lambda: sum(len(batch) for batch in rmq.read_json_batches(
+                                      queue_name, n=n_messages, timeout_seconds=read_timeout_seconds, verbose=False)),
+                                  n_bytes=n_bytes,
+                                  count_connections=count_connections))
+
+        results.append(timed_ops('rmq.get_count', max(1, int(200 * scale)),
+                                 lambda i: rmq.get_count(queue_name),
+                                 count_connections=count_connections))
+    finally:
+        with rmq._pool.channel() as rmq_channel:
+            rmq_channel.queue_delete(queue=queue_name)
+        rmq.close()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark RMQ, RMQAdmin and SSH against local stand-ins')
+    parser.add_argument('--only', default='ssh,http,rmq', help='comma-separated subset of: ssh, http, rmq')
+    parser.add_argument('--output', default=None, help='also append json lines results to this file')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the number of operations')
+    parser.add_argument('--rmq-host', default=os.environ.get('RMQ_HOST', '127.0.0.1'))
+    parser.add_argument('--rmq-port', type=int, default=int(os.environ.get('RMQ_PORT', 5672)))
+    parser.add_argument('--rmq-vhost', default=os.environ.get('RMQ_VHOST', '/'))
+    parser.add_argument('--rmq-username', default=os.environ.get('RMQ_USERNAME', 'guest'))
+    parser.add_argument('--rmq-password', default=os.environ.get('RMQ_PASSWORD', 'guest'))
+    args = parser.parse_args(argv)
+
+    only = set(args.only.split(','))
+    results = []
+    if 'ssh' in only:
+        results.extend(bench_ssh(args.scale))
+    if 'http' in only:
+        results.extend(bench_http(args.scale))
+    if 'rmq' in only:
+        results.extend(bench_rmq(args.scale, args.rmq_host, args.rmq_port, args.rmq_vhost, args.rmq_username,
+                                 args.rmq_password))
+
+    commit = _git_commit()
+    timestamp = time.time()
+    lines = []
+    for result in results:
+        print(result, file=sys.stderr)
+        lines.append(json.dumps({'commit': commit, 'timestamp': timestamp, **result.record}, sort_keys=True))
+
+    print('\n'.join(lines))
+    if args.output is not None:
+        with open(args.output, mode='at', encoding='utf8', newline='\n') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+# seconds, from sub-millisecond rpcs to multi-minute transfers
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _format_labels(label_items, extra=()):
+    label_items = tuple(label_items) + tuple(extra)
+    if not label_items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+               for _, value in label_items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(label_items, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = dict()  # sorted label items -> value
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._values = dict()  # sorted label items -> [bucket counts..., +inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    def get_count(self, **labels):
+        values = self._values.get(tuple(sorted(labels.items())))
+        return 0 if values is None else sum(values[:-1])
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets, values):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_format_labels(key, [("le", upper_bound)])} {cumulative}')
+                cumulative += values[len(self.buckets)]
+                lines.append(f'{self.name}_bucket{_format_labels(key, [("le", "+Inf")])} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {values[-1]}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    in-process counters and histograms, exposed in the prometheus text format
+    metrics are created on first use and shared by name, so modules can declare the same metric independently
+    """
+
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, *args)
+            assert isinstance(self._metrics[name], metric_class), f'{name} is not a {metric_class.__name__}'
+            return self._metrics[name]
+
+    def counter(self, name, documentation):
+        return self._get_or_create(Counter, name, documentation)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, buckets)
+
+    def dump(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, port, host='0.0.0.0'):
+        """
+        serve `dump()` at http://host:port/metrics from a background thread
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                data = registry.dump().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+REGISTRY = MetricsRegistry()
+
+
+@contextlib.contextmanager
+def timer(histogram, **labels):
+    """
+    observe the duration of a with-block in `histogram`, whether or not it raises
+    """
+    time_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - time_start, **labels)
+
+
+def instrumented(prefix, registry=REGISTRY):
+    """
+    decorator recording the duration of each call in `{prefix}_operation_seconds{operation=<function name>}`,
+    and the exceptions raised in `{prefix}_operation_errors_total`
+    (for generator functions this only times creating the generator, so count their items separately instead)
+    """
+    histogram = registry.histogram(f'{prefix}_operation_seconds', f'duration of {prefix} operations')
+    errors = registry.counter(f'{prefix}_operation_errors_total', f'exceptions raised by {prefix} operations')
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            time_start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                errors.inc(operation=func.__name__, error=type(e).__name__)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - time_start, operation=func.__name__)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,114 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+
+class OperationLogger:
+    """
+    appends log records to a file as compact json lines, from a background thread, in batches
+    *   `log()` never blocks: records are queued in memory (and dropped, with a count, beyond `max_pending`)
+    *   the file is rotated to `logfile.1`, `logfile.2`, ... once it would exceed `max_bytes`
+    *   pending records are flushed at interpreter exit
+    """
+
+    def __init__(self, logfile, max_bytes=100 * 1024 * 1024, backup_count=5, max_pending=100000):
+        self.logfile = os.path.abspath(logfile)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_pending = max_pending
+        self.n_dropped = 0
+
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f'OperationLogger<{self.logfile}>')
+        self._thread.start()
+
+    def __str__(self):
+        return f'OperationLogger<{self.logfile}>'
+
+    def log(self, json_data):
+        if self._queue.qsize() >= self.max_pending:
+            self.n_dropped += 1
+            return
+        self._queue.put(json_data)
+
+    def flush(self, timeout=None):
+        """
+        block until everything logged so far has been written
+        """
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        return flushed.wait(timeout)
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{self.logfile}.{i}'):
+                os.replace(f'{self.logfile}.{i}', f'{self.logfile}.{i + 1}')
+        if self.backup_count > 0:
+            os.replace(self.logfile, f'{self.logfile}.1')
+        else:
+            os.remove(self.logfile)
+
+    def _write(self, lines):
+        data = ''.join(lines)
+
+        for _ in range(5):
+            try:
+                size = os.path.getsize(self.logfile) if os.path.exists(self.logfile) else 0
+                if self.max_bytes and 0 < size and size + len(data) > self.max_bytes:
+                    self._rotate()
+
+                with open(self.logfile, mode='at', encoding='utf8', newline='\n') as f:
+                    f.write(data)
+                break
+            except IOError:
+                time.sleep(1)
+
+    def _run(self):
+        while True:
+            # block until there's something to do, then take everything else that's already waiting
+            items = [self._queue.get()]
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for item in items:
+                if isinstance(item, threading.Event):
+                    if lines:
+                        self._write(lines)
+                        lines = []
+                    item.set()
+                else:
+                    lines.append(json.dumps(item, sort_keys=True, ensure_ascii=False, separators=(',', ':'),
+                                            default=str) + '\n')
+
+            if lines:
+                self._write(lines)
+
+
+_loggers = dict()
+_loggers_lock = threading.Lock()
+
+
+def get_logger(logfile):
+    """
+    one shared logger per log file, so RMQ and SSH instances writing to the same file don't interleave writes
+    """
+    logfile = os.path.abspath(logfile)
+    with _loggers_lock:
+        if logfile not in _loggers:
+            _loggers[logfile] = OperationLogger(logfile)
+        return _loggers[logfile]
+
+
+@atexit.register
+def flush_all(timeout=5):
+    with _loggers_lock:
+        loggers = list(_loggers.values())
+    for logger in loggers:
+        logger.flush(timeout)
@@ -0,0 +1,296 @@
+import asyncio
+import contextlib
+import inspect
+import warnings
+from typing import Callable
+from typing import Iterable
+from typing import Optional
+from typing import Union
+
+import aio_pika
+import aio_pika.pool
+
+import rmq_codecs
+from rmq_controller import EmptyQueuesTracker
+from rmq_controller import RMQ
+
+
+class AsyncRMQ:
+    """
+    asyncio counterpart of RMQ, for consuming from and publishing to many queues concurrently in one process
+
+    usage:
+        async with AsyncRMQ(ip_address, port, virtual_host, username, password) as rmq:
+            await asyncio.gather(*[consume(rmq, queue_name) for queue_name in queue_names])
+    """
+    _connection: [aio_pika.abc.AbstractRobustConnection, None]
+    _channel_pool: [aio_pika.pool.Pool, None]
+
+    def __init__(self, ip_address, port, virtual_host, username, password, name=None, logfile='rmq.log',
+                 pool_size=4, codec='json', compression=None):
+        self.ip_address = ip_address
+        self.port = port
+        self.virtual_host = virtual_host
+        self.username = username
+        self.password = password
+        self.logfile = logfile
+        self.name = name
+        self.pool_size = pool_size
+        self.codec = rmq_codecs.Codec(serializer=codec, compression=compression)
+
+        self._connection = None
+        self._channel_pool = None
+
+    def __str__(self):
+        if self.name is None:
+            return f'AsyncRMQ<{self.username}@{self.ip_address}:{self.port}/{self.virtual_host}>'
+        else:
+            return f'AsyncRMQ<[{self.name}]={self.username}@{self.ip_address}:{self.port}/{self.virtual_host}>'
+
+    # same audit log as the blocking client
+    _log = RMQ._log
+
+    async def connect(self):
+        try:
+            self._connection = await aio_pika.connect_robust(host=self.ip_address,
+                                                             port=self.port,
+                                                             virtualhost=self.virtual_host,
+                                                             login=self.username,
+                                                             password=self.password,
+                                                             heartbeat=60)
+        except Exception:
+            print('AsyncRMQ connection test failed')
+            raise
+
+        self._channel_pool = aio_pika.pool.Pool(self._connection.channel, max_size=self.pool_size)
+        self._log({'function': 'init'})
+        return self
+
+    async def close(self):
+        if self._channel_pool is not None:
+            await self._channel_pool.close()
+            self._channel_pool = None
+
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @contextlib.asynccontextmanager
+    async def _channel(self):
+        async with self._channel_pool.acquire() as channel:
+            # e.g. closed by the broker after a failed passive declare
+            if channel.is_closed:
+                await channel.reopen()
+            yield channel
+
+    async def _get_queue_count(self, queue_name):
+        async with self._channel() as channel:
+            rmq_queue = await channel.declare_queue(queue_name,
+                                                    durable=True,
+                                                    exclusive=False,
+                                                    auto_delete=False,
+                                                    passive=True)
+            return rmq_queue.declaration_result.message_count
+
+    async def get_counts(self, queue_names):
+        """
+        :return: dict of queue name to message count, all queues are queried concurrently
+        """
+        if type(queue_names) is str:
+            queue_names = [queue_names]
+
+        counts = await asyncio.gather(*[self._get_queue_count(queue_name) for queue_name in queue_names])
+        return dict(zip(queue_names, counts))
+
+    async def get_count(self, queue_names):
+
+        if type(queue_names) is str:
+            queue_names = [queue_names]
+
+        self._log({'function':    'get_count',
+                   'queue_names': queue_names,
+                   })
+
+        return sum((await self.get_counts(queue_names)).values())
+
+    async def _purge_queue(self, queue_name):
+        async with self._channel() as channel:
+            rmq_queue = await channel.get_queue(queue_name, ensure=False)
+            res = await rmq_queue.purge()
+            return res.message_count
+
+    async def purge(self, queue_names, verbose=True):
+
+        if type(queue_names) is str:
+            queue_names = [queue_names]
+
+        self._log({'function':    'purge',
+                   'queue_names': queue_names,
+                   })
+
+        if verbose:
+            print(f'purging all messages from <{",".join(queue_names)}>')
+
+        return sum(await asyncio.gather(*[self._purge_queue(queue_name) for queue_name in queue_names]))
+
+    async def read_jsons(self, queue_name, n=None, auto_ack=False, timeout_seconds=60, verbose=True,
+                         prefetch_count=100):
+        # how many to read from mq
+        _num_to_read = await self.get_count(queue_name)
+
+        if n is not None:
+            if verbose:
+                if auto_ack:
+                    print(f'popping {n} messages from <{queue_name}> (total {_num_to_read})')
+                else:
+                    print(f'peeking at {n} messages in <{queue_name}> (total {_num_to_read})')
+
+            if n > _num_to_read:
+                warnings.warn('n > queue length, this method blocks until n messages have been read')
+            _num_to_read = n
+
+        elif verbose:
+            if auto_ack:
+                print(f'popping messages from <{queue_name}> (total {_num_to_read})')
+            else:
+                print(f'peeking at messages in <{queue_name}> (total {_num_to_read})')
+
+        assert type(_num_to_read) is int
+        assert _num_to_read >= 0
+
+        self._log({'function':     'read_jsons',
+                   'queue_name':   queue_name,
+                   'n':            n,
+                   '_num_to_read': _num_to_read,
+                   })
+
+        if _num_to_read == 0:
+            return
+
+        # dedicated channel so that closing it requeues unacked messages, and so qos doesn't leak into the pool
+        channel = await self._connection.channel()
+        try:
+            # unacked messages count against the prefetch, so when peeking all of them have to fit
+            # (prefetch_count is a 16 bit field, 0 means unlimited)
+            if not auto_ack:
+                prefetch_count = max(prefetch_count, _num_to_read) if _num_to_read <= 65535 else 0
+            await channel.set_qos(prefetch_count=prefetch_count)
+            rmq_queue = await channel.get_queue(queue_name, ensure=False)
+
+            messages = asyncio.Queue()
+            consumer_tag = await rmq_queue.consume(messages.put)
+
+            while _num_to_read > 0:
+                try:
+                    message = await asyncio.wait_for(messages.get(), timeout=timeout_seconds)
+                except asyncio.TimeoutError:
+                    continue  # nothing arrived within timeout_seconds, keep waiting like RMQ.read_jsons
+
+                # decode according to content type and encoding
+                yield rmq_codecs.decode(message.body, message.content_type, message.content_encoding,
+                                        fast_json=self.codec.fast_json)
+
+                # ack message
+                if auto_ack:
+                    await message.ack()
+
+                # count down until n==0
+                _num_to_read -= 1
+
+            await rmq_queue.cancel(consumer_tag)
+
+        finally:
+            # re-queue unacked messages, if any
+            if not channel.is_closed:
+                await channel.close()
+
+    async def write_jsons(self, queue_name, json_iterator, window=1000):
+        """
+        publishes with confirms, keeping up to `window` unconfirmed messages in flight
+        `json_iterator` may be a normal or an async iterable
+        """
+
+        self._log({'function':   'write_jsons',
+                   'queue_name': queue_name,
+                   })
+
+        async def json_objs():
+            if hasattr(json_iterator, '__aiter__'):
+                async for _json_obj in json_iterator:
+                    yield _json_obj
+            else:
+                for _json_obj in json_iterator:
+                    yield _json_obj
+
+        n_inserted = 0
+        in_flight = set()
+        async with self._channel() as channel:
+            try:
+                async for json_obj in json_objs():
+                    message = aio_pika.Message(body=self.codec.encode(json_obj),
+                                               content_type=self.codec.content_type,
+                                               content_encoding=self.codec.content_encoding)
+                    in_flight.add(asyncio.ensure_future(channel.default_exchange.publish(message,
+                                                                                         routing_key=queue_name)))
+                    n_inserted += 1
+
+                    # wait for confirms once the window is full, raising if any publish failed
+                    if len(in_flight) >= window:
+                        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+
+                for future in asyncio.as_completed(in_flight):
+                    await future
+
+            # don't leave the other publishes running in the background (or the channel returned to the pool under them)
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()
+                await asyncio.gather(*in_flight, return_exceptions=True)
+                raise
+
+        return n_inserted
+
+    async def wait_until_queues_empty(self,
+                                      queue_names: Union[str, Iterable[str]],
+                                      verbose: Union[bool, int, float] = True,
+                                      on_empty: Optional[Callable] = None,
+                                      min_sleep_seconds: float = 0.5,
+                                      max_sleep_seconds: float = 60):
+        """
+        same as RMQ.wait_until_queues_empty, but `on_empty(queue_name, elapsed_seconds)` may also be a coroutine
+        """
+        if isinstance(queue_names, str):
+            queue_names = [queue_names]
+
+        self._log({'function':    'wait_until_queues_ready',
+                   'queue_names': queue_names,
+                   })
+
+        tracker = EmptyQueuesTracker(queue_names,
+                                     verbose=verbose,
+                                     min_sleep_seconds=min_sleep_seconds,
+                                     max_sleep_seconds=max_sleep_seconds)
+
+        while True:
+            # no management api here, so every count is fresh
+            queue_counts = await self.get_counts(tracker.queue_names_to_recount(dict()))
+
+            for queue_name, elapsed_seconds in tracker.update(queue_counts):
+                if on_empty is not None:
+                    result = on_empty(queue_name, elapsed_seconds)
+                    if inspect.isawaitable(result):
+                        await result
+
+            if tracker.is_done:
+                break
+
+            # wait a while and then continue
+            await asyncio.sleep(tracker.sleep_seconds())
@@ -0,0 +1,132 @@
+import json
+import zlib
+
+# optional faster / more compact codecs
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CONTENT_TYPES = {
+    'json':    'application/json',
+    'orjson':  'application/json',  # same wire format, just a faster encoder
+    'msgpack': 'application/msgpack',
+    'raw':     'application/octet-stream',
+}
+
+
+def _dumps_json(json_obj):
+    return json.dumps(json_obj, ensure_ascii=False, sort_keys=True, allow_nan=False).encode('utf8')
+
+
+def _dumps_orjson(json_obj):
+    # note: unlike allow_nan=False, orjson writes nan/inf as null instead of raising
+    return orjson.dumps(json_obj, option=orjson.OPT_SORT_KEYS)
+
+
+def _loads_json(body, fast_json=False):
+    # orjson reads big ints as floats and rejects NaN, so it is only used when asked for
+    if fast_json:
+        return orjson.loads(body)
+    if type(body) is bytes:
+        body = body.decode('utf8')
+    return json.loads(body)
+
+
+def _dumps_raw(body):
+    if type(body) is str:
+        return body.encode('utf8')
+    assert type(body) is bytes, 'raw codec can only write bytes or str'
+    return body
+
+
+class Codec:
+    """
+    serializes message bodies and names the serialization in the AMQP `content_type`/`content_encoding` properties,
+    so that readers can pick the right decoder regardless of which codec the writer used
+
+    :param serializer: 'json' (stdlib), 'orjson' (faster, if installed), 'msgpack' (if installed), or 'raw' (bytes)
+    :param compression: None, 'zlib', or 'lz4' (if installed)
+    """
+
+    def __init__(self, serializer='json', compression=None, compression_level=None):
+        assert serializer in CONTENT_TYPES, f'unknown serializer: {serializer}'
+        assert compression in (None, 'zlib', 'lz4'), f'unknown compression: {compression}'
+
+        if serializer == 'orjson' and orjson is None:
+            raise ImportError('orjson is not installed')
+        if serializer == 'msgpack' and msgpack is None:
+            raise ImportError('msgpack is not installed')
+        if compression == 'lz4' and lz4 is None:
+            raise ImportError('lz4 is not installed')
+
+        self.serializer = serializer
+        self.compression = compression
+        self.compression_level = compression_level
+        self.content_type = CONTENT_TYPES[serializer]
+        self.fast_json = serializer == 'orjson'  # also read json with orjson
+        self.content_encoding = compression
+
+    def __str__(self):
+        return f'Codec<{self.serializer}+{self.compression}>'
+
+    def encode(self, json_obj):
+        if self.serializer == 'json':
+            body = _dumps_json(json_obj)
+        elif self.serializer == 'orjson':
+            body = _dumps_orjson(json_obj)
+        elif self.serializer == 'msgpack':
+            body = msgpack.packb(json_obj, use_bin_type=True)
+        else:
+            body = _dumps_raw(json_obj)
+
+        if self.compression == 'zlib':
+            body = zlib.compress(body, -1 if self.compression_level is None else self.compression_level)
+        elif self.compression == 'lz4':
+            body = lz4.frame.compress(body, compression_level=self.compression_level or 0)
+
+        return body
+
+
+def decode(body, content_type=None, content_encoding=None, fast_json=False):
+    """
+    decode a message body according to its AMQP properties
+    messages without a content type, or with a `text/*` one, are assumed to be utf8 json
+    (i.e. written before codecs existed, or by other clients)
+    parameters of the content type (e.g. `; charset=utf-8`) are ignored
+
+    :param fast_json: decode json with orjson (if installed), which reads big ints as floats and rejects NaN
+    """
+    if content_encoding == 'zlib':
+        body = zlib.decompress(body)
+    elif content_encoding == 'lz4':
+        if lz4 is None:
+            raise ImportError('lz4 is not installed')
+        body = lz4.frame.decompress(body)
+    elif content_encoding not in (None, '', 'utf8', 'utf-8'):
+        raise ValueError(f'unknown content encoding: {content_encoding}')
+
+    media_type = (content_type or '').split(';', 1)[0].strip().lower()
+
+    if media_type in ('', 'application/json') or media_type.startswith('text/'):
+        return _loads_json(body, fast_json=fast_json and orjson is not None)
+
+    if media_type == 'application/msgpack':
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+        return msgpack.unpackb(body, raw=False)
+
+    if media_type == 'application/octet-stream':
+        return body
+
+    raise ValueError(f'unknown content type: {content_type}')
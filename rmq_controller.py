@@ -1,13 +1,32 @@
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import datetime
-import json
+import functools
+import hashlib
+import inspect
+import os
+import queue
+import random
+import threading
 import time
+import uuid
 import warnings
+import weakref
+from typing import Callable
 from typing import Iterable
+from typing import Optional
 from typing import Union
 
 import math
 import pika
 
+import metrics
+import operation_log
+import rmq_codecs
+import rmq_dump
+import rmq_offsets
 from estimate_time_remaining import RemainingTimeEstimator
 
 
@@ -72,6 +91,223 @@ def format_seconds(num_seconds):
             return f'{minus}{num_seconds:,.0f} {unit}'
 
 
+def adaptive_sleep_seconds(estimates, min_seconds, max_seconds, default_seconds):
+    """
+    poll a few times within the nearest estimated completion time,
+    so long drains back off and queues close to empty are checked often
+    """
+    estimates = [estimate for estimate in estimates if not math.isnan(estimate)]
+    if not estimates:
+        return default_seconds
+    return min(max_seconds, max(min_seconds, min(estimates) / 4))
+
+
+class EmptyQueuesTracker:
+    """
+    bookkeeping for waiting until queues are empty, shared by RMQ and AsyncRMQ, which only supply counts and sleeps:
+        tracker = EmptyQueuesTracker(queue_names)
+        while True:
+            queue_counts = dict(estimate_counts)  # possibly stale, and possibly missing some queues
+            queue_counts.update(get_counts(tracker.queue_names_to_recount(estimate_counts)))
+            for queue_name, elapsed_seconds in tracker.update(queue_counts):
+                on_empty(queue_name, elapsed_seconds)
+            if tracker.is_done:
+                break
+            sleep(tracker.sleep_seconds())
+    *   a queue is reported empty (or refilled) only by a fresh count, stale counts are only used for the estimates
+    *   `stats_lag_seconds` is how stale the estimate counts can be, queues estimated to empty sooner are recounted
+    """
+
+    _eta_max = 999 * 365.25 * 24 * 60 * 60  # 999 years
+
+    def __init__(self, queue_names, verbose=True, min_sleep_seconds=0.5, max_sleep_seconds=60, stats_lag_seconds=0):
+        if isinstance(queue_names, str):
+            queue_names = [queue_names]
+
+        self.queue_names = list(queue_names)
+        self.verbose = verbose
+        self.min_sleep_seconds = min_sleep_seconds
+        self.max_sleep_seconds = max_sleep_seconds
+        self.stats_lag_seconds = stats_lag_seconds
+        self.is_done = False
+
+        self._time_start = time.time()
+        self._completed = set()
+        self._print_seconds = 40
+        self._default_sleep_seconds = 5  # until there's an estimate
+        self._next_print_time = -1
+
+        if verbose:
+            if type(verbose) in (int, float):
+                self._print_seconds = max(self._default_sleep_seconds, verbose)
+
+        self._estimators = dict()
+        for queue_name in self.queue_names:
+            self._estimators[queue_name] = RemainingTimeEstimator(name=queue_name)
+
+    def queue_names_to_recount(self, estimate_counts):
+        """
+        :param estimate_counts: dict of queue name to a possibly stale count, queues may be missing
+        :return: the queues that look (or may by now be) empty or refilled, which need a fresh count
+        """
+        return [queue_name for queue_name in self.queue_names
+                if queue_name not in estimate_counts
+                or (estimate_counts[queue_name] == 0) != (queue_name in self._completed)
+                or (queue_name in self._estimators
+                    and self._estimators[queue_name].get_estimate() <= self.stats_lag_seconds)]
+
+    def update(self, queue_counts):
+        """
+        :param queue_counts: dict of queue name to count, fresh for the queues returned by `queue_names_to_recount`
+        :return: list of (queue_name, elapsed_seconds) for the queues that were just seen empty
+        """
+        newly_empty = []
+        total_count = sum(queue_counts.values())
+
+        # update all estimators individually
+        for queue_name, queue_count in queue_counts.items():
+            assert queue_count >= 0
+
+            # ignore empty queues
+            if queue_count == 0:
+                if queue_name not in self._completed:
+                    elapsed_seconds = time.time() - self._time_start
+                    print(f'<{queue_name}> is empty (elapsed {format_seconds(elapsed_seconds)})')
+                    self._completed.add(queue_name)
+                    del self._estimators[queue_name]
+                    newly_empty.append((queue_name, elapsed_seconds))
+                continue
+
+            # queues that somehow got refilled
+            if queue_name in self._completed:
+                warnings.warn(f'<{queue_name}> unexpectedly refilled!')
+                self._completed.remove(queue_name)
+                self._estimators[queue_name] = RemainingTimeEstimator(name=queue_name)
+
+            # update estimator
+            self._estimators[queue_name].update(queue_count)
+
+        # completed?
+        self.is_done = total_count == 0
+
+        # print estimated time remaining
+        if self.verbose and not self.is_done and time.time() >= self._next_print_time:
+
+            # eta is the worst case estimate
+            furthest_estimate = float('nan')
+            for estimator in self._estimators.values():
+                furthest_estimate = max(estimator.get_estimate(), furthest_estimate)  # put the nan last
+
+            # stuff to print
+            unfinished_queues = sorted(queue_name for queue_name in self.queue_names
+                                       if queue_name not in self._completed)
+            eta = '<?>' if math.isnan(furthest_estimate) else format_seconds(min(self._eta_max, furthest_estimate))
+
+            # print info
+            print(f'waiting for <{",".join(unfinished_queues)}> to be empty... '
+                  f'(elapsed {format_seconds(time.time() - self._time_start)}, len={total_count}, remaining {eta})')
+
+            self._next_print_time = time.time() + self._print_seconds
+
+        return newly_empty
+
+    def sleep_seconds(self):
+        """
+        :return: how long to wait before counting again
+        """
+        return adaptive_sleep_seconds([estimator.get_estimate() for estimator in self._estimators.values()],
+                                      min_seconds=self.min_sleep_seconds,
+                                      max_seconds=self.max_sleep_seconds,
+                                      default_seconds=self._default_sleep_seconds)
+
+
+_metric_messages = metrics.REGISTRY.counter('rmq_messages_total',
+                                            'messages published (direction="out") or received (direction="in")')
+_metric_bytes = metrics.REGISTRY.counter('rmq_bytes_total',
+                                         'message body bytes published (direction="out") or received (direction="in")')
+_metric_connect_seconds = metrics.REGISTRY.histogram('rmq_connect_seconds',
+                                                     'time to open a broker connection and its first channel')
+_metric_rpc_seconds = metrics.REGISTRY.histogram('rmq_rpc_seconds',
+                                                 'round trip time of synchronous broker methods')
+
+
+_metric_dwell_seconds = metrics.REGISTRY.histogram('rmq_queue_dwell_seconds',
+                                                   'time from publish to receipt of traced messages (client clocks)',
+                                                   buckets=metrics.DEFAULT_BUCKETS + (900, 3600, 14400, 86400))
+_metric_end_to_end_seconds = metrics.REGISTRY.histogram('rmq_end_to_end_seconds',
+                                                        'time from the first publish in a trace to receipt',
+                                                        buckets=metrics.DEFAULT_BUCKETS + (900, 3600, 14400, 86400))
+
+# (trace id, origin timestamp) of the traced message this thread received last
+_trace_context = threading.local()
+
+
+def current_trace():
+    """
+    :return: (trace_id, origin_timestamp) of the last traced message received by this thread, or None
+    """
+    return getattr(_trace_context, 'trace', None)
+
+
+@contextlib.contextmanager
+def _trace_scope():
+    # messages received in the block set the current trace, which must not outlive the read
+    # (reads can nest in one thread, e.g. a handler of one queue's messages reading another, so restore, don't clear)
+    previous_trace = current_trace()
+    try:
+        yield
+    finally:
+        _trace_context.trace = previous_trace
+
+
+def _trace_headers():
+    # a message published while handling a traced message continues its trace
+    # timestamps are integer epoch microseconds, pika can't encode float header values
+    now = time.time()
+    trace = current_trace()
+    if trace is None:
+        trace = (uuid.uuid4().hex, now)
+    trace_id, origin_timestamp = trace
+    return {'x-trace-id':        trace_id,
+            'x-publish-ts':      int(now * 1e6),
+            'x-trace-origin-ts': int(origin_timestamp * 1e6),
+            }
+
+
+def _is_timestamp(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _count_messages(direction, queue_name, body):
+    _metric_messages.inc(direction=direction, queue=queue_name)
+    _metric_bytes.inc(len(body), direction=direction, queue=queue_name)
+
+
+def _on_received(queue_name, header_frame, body):
+    _count_messages('in', queue_name, body)
+
+    # other tracing tools use x-trace-id too, so only headers written by _trace_headers count
+    headers = header_frame.headers
+    if (not headers
+            or not isinstance(headers.get('x-trace-id'), str)
+            or not _is_timestamp(headers.get('x-publish-ts'))
+            or not _is_timestamp(headers.get('x-trace-origin-ts'))):
+        _trace_context.trace = None
+        return
+
+    now = time.time()
+    publish_timestamp = headers['x-publish-ts'] / 1e6
+    origin_timestamp = headers['x-trace-origin-ts'] / 1e6
+    _metric_dwell_seconds.observe(max(0.0, now - publish_timestamp), queue=queue_name)
+    _metric_end_to_end_seconds.observe(max(0.0, now - origin_timestamp), queue=queue_name)
+    _trace_context.trace = (headers['x-trace-id'], origin_timestamp)
+
+
+def _decode_and_handle(handler, body, content_type, content_encoding, fast_json):
+    # runs in a worker process, so decoding happens off the consuming thread too
+    return handler(rmq_codecs.decode(body, content_type, content_encoding, fast_json=fast_json))
+
+
 class RChannel:
     rmq_channel: [pika.adapters.blocking_connection.BlockingChannel, None]
     rmq_conn: [pika.BlockingConnection, None]
@@ -100,8 +336,523 @@ class RChannel:
             self.rmq_conn = None
 
 
+class RChannelPool:
+    """
+    long-lived pool of (connection, channel) pairs so that each RMQ call costs an RPC instead of a handshake
+    *   at most `size` idle connections are kept, extra connections are opened on demand and closed on return
+    *   connections are health-checked on checkout and transparently replaced if the broker dropped them
+    *   idle connections have their heartbeats serviced by a background thread
+    """
+    _idle: collections.deque
+
+    def __init__(self, parameters, size=4):
+        assert size >= 1
+        self.parameters = parameters
+        self.size = size
+        self.n_connections_opened = 0
+
+        self._blocked = set()  # ids of connections the broker has blocked (memory or disk alarm)
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+        # BlockingConnection only sends heartbeats while someone is pumping its event loop
+        # the thread only holds a weak reference, so that an abandoned pool can still be garbage collected
+        self._heartbeat_thread = None
+        if self.parameters.heartbeat:
+            self._heartbeat_thread = threading.Thread(target=RChannelPool._service_heartbeats,
+                                                      args=(weakref.ref(self), self._closed,
+                                                            max(1.0, self.parameters.heartbeat / 2)),
+                                                      daemon=True)
+            self._heartbeat_thread.start()
+
+    def _connect(self):
+        with metrics.timer(_metric_connect_seconds):
+            rmq_conn = pika.BlockingConnection(parameters=self.parameters)
+            rmq_channel = rmq_conn.channel()
+        self.n_connections_opened += 1
+
+        # note: these are dispatched when the connection's events are processed, e.g. by process_data_events
+        rmq_conn.add_on_connection_blocked_callback(lambda conn, method_frame: self._blocked.add(id(conn)))
+        rmq_conn.add_on_connection_unblocked_callback(lambda conn, method_frame: self._blocked.discard(id(conn)))
+        return rmq_conn, rmq_channel
+
+    def _discard(self, rmq_conn):
+        self._blocked.discard(id(rmq_conn))
+        try:
+            if rmq_conn.is_open:
+                rmq_conn.close()
+        except pika.exceptions.AMQPError:
+            pass
+
+    def is_blocked(self, rmq_conn):
+        return id(rmq_conn) in self._blocked
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None  # most recently used is least likely to be stale
+
+            if entry is None:
+                return self._connect()
+
+            # health check: pumping the event loop surfaces dropped sockets and services heartbeats
+            rmq_conn, rmq_channel = entry
+            try:
+                rmq_conn.process_data_events(time_limit=0)
+                if rmq_conn.is_open:
+                    if not rmq_channel.is_open:  # e.g. closed by the broker after a failed passive declare
+                        rmq_channel = rmq_conn.channel()
+                    return rmq_conn, rmq_channel
+            except pika.exceptions.AMQPError:
+                pass
+
+            self._discard(rmq_conn)
+
+    def _checkin(self, rmq_conn, rmq_channel):
+        if rmq_conn.is_open and not self._closed.is_set():
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((rmq_conn, rmq_channel))
+                    return
+
+        self._discard(rmq_conn)
+
+    def _service_idle(self):
+        with self._lock:
+            entries = list(self._idle)
+            self._idle.clear()
+
+        for rmq_conn, rmq_channel in entries:
+            try:
+                rmq_conn.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError:
+                pass
+            self._checkin(rmq_conn, rmq_channel)
+
+    @staticmethod
+    def _service_heartbeats(pool_ref, closed, interval):
+        while not closed.wait(interval):
+            pool = pool_ref()
+            if pool is None:
+                return  # garbage collected without being closed
+            pool._service_idle()
+            del pool
+
+    @contextlib.contextmanager
+    def channel(self, dedicated=False):
+        """
+        check out a channel, returning it to the pool afterwards
+        if `dedicated` is set, a fresh channel is opened on a pooled connection and closed afterwards,
+        for callers that change channel state (qos, confirm mode, consumers) which must not leak into the pool
+
+        :type dedicated: bool
+        """
+        rmq_conn, rmq_channel = self._checkout()
+        dedicated_channel = None
+        try:
+            if dedicated:
+                dedicated_channel = rmq_conn.channel()
+                yield dedicated_channel
+            else:
+                yield rmq_channel
+
+        finally:
+            if dedicated_channel is not None and dedicated_channel.is_open:
+                try:
+                    dedicated_channel.close()
+                except pika.exceptions.AMQPError:
+                    pass
+            self._checkin(rmq_conn, rmq_channel)
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            entries = list(self._idle)
+            self._idle.clear()
+        for rmq_conn, _ in entries:
+            self._discard(rmq_conn)
+
+
+# BlockingChannel.confirm_delivery() makes every basic_publish wait for its own confirm, and pika has no public
+# blocking api to publish a batch and then wait for its confirms, so RPublisher (and the batched acks in RMQ.move)
+# use these internals of the channel underneath a BlockingChannel
+# pika is pinned in requirements.txt, and check_pika_internals() fails loudly if a release changes them
+_PIKA_INTERNALS = (
+    (pika.channel.Channel, 'confirm_delivery', ('ack_nack_callback', 'callback')),
+    (pika.channel.Channel, 'basic_publish', ('exchange', 'routing_key', 'body', 'properties')),
+    (pika.channel.Channel, 'basic_ack', ('delivery_tag', 'multiple')),
+    (pika.adapters.blocking_connection.BlockingChannel, '_flush_output', ('waiters',)),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def check_pika_internals():
+    """
+    raise if the installed pika no longer has the private methods RPublisher relies on
+    """
+    for cls, method_name, parameter_names in _PIKA_INTERNALS:
+        method = getattr(cls, method_name, None)
+        if method is None:
+            raise RuntimeError(f'pika {pika.__version__} no longer has {cls.__name__}.{method_name}, '
+                               f'install the version in requirements.txt')
+        missing = set(parameter_names) - set(inspect.signature(method).parameters)
+        if missing:
+            raise RuntimeError(f'pika {pika.__version__} changed {cls.__name__}.{method_name} '
+                               f'(missing parameters: {sorted(missing)}), install the version in requirements.txt')
+    blocking_channel_init = inspect.getsource(pika.adapters.blocking_connection.BlockingChannel.__init__)
+    if 'self._impl = ' not in blocking_channel_init:
+        raise RuntimeError(f'pika {pika.__version__} no longer keeps the underlying channel in BlockingChannel._impl, '
+                           f'install the version in requirements.txt')
+
+
+class RPublisher:
+    """
+    pipelined publisher using publisher confirms on a channel it owns (don't share the channel while publishing)
+    *   up to `window` unconfirmed messages are kept in flight instead of waiting one round trip per message
+    *   delivery tags are tracked, nacked messages are resent up to `max_retries` times, then reported as failed
+    *   an optional `tag` per message is handed back via `pop_confirmed()` once the broker has confirmed it
+    *   if `max_unconfirmed_bytes` is set, the window is also limited by the total size of unconfirmed bodies
+    """
+    _unconfirmed: collections.OrderedDict
+
+    def __init__(self, rmq_channel, window=1000, max_retries=3, max_unconfirmed_bytes=None):
+        assert window >= 1
+        assert max_retries >= 0
+        self.rmq_channel = rmq_channel
+        self.window = window
+        self.max_retries = max_retries
+        self.max_unconfirmed_bytes = max_unconfirmed_bytes
+
+        self.throttled_seconds = 0.0
+        self.publish_rate = float('nan')  # messages per second, smoothed
+        self._rate_time = time.time()
+        self._rate_count = 0
+
+        self.n_published = 0
+        self.n_confirmed = 0
+        self.n_nacked = 0
+        self.n_resent = 0
+        self.n_failed = 0
+        self.failed = []  # (routing_key, body) of messages nacked more than max_retries times
+
+        self._next_delivery_tag = 1
+        self._unconfirmed = collections.OrderedDict()  # delivery tag -> message, in publish order
+        self._unconfirmed_bytes = 0
+        self._to_resend = collections.deque()
+        self._confirmed_tags = []
+
+        # BlockingChannel.confirm_delivery() would make every publish wait for its confirm,
+        # so confirm mode is enabled on the underlying channel and acks/nacks are tracked here instead
+        check_pika_internals()
+        select_ok = []
+        self.rmq_channel._impl.confirm_delivery(ack_nack_callback=self._on_ack_nack, callback=select_ok.append)
+        self._wait_until(lambda: select_ok)
+
+    def _wait_until(self, condition):
+        # processes broker frames (confirms, heartbeats) until the condition holds, raises if the channel closes
+        self.rmq_channel._flush_output(condition)
+
+    def _send(self, message):
+        exchange, routing_key, body, properties, tag, n_attempts = message
+        self.rmq_channel._impl.basic_publish(exchange=exchange,
+                                             routing_key=routing_key,
+                                             body=body,
+                                             properties=properties)
+        self._unconfirmed[self._next_delivery_tag] = message
+        self._unconfirmed_bytes += len(body)
+        self._next_delivery_tag += 1
+        self.n_published += 1
+        _count_messages('out', routing_key, body)
+
+    def _settle(self, delivery_tag, acked):
+        message = self._unconfirmed.pop(delivery_tag, None)
+        if message is None:
+            return
+
+        exchange, routing_key, body, properties, tag, n_attempts = message
+        self._unconfirmed_bytes -= len(body)
+        if acked:
+            self.n_confirmed += 1
+            if tag is not None:
+                self._confirmed_tags.append(tag)
+            return
+
+        self.n_nacked += 1
+        if n_attempts <= self.max_retries:
+            self._to_resend.append((exchange, routing_key, body, properties, tag, n_attempts + 1))
+        else:
+            self.n_failed += 1
+            self.failed.append((routing_key, body))
+
+    def _on_ack_nack(self, method_frame):
+        acked = isinstance(method_frame.method, pika.spec.Basic.Ack)
+        delivery_tag = method_frame.method.delivery_tag
+
+        if not method_frame.method.multiple:
+            self._settle(delivery_tag, acked)
+            return
+
+        # multiple=True settles everything up to and including the delivery tag
+        while self._unconfirmed:
+            oldest_tag = next(iter(self._unconfirmed))
+            if oldest_tag > delivery_tag:
+                break
+            self._settle(oldest_tag, acked)
+
+    def _has_room(self):
+        if len(self._unconfirmed) >= self.window:
+            return False
+        if self.max_unconfirmed_bytes is not None and self._unconfirmed:
+            return self._unconfirmed_bytes < self.max_unconfirmed_bytes
+        return True
+
+    def _update_publish_rate(self):
+        now = time.time()
+        if now - self._rate_time >= 1:
+            rate = (self.n_published - self._rate_count) / (now - self._rate_time)
+            self.publish_rate = rate if math.isnan(self.publish_rate) else 0.5 * self.publish_rate + 0.5 * rate
+            self._rate_time = now
+            self._rate_count = self.n_published
+
+    def _resend_nacked(self):
+        while self._to_resend:
+            self._wait_until(self._has_room)
+            self._send(self._to_resend.popleft())
+            self.n_resent += 1
+
+    def publish(self, exchange, routing_key, body, properties=None, tag=None):
+        self._resend_nacked()
+        self._wait_until(self._has_room)
+        self._send((exchange, routing_key, body, properties, tag, 1))
+        self._update_publish_rate()
+
+    def pause_while(self, condition, poll_seconds=1.0):
+        """
+        stop publishing while `condition()` holds, servicing confirms and heartbeats in the meantime
+        time spent paused is added to `throttled_seconds`
+        """
+        time_start = time.time()
+        while condition():
+            self.rmq_channel.connection.sleep(poll_seconds)
+            self._update_publish_rate()
+        self.throttled_seconds += time.time() - time_start
+
+    def flush(self):
+        """
+        block until every published message has been confirmed (or has failed after retries)
+        """
+        while self._unconfirmed or self._to_resend:
+            self._resend_nacked()
+            self._wait_until(lambda: not self._unconfirmed or self._to_resend)
+
+    def pop_confirmed(self):
+        confirmed_tags, self._confirmed_tags = self._confirmed_tags, []
+        return confirmed_tags
+
+    def stats(self):
+        return {'published':         self.n_published,
+                'confirmed':         self.n_confirmed,
+                'nacked':            self.n_nacked,
+                'resent':            self.n_resent,
+                'failed':            self.n_failed,
+                'throttled_seconds': self.throttled_seconds,
+                }
+
+
+class RConsumer:
+    """
+    consumer whose connection is owned by a background thread, so heartbeats keep flowing however long the caller
+    spends on a message, and which reconnects (with exponential backoff) whenever the connection drops
+    *   deliveries are handed over through an in-memory queue, holding at most `prefetch_count` of them
+    *   each connection is a new generation: its delivery tags are meaningless on later connections,
+        and whatever it had delivered but not acked is redelivered by the broker after the drop,
+        so stale deliveries are dropped from the hand-over queue and acking them is a no-op
+    *   gives up after `max_reconnects` consecutive failed attempts, re-raising the last error from `get()`
+    """
+
+    def __init__(self, parameters, queue_name, prefetch_count=100, max_reconnects=10, backoff_seconds=1.0,
+                 max_backoff_seconds=60.0):
+        assert prefetch_count >= 1
+        self.parameters = parameters
+        self.queue_name = queue_name
+        self.prefetch_count = prefetch_count
+        self.max_reconnects = max_reconnects
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self.generation = 0
+        self.n_reconnects = 0
+        self.error = None
+
+        self._deliveries = queue.Queue()
+        self._connection = None
+        self._channel = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f'RConsumer<{queue_name}>')
+
+    def _consume(self):
+        rmq_conn = pika.BlockingConnection(parameters=self.parameters)
+        try:
+            rmq_channel = rmq_conn.channel()
+            rmq_channel.basic_qos(prefetch_count=self.prefetch_count)
+
+            generation = self.generation + 1
+
+            def on_message(channel, method_frame, header_frame, body):
+                self._deliveries.put((generation, method_frame.delivery_tag, header_frame, body))
+
+            rmq_channel.basic_consume(queue=self.queue_name, on_message_callback=on_message)
+            with self._lock:
+                self._connection = rmq_conn
+                self._channel = rmq_channel
+                self.generation = generation
+
+            # also runs the acks queued by ack() via add_callback_threadsafe
+            while not self._closed.is_set():
+                rmq_conn.process_data_events(time_limit=1)
+
+        finally:
+            with self._lock:
+                self._connection = None
+                self._channel = None
+            try:
+                if rmq_conn.is_open:
+                    rmq_conn.close()  # unacked messages are requeued
+            except pika.exceptions.AMQPError:
+                pass
+
+    def _run(self):
+        n_failures = 0
+        while not self._closed.is_set():
+            generation = self.generation
+            try:
+                self._consume()
+
+            except pika.exceptions.AMQPError as e:
+                # a successful connection resets the backoff
+                if self.generation != generation:
+                    n_failures = 0
+
+                # a missing queue won't come back by retrying
+                if isinstance(e, pika.exceptions.ChannelClosedByBroker) and e.reply_code == 404:
+                    self.error = e
+                    break
+
+                n_failures += 1
+                if n_failures > self.max_reconnects:
+                    self.error = e
+                    break
+
+                sleep_seconds = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (n_failures - 1))
+                warnings.warn(f'connection to <{self.queue_name}> lost ({e!r}), reconnecting in '
+                              f'{format_seconds(sleep_seconds)} (attempt {n_failures}/{self.max_reconnects})')
+                self._closed.wait(sleep_seconds)
+                self.n_reconnects += 1
+
+            except Exception as e:
+                self.error = e
+                break
+
+    def start(self):
+        self._thread.start()
+
+    def get(self, timeout=None):
+        """
+        :return: the next (generation, delivery_tag, header_frame, body), or None if nothing arrived within `timeout`
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.error is not None:
+                raise self.error
+            wait_seconds = 1 if deadline is None else max(0, min(1, deadline - time.time()))
+            try:
+                delivery = self._deliveries.get(timeout=wait_seconds)
+            except queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    return None
+                continue
+
+            # delivered on a connection that has since dropped, the broker will redeliver it
+            if delivery[0] == self.generation:
+                return delivery
+
+    def ack(self, generation, delivery_tag):
+        """
+        :return: False if the connection that delivered the message is gone (so it will be redelivered)
+        """
+        with self._lock:
+            if generation != self.generation or self._connection is None:
+                return False
+            rmq_conn, rmq_channel = self._connection, self._channel
+
+        try:
+            rmq_conn.add_callback_threadsafe(functools.partial(rmq_channel.basic_ack, delivery_tag))
+        except pika.exceptions.AMQPError:
+            return False
+        return True
+
+    def close(self):
+        self._closed.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def shard_queue_names(queue_names, n_shards=None):
+    """
+    either a list of queue names, or a prefix and a number of shards, e.g. ('events', 3) -> events.0, events.1, events.2
+    """
+    if n_shards is not None:
+        assert type(queue_names) is str, 'pass a queue name prefix together with n_shards'
+        assert n_shards >= 1
+        return [f'{queue_names}.{i}' for i in range(n_shards)]
+
+    if type(queue_names) is str:
+        queue_names = [queue_names]
+    queue_names = list(queue_names)
+    assert queue_names
+    assert len(set(queue_names)) == len(queue_names), 'duplicate shard queue names'
+    return queue_names
+
+
+class ConsistentHashRing:
+    """
+    maps keys to queue names so that each key always lands on the same queue,
+    and adding or removing a queue only remaps the keys of its neighbours on the ring (about 1/N of them)
+    each queue is placed at `n_virtual` points on the ring to even out the load
+    """
+
+    def __init__(self, queue_names, n_virtual=128):
+        assert n_virtual >= 1
+        self.queue_names = list(queue_names)
+        points = sorted((self._hash(f'{queue_name}#{i}'), queue_name)
+                        for queue_name in self.queue_names
+                        for i in range(n_virtual))
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._queue_names = [queue_name for _, queue_name in points]
+
+    @staticmethod
+    def _hash(key):
+        if type(key) is not bytes:
+            key = str(key).encode('utf8')
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    def get(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key))
+        return self._queue_names[index % len(self._queue_names)]
+
+
 class RMQ:
-    def __init__(self, ip_address, port, virtual_host, username, password, name=None, logfile='rmq.log'):
+    def __init__(self, ip_address, port, virtual_host, username, password, name=None, logfile='rmq.log',
+                 pool_size=4, codec='json', compression=None, admin=None, trace=False):
         self.ip_address = ip_address
         self.port = port
         self.virtual_host = virtual_host
@@ -110,13 +861,24 @@ class RMQ:
         self.exchange = 'amq.default'
         self.logfile = logfile
         self.name = name
-        self.log_separator = '--'  # compatible with jdump files
+        self.codec = rmq_codecs.Codec(serializer=codec, compression=compression)
+        self.admin = admin  # optional RMQAdmin, used for queue counts
+        self.trace = trace  # stamp trace headers on published messages
+
+        parameters = pika.ConnectionParameters(host=self.ip_address,
+                                               port=self.port,
+                                               virtual_host=self.virtual_host,
+                                               credentials=pika.credentials.PlainCredentials(self.username,
+                                                                                             self.password),
+                                               heartbeat=60)
+        self._pool = RChannelPool(parameters, size=pool_size)
 
         try:
-            with RChannel(self.ip_address, self.port, self.virtual_host, self.username, self.password) as rmq_channel:
+            with self._pool.channel() as rmq_channel:
                 assert rmq_channel.is_open
         except Exception:
             print('RMQ connection test failed')
+            self._pool.close()
             raise
 
         self._log({'function': 'init'})
@@ -127,6 +889,15 @@ class RMQ:
         else:
             return f'RMQ<[{self.name}]={self.username}@{self.ip_address}:{self.port}/{self.virtual_host}>'
 
+    def close(self):
+        self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     def _log(self, json_data):
 
         json_data['config'] = {
@@ -138,17 +909,22 @@ class RMQ:
         }
 
         if self.logfile is not None:
-            for _ in range(5):
-                try:
-                    with open(self.logfile, mode='at', encoding='utf8', newline='\n') as f:
-                        f.write(json.dumps(json_data, indent=4, sort_keys=True, ensure_ascii=False) + '\n')
-                        if self.log_separator:
-                            f.write(self.log_separator + '\n')
-                    break
-                except IOError:
-                    time.sleep(1)
+            operation_log.get_logger(self.logfile).log(json_data)
+
+    def _encode(self, json_obj):
+        body = self.codec.encode(json_obj)
+        properties = pika.BasicProperties(content_type=self.codec.content_type,
+                                          content_encoding=self.codec.content_encoding,
+                                          headers=_trace_headers() if self.trace else None)
+        return body, properties
 
-    def get_count(self, queue_names):
+    def _decode(self, header_frame, body):
+        # decoder is chosen by the message's own properties, json is only read with orjson if this instance writes it
+        return rmq_codecs.decode(body, header_frame.content_type, header_frame.content_encoding,
+                                 fast_json=self.codec.fast_json)
+
+    @metrics.instrumented('rmq')
+    def get_count(self, queue_names, fresh=True):
 
         if type(queue_names) is str:
             queue_names = [queue_names]
@@ -157,18 +933,39 @@ class RMQ:
                    'queue_names': queue_names,
                    })
 
-        count = 0
-        with RChannel(self.ip_address, self.port, self.virtual_host, self.username, self.password) as rmq_channel:
+        return sum(self.get_counts(queue_names, fresh=fresh).values())
+
+    @metrics.instrumented('rmq')
+    def get_counts(self, queue_names, fresh=True):
+        """
+        :param fresh: if not set and this instance has an `admin`, counts come from a single (cached) management api
+                      snapshot, which can be a few seconds old, so don't use that to decide how many messages to read
+        :return: dict of queue name to message count, all fetched using one pooled channel
+        """
+        if type(queue_names) is str:
+            queue_names = [queue_names]
+
+        if not fresh and self.admin is not None:
+            snapshot = self.admin.snapshot()
+            missing_queue_names = [queue_name for queue_name in queue_names if queue_name not in snapshot.index]
+            if missing_queue_names:
+                raise KeyError(f'queues not found: <{",".join(missing_queue_names)}>')
+            return {queue_name: int(snapshot.at[queue_name, 'messages_ready']) for queue_name in queue_names}
+
+        counts = dict()
+        with self._pool.channel() as rmq_channel:
             for queue_name in queue_names:
-                rmq_queue = rmq_channel.queue_declare(queue=queue_name,
-                                                      durable=True,
-                                                      exclusive=False,
-                                                      auto_delete=False,
-                                                      passive=True)
-                count += rmq_queue.method.message_count
+                with metrics.timer(_metric_rpc_seconds, method='queue_declare'):
+                    rmq_queue = rmq_channel.queue_declare(queue=queue_name,
+                                                          durable=True,
+                                                          exclusive=False,
+                                                          auto_delete=False,
+                                                          passive=True)
+                counts[queue_name] = rmq_queue.method.message_count
 
-        return count
+        return counts
 
+    @metrics.instrumented('rmq')
     def purge(self, queue_names, verbose=True):
 
         if type(queue_names) is str:
@@ -182,9 +979,10 @@ class RMQ:
             print(f'purging all messages from <{",".join(queue_names)}>')
 
         removed_count = 0
-        with RChannel(self.ip_address, self.port, self.virtual_host, self.username, self.password) as rmq_channel:
+        with self._pool.channel() as rmq_channel:
             for queue_name in queue_names:
-                res = rmq_channel.queue_purge(queue=queue_name)
+                with metrics.timer(_metric_rpc_seconds, method='queue_purge'):
+                    res = rmq_channel.queue_purge(queue=queue_name)
                 assert res.method.NAME == 'Queue.PurgeOk'
                 removed_count += res.method.message_count
 
@@ -222,34 +1020,390 @@ class RMQ:
 
         # start reading
         if _num_to_read > 0:
-            with RChannel(self.ip_address, self.port, self.virtual_host, self.username, self.password) as rmq_channel:
-                for method_frame, header_frame, body in rmq_channel.consume(queue=queue_name,
-                                                                            inactivity_timeout=timeout_seconds):
-                    # finished reading messages
-                    if _num_to_read == 0:
-                        break
+            with self._pool.channel() as rmq_channel, _trace_scope():
+                try:
+                    for method_frame, header_frame, body in rmq_channel.consume(queue=queue_name,
+                                                                                inactivity_timeout=timeout_seconds):
+                        # rabbit mq way of saying there's nothing left (after timeout_seconds of the queue being empty)
+                        if body is None:
+                            continue
+                        _on_received(queue_name, header_frame, body)
+
+                        # decode according to content type and encoding
+                        yield self._decode(header_frame, body)
+
+                        # ack message
+                        if auto_ack and method_frame:
+                            rmq_channel.basic_ack(method_frame.delivery_tag)
+
+                        # count down until n==0, then stop without waiting for another delivery (or the timeout)
+                        _num_to_read -= 1
+                        if _num_to_read == 0:
+                            break
+
+                finally:
+                    # re-queue unacked messages, if any (the channel goes back to the pool, so closing won't do it)
+                    if rmq_channel.is_open:
+                        rmq_channel.cancel()
+                        rmq_channel.basic_nack(delivery_tag=0, multiple=True, requeue=True)
+
+    def consume_jsons(self, queue_name, n=None, prefetch_count=100, timeout_seconds=60, max_reconnects=10,
+                      backoff_seconds=1.0, max_backoff_seconds=60.0, verbose=True):
+        """
+        long-running consumer for slow handlers, yielding json objects (see RConsumer)
+        *   the connection is serviced by a background thread, so the caller can take as long as it likes per message
+            (up to the broker's consumer_timeout, after which the broker closes the channel and we reconnect)
+        *   each message is acked once the caller asks for the next one
+        *   dropped connections are re-established with exponential backoff, and reading continues;
+            messages that were delivered but not yet acked when the connection dropped are redelivered
+            (i.e. at-least-once, a message being handled during a drop will be seen again)
+        *   stops after `n` messages, or once no message arrives for `timeout_seconds`
+        """
+        if verbose:
+            print(f'consuming messages from <{queue_name}> (total {self.get_count(queue_name)})')
 
-                    # rabbit mq way of saying there's nothing left (after timeout_seconds of the queue being empty)
-                    if body is None:
-                        continue
+        self._log({'function':       'consume_jsons',
+                   'queue_name':     queue_name,
+                   'n':              n,
+                   'prefetch_count': prefetch_count,
+                   'max_reconnects': max_reconnects,
+                   })
 
-                    # decode to utf8
-                    if type(body) is bytes:
-                        body = body.decode('utf8')
+        consumer = RConsumer(self._pool.parameters,
+                             queue_name,
+                             prefetch_count=prefetch_count,
+                             max_reconnects=max_reconnects,
+                             backoff_seconds=backoff_seconds,
+                             max_backoff_seconds=max_backoff_seconds)
+        with consumer, _trace_scope():
+            n_read = 0
+            n_unacked = 0
+            while n is None or n_read < n:
+                delivery = consumer.get(timeout=timeout_seconds)
+                if delivery is None:
+                    break
 
-                    # json decode
-                    yield json.loads(body)
+                generation, delivery_tag, header_frame, body = delivery
+                _on_received(queue_name, header_frame, body)
+                yield self._decode(header_frame, body)
 
-                    # ack message
-                    if auto_ack and method_frame:
-                        rmq_channel.basic_ack(method_frame.delivery_tag)
+                # caller has finished handling the message
+                if not consumer.ack(generation, delivery_tag):
+                    n_unacked += 1
+                n_read += 1
 
-                    # count down until n==0
+        if verbose:
+            print(f'consumed {n_read} messages from <{queue_name}> ({consumer.n_reconnects} reconnects, '
+                  f'{n_unacked} handled during a drop and requeued)')
+
+    def _browse(self, rmq_channel, queue_name, n, timeout_seconds, offset=None):
+        """
+        receive up to `n` messages on a consumer with prefetch `n`, without settling them
+        returns a list of (delivery_tag, header_frame, body), stops early if no message arrives for `timeout_seconds`
+        """
+        # prefetch_count is a 16 bit field, 0 means unlimited (which streams don't allow, see peek)
+        rmq_channel.basic_qos(prefetch_count=n if n <= 65535 else 0)
+        arguments = None if offset is None else {'x-stream-offset': offset}
+
+        deliveries = []
+        for method_frame, header_frame, body in rmq_channel.consume(queue=queue_name,
+                                                                    arguments=arguments,
+                                                                    inactivity_timeout=timeout_seconds):
+            if body is None:
+                break
+            _count_messages('in', queue_name, body)
+            deliveries.append((method_frame.delivery_tag, header_frame, body))
+            if len(deliveries) >= n:
+                break
+
+        # cancel() rejects anything prefetched but not yet received, the rest is settled explicitly:
+        # requeued in one multi-nack (the broker puts them back in their original positions),
+        # or acked for streams, where acks don't remove anything and only grant more credit
+        rmq_channel.cancel()
+        if deliveries:
+            if offset is None:
+                rmq_channel.basic_nack(delivery_tag=deliveries[-1][0], multiple=True, requeue=True)
+            else:
+                rmq_channel.basic_ack(delivery_tag=deliveries[-1][0], multiple=True)
+
+        return deliveries
+
+    @metrics.instrumented('rmq')
+    def peek(self, queue_name, n=10, offset=None, timeout_seconds=1, verbose=True):
+        """
+        look at the first `n` messages of a queue without removing them
+        *   only `n` messages are prefetched, and they are requeued with a single nack as soon as they arrive
+            (they are still marked as redelivered, and are hidden from other consumers for that round trip)
+        *   for stream queues, pass `offset` ('first', 'last', 'next', an offset number, or a datetime)
+            to browse from that point instead; reading a stream never changes it
+            (at most 65535 at a time, since stream consumers need a prefetch limit)
+
+        :return: list of up to `n` json objects
+        """
+        assert n > 0
+        if offset is not None and n > 65535:
+            raise ValueError(f'can peek at most 65535 messages of a stream at a time, not {n}')
+
+        self._log({'function':   'peek',
+                   'queue_name': queue_name,
+                   'n':          n,
+                   'offset':     offset,
+                   })
+
+        if offset is None:
+            n = min(n, self.get_count(queue_name))
+            if n == 0:
+                return []
+
+        if verbose:
+            print(f'peeking at {n} messages in <{queue_name}>{"" if offset is None else f" from offset {offset}"}')
+
+        # dedicated channel so the qos setting doesn't leak into the pool
+        with self._pool.channel(dedicated=True) as rmq_channel:
+            deliveries = self._browse(rmq_channel, queue_name, n, timeout_seconds, offset=offset)
+
+        return [self._decode(header_frame, body) for _, header_frame, body in deliveries]
+
+    @metrics.instrumented('rmq')
+    def sample(self, queue_name, n=100, stream=False, max_scan=None, timeout_seconds=1, verbose=True):
+        """
+        random sample of `n` messages, without removing any of them
+        *   for stream queues (`stream=True`) the sample is drawn from the whole stream,
+            by reading one message at each of `n` random offsets, so the cost doesn't grow with the stream length
+        *   other queues only hand out messages from the head, so the sample is drawn uniformly from the first
+            `max_scan` messages (default 10 * n), which are held unacked just long enough to pick the sample
+            and are then requeued with a single nack
+
+        :return: list of up to `n` json objects, in queue order
+        """
+        assert n > 0
+        if max_scan is None:
+            max_scan = 10 * n
+        assert max_scan >= n
+
+        self._log({'function':   'sample',
+                   'queue_name': queue_name,
+                   'n':          n,
+                   'stream':     stream,
+                   'max_scan':   max_scan,
+                   })
+
+        # dedicated channel so the qos setting doesn't leak into the pool
+        with self._pool.channel(dedicated=True) as rmq_channel:
+            if not stream:
+                n_scan = min(max_scan, self.get_count(queue_name))
+                deliveries = self._browse(rmq_channel, queue_name, n_scan, timeout_seconds) if n_scan else []
+                if verbose:
+                    print(f'sampling {min(n, len(deliveries))} of the first {len(deliveries)} messages '
+                          f'in <{queue_name}>')
+                deliveries = sorted(random.sample(deliveries, min(n, len(deliveries))))
+                return [self._decode(header_frame, body) for _, header_frame, body in deliveries]
+
+            # the first message carries the stream's first offset, the stream length gives the last one
+            first = self._browse(rmq_channel, queue_name, 1, timeout_seconds, offset='first')
+            if not first:
+                return []
+            first_offset = first[0][1].headers['x-stream-offset']
+            rmq_queue = rmq_channel.queue_declare(queue=queue_name,
+                                                  durable=True,
+                                                  exclusive=False,
+                                                  auto_delete=False,
+                                                  passive=True)
+            n_messages = max(1, rmq_queue.method.message_count)
+
+            if verbose:
+                print(f'sampling {min(n, n_messages)} of {n_messages} messages in stream <{queue_name}>')
+
+            samples = []
+            for offset in sorted(random.sample(range(first_offset, first_offset + n_messages), min(n, n_messages))):
+                samples.extend(self._browse(rmq_channel, queue_name, 1, timeout_seconds, offset=offset))
+
+        return [self._decode(header_frame, body) for _, header_frame, body in samples]
+
+    def read_json_batches(self, queue_name, batch_size=100, max_bytes=None, prefetch_count=None, n=None,
+                          timeout_seconds=60, verbose=True):
+        """
+        consume messages in batches, yielding lists of json objects
+        *   a batch ends at `batch_size` messages or once its bodies total `max_bytes`
+        *   a partial batch is yielded if no message arrives for `timeout_seconds`
+        *   each batch is acked with a single multi-ack when the next batch is requested, i.e. after it was handled
+            (a batch whose handler raises, or that is abandoned, is requeued when the channel closes)
+        """
+        # how many to read from mq
+        _num_to_read = self.get_count(queue_name)
+        if n is not None:
+            if n > _num_to_read:
+                warnings.warn('n > queue length, this method blocks until n messages have been read')
+            _num_to_read = n
+
+        if prefetch_count is None:
+            prefetch_count = 2 * batch_size
+        elif prefetch_count < batch_size:
+            warnings.warn('prefetch_count < batch_size, batches will be cut short by timeout_seconds')
+
+        assert type(_num_to_read) is int
+        assert _num_to_read >= 0
+        assert batch_size > 0
+
+        if verbose:
+            print(f'popping messages from <{queue_name}> in batches of {batch_size} (total {_num_to_read})')
+
+        self._log({'function':       'read_json_batches',
+                   'queue_name':     queue_name,
+                   'n':              n,
+                   '_num_to_read':   _num_to_read,
+                   'batch_size':     batch_size,
+                   'max_bytes':      max_bytes,
+                   'prefetch_count': prefetch_count,
+                   })
+
+        if _num_to_read == 0:
+            return
+
+        # dedicated channel so the qos setting doesn't leak into the pool, and closing it requeues unacked messages
+        with self._pool.channel(dedicated=True) as rmq_channel, _trace_scope():
+            rmq_channel.basic_qos(prefetch_count=prefetch_count)
+
+            batch = []
+            batch_bytes = 0
+            last_delivery_tag = None
+            for method_frame, header_frame, body in rmq_channel.consume(queue=queue_name,
+                                                                        inactivity_timeout=timeout_seconds):
+                if body is not None:
+                    _on_received(queue_name, header_frame, body)
+                    batch_bytes += len(body)
+                    batch.append(self._decode(header_frame, body))
+                    last_delivery_tag = method_frame.delivery_tag
                     _num_to_read -= 1
 
-                # re-queue unacked messages, if any
-                rmq_channel.cancel()
+                # batch is full, the byte budget is used up, we're done, or the queue went quiet
+                if batch and (len(batch) >= batch_size
+                              or (max_bytes is not None and batch_bytes >= max_bytes)
+                              or _num_to_read == 0
+                              or body is None):
+                    yield batch
+
+                    # caller has finished handling the batch
+                    rmq_channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+                    batch = []
+                    batch_bytes = 0
+
+                # finished reading messages
+                if _num_to_read == 0:
+                    break
+
+    def map_jsons(self, queue_name, handler, processes=None, max_in_flight=None, ordered=True, n=None,
+                  max_restarts=3, verbose=True):
+        """
+        consume messages and run `handler(json_obj)` in a pool of worker processes, yielding the handler results
+        *   raw bodies are sent to the workers, `handler` must be picklable (i.e. a module-level function)
+        *   at most `max_in_flight` messages are unacked at once (this is also the prefetch count)
+        *   each message is acked only after its handler has returned
+        *   if `ordered`, results are yielded (and messages acked) in delivery order, otherwise as they complete
+        *   if a worker process dies, the in-flight messages are requeued and the pool is restarted
+            (a broken pool fails all of its pending work, so this requeues every in-flight message)
+        *   if a handler raises, the in-flight messages are requeued and the exception is re-raised
+        """
+        if processes is None:
+            processes = os.cpu_count()
+        if max_in_flight is None:
+            max_in_flight = 2 * processes
+
+        # how many to read from mq
+        _num_to_read = self.get_count(queue_name)
+        if n is not None:
+            if n > _num_to_read:
+                warnings.warn('n > queue length, this method blocks until n messages have been read')
+            _num_to_read = n
+
+        assert type(_num_to_read) is int
+        assert _num_to_read >= 0
+        assert max_in_flight >= processes > 0
+
+        if verbose:
+            print(f'popping messages from <{queue_name}> into {processes} processes (total {_num_to_read})')
+
+        self._log({'function':      'map_jsons',
+                   'queue_name':    queue_name,
+                   'n':             n,
+                   '_num_to_read':  _num_to_read,
+                   'processes':     processes,
+                   'max_in_flight': max_in_flight,
+                   'ordered':       ordered,
+                   })
+
+        if _num_to_read == 0:
+            return
+
+        # dedicated channel so the qos setting doesn't leak into the pool, and closing it requeues unacked messages
+        with self._pool.channel(dedicated=True) as rmq_channel, _trace_scope():
+            rmq_channel.basic_qos(prefetch_count=max_in_flight)
 
+            executor = concurrent.futures.ProcessPoolExecutor(processes)
+            in_flight = collections.OrderedDict()  # delivery tag -> future, in delivery order
+            n_received = 0
+            n_restarts = 0
+            try:
+                # short inactivity timeout so that finished work is harvested while waiting for messages
+                for method_frame, header_frame, body in rmq_channel.consume(queue=queue_name,
+                                                                            inactivity_timeout=0.01):
+                    # prefetched messages beyond _num_to_read are left unacked, and requeued when the channel closes
+                    if body is not None and n_received < _num_to_read:
+                        _on_received(queue_name, header_frame, body)
+                        try:
+                            future = executor.submit(_decode_and_handle,
+                                                     handler,
+                                                     body,
+                                                     header_frame.content_type,
+                                                     header_frame.content_encoding,
+                                                     self.codec.fast_json)
+
+                        # the pool broke since the last harvest, fail this message like the rest of its work
+                        # so that it is requeued and the pool restarted below
+                        except concurrent.futures.process.BrokenProcessPool as e:
+                            future = concurrent.futures.Future()
+                            future.set_exception(e)
+                        in_flight[method_frame.delivery_tag] = future
+                        n_received += 1
+
+                    # harvest finished work
+                    done_tags = []
+                    for delivery_tag, future in in_flight.items():
+                        if future.done():
+                            done_tags.append(delivery_tag)
+                        elif ordered:
+                            break
+
+                    for delivery_tag in done_tags:
+                        try:
+                            result = in_flight[delivery_tag].result()
+
+                        # a worker died, requeue everything in flight and start over with a new pool
+                        except concurrent.futures.process.BrokenProcessPool:
+                            n_restarts += 1
+                            if n_restarts > max_restarts:
+                                raise
+                            warnings.warn(f'worker process died, requeueing {len(in_flight)} messages '
+                                          f'(restart {n_restarts}/{max_restarts})')
+                            rmq_channel.basic_nack(delivery_tag=max(in_flight), multiple=True, requeue=True)
+                            n_received -= len(in_flight)
+                            in_flight.clear()
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            executor = concurrent.futures.ProcessPoolExecutor(processes)
+                            break
+
+                        del in_flight[delivery_tag]
+                        rmq_channel.basic_ack(delivery_tag)
+                        yield result
+
+                    # finished reading and processing messages
+                    if n_received >= _num_to_read and not in_flight:
+                        break
+
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    @metrics.instrumented('rmq')
     def write_jsons(self, queue_name, json_iterator):
 
         self._log({'function':   'write_jsons',
@@ -257,94 +1411,665 @@ class RMQ:
                    })
 
         n_inserted = 0
-        with RChannel(self.ip_address, self.port, self.virtual_host, self.username, self.password) as rmq_channel:
+        with self._pool.channel() as rmq_channel:
             for json_obj in json_iterator:
+                body, properties = self._encode(json_obj)
                 rmq_channel.basic_publish(exchange=self.exchange,
                                           routing_key=queue_name,
-                                          body=json.dumps(json_obj,
-                                                          ensure_ascii=False,
-                                                          sort_keys=True,
-                                                          allow_nan=False))
+                                          body=body,
+                                          properties=properties)
+                _count_messages('out', queue_name, body)
                 n_inserted += 1
 
         return n_inserted
 
-    def wait_until_queues_empty(self, queue_names: Union[str, Iterable[str]], verbose: Union[bool, int, float] = True):
-        _eta_max = 999 * 365.25 * 24 * 60 * 60  # 999 years
-        _time_start = time.time()
-        _completed = set()
-        _print_seconds = 40
-        _sleep_seconds = 5
-        _next_print_time = -1
+    @metrics.instrumented('rmq')
+    def write_jsons_confirmed(self, queue_name, json_iterator, window=1000, batch_size=10000, max_retries=3,
+                              max_queue_depth=None, max_unconfirmed_bytes=None, check_seconds=1.0, verbose=True):
+        """
+        at-least-once version of write_jsons that pipelines publisher confirms instead of waiting for each message
+        every `batch_size` messages the in-flight window is flushed and a report for that batch is appended
+
+        flow control (opt-in):
+        *   if `max_queue_depth` is set, the queue depth is checked every `check_seconds`,
+            and publishing pauses while it is at or above the limit
+        *   if `max_unconfirmed_bytes` is set, it caps the total size of messages the broker hasn't confirmed yet
+        *   publishing always pauses while the broker has blocked the connection (memory or disk alarm)
+
+        :return: list of per-batch reports (published/confirmed/nacked/resent/failed counts, duration,
+                 time spent throttled, and publish rate in messages per second)
+        """
+
+        self._log({'function':              'write_jsons_confirmed',
+                   'queue_name':            queue_name,
+                   'window':                window,
+                   'batch_size':            batch_size,
+                   'max_retries':           max_retries,
+                   'max_queue_depth':       max_queue_depth,
+                   'max_unconfirmed_bytes': max_unconfirmed_bytes,
+                   })
+
+        reports = []
+        with self._pool.channel(dedicated=True) as rmq_channel:
+            publisher = RPublisher(rmq_channel,
+                                   window=window,
+                                   max_retries=max_retries,
+                                   max_unconfirmed_bytes=max_unconfirmed_bytes)
+
+            def should_throttle():
+                if self._pool.is_blocked(rmq_channel.connection):
+                    return True
+                if max_queue_depth is None:
+                    return False
+                with metrics.timer(_metric_rpc_seconds, method='queue_declare'):
+                    rmq_queue = rmq_channel.queue_declare(queue=queue_name,
+                                                          durable=True,
+                                                          exclusive=False,
+                                                          auto_delete=False,
+                                                          passive=True)
+                return rmq_queue.method.message_count >= max_queue_depth
+
+            def flush_batch():
+                publisher.flush()
+                stats = publisher.stats()
+                report = {key: stats[key] - prev_stats[key] for key in stats}
+                report['batch'] = len(reports)
+                report['seconds'] = time.time() - batch_start_time
+                report['publish_rate'] = publisher.publish_rate
+                reports.append(report)
+
+                if verbose:
+                    print(f'batch {report["batch"]}: confirmed {report["confirmed"]:,} messages to <{queue_name}> '
+                          f'in {format_seconds(report["seconds"])} ({report["failed"]:,} failed, '
+                          f'throttled for {format_seconds(report["throttled_seconds"])})')
+                if report['failed']:
+                    warnings.warn(f'{report["failed"]} messages were nacked {max_retries + 1} times by the broker')
+
+            prev_stats = publisher.stats()
+            batch_start_time = time.time()
+            next_check_time = time.time() + check_seconds
+            n_in_batch = 0
+            for json_obj in json_iterator:
+                # process connection events (e.g. blocked notifications), then pause if needed
+                if time.time() >= next_check_time:
+                    rmq_channel.connection.process_data_events(time_limit=0)
+                    publisher.pause_while(should_throttle, poll_seconds=check_seconds)
+                    next_check_time = time.time() + check_seconds
+
+                body, properties = self._encode(json_obj)
+                publisher.publish(exchange=self.exchange,
+                                  routing_key=queue_name,
+                                  body=body,
+                                  properties=properties)
+                n_in_batch += 1
+
+                if n_in_batch >= batch_size:
+                    flush_batch()
+                    prev_stats = publisher.stats()
+                    batch_start_time = time.time()
+                    n_in_batch = 0
+
+            if n_in_batch:
+                flush_batch()
+
+        return reports
+
+    @metrics.instrumented('rmq')
+    def write_jsons_sharded(self, queue_names, json_iterator, key, n_shards=None, batch_size=100, window=1000,
+                            max_retries=3, verbose=True):
+        """
+        publish each json object to one of several queues, chosen by consistent hashing of `key(json_obj)`
+        *   `queue_names` is a list of queues, or a prefix if `n_shards` is given (see shard_queue_names)
+        *   objects with the same key always go to the same queue, in iteration order
+            (unless the broker nacks one, in which case the resent copy lands behind later messages)
+        *   messages are buffered per shard and published `batch_size` at a time,
+            over one channel with pipelined publisher confirms (at-least-once, like write_jsons_confirmed)
+
+        :return: dict of published/confirmed/nacked/resent/failed counts, plus a count per shard
+        """
+        queue_names = shard_queue_names(queue_names, n_shards)
+        ring = ConsistentHashRing(queue_names)
+
+        self._log({'function':    'write_jsons_sharded',
+                   'queue_names': queue_names,
+                   'batch_size':  batch_size,
+                   'window':      window,
+                   'max_retries': max_retries,
+                   })
+
+        shard_counts = dict.fromkeys(queue_names, 0)
+        with self._pool.channel(dedicated=True) as rmq_channel:
+            publisher = RPublisher(rmq_channel, window=window, max_retries=max_retries)
+            buffers = {queue_name: [] for queue_name in queue_names}
+
+            def publish_batch(queue_name):
+                for body, properties in buffers[queue_name]:
+                    publisher.publish(exchange=self.exchange,
+                                      routing_key=queue_name,
+                                      body=body,
+                                      properties=properties)
+                shard_counts[queue_name] += len(buffers[queue_name])
+                buffers[queue_name] = []
+
+            for json_obj in json_iterator:
+                queue_name = ring.get(key(json_obj))
+                buffers[queue_name].append(self._encode(json_obj))
+                if len(buffers[queue_name]) >= batch_size:
+                    publish_batch(queue_name)
+
+            for queue_name in queue_names:
+                publish_batch(queue_name)
+            publisher.flush()
 
+        stats = publisher.stats()
+        stats['shards'] = shard_counts
+        if stats['failed']:
+            warnings.warn(f'{stats["failed"]} messages were nacked {max_retries + 1} times by the broker')
         if verbose:
-            if type(verbose) in (int, float):
-                _print_seconds = max(_sleep_seconds, verbose)
+            print(f'confirmed {stats["confirmed"]:,} messages to {len(queue_names)} shards '
+                  f'(min {min(shard_counts.values()):,}, max {max(shard_counts.values()):,} per shard)')
 
-        if isinstance(queue_names, str):
-            queue_names = [queue_names]
+        return stats
 
-        self._log({'function':    'wait_until_queues_ready',
-                   'queue_names': queue_names,
+    def read_jsons_sharded(self, queue_names, n_shards=None, n=None, prefetch_count=100, timeout_seconds=60,
+                           verbose=True):
+        """
+        consume from every shard at once (one consumer per queue on a shared channel), yielding json objects
+        *   messages from the same shard are yielded in order, shards are interleaved as their messages arrive
+        *   each message is acked when the next one is requested, i.e. after the caller has handled it
+        *   `prefetch_count` applies per shard, stops early if no message arrives for `timeout_seconds`
+        """
+        queue_names = shard_queue_names(queue_names, n_shards)
+
+        # how many to read from mq
+        _num_to_read = self.get_count(queue_names)
+        if n is not None:
+            if n > _num_to_read:
+                warnings.warn('n > queue length, this method blocks until n messages have been read')
+            _num_to_read = n
+
+        assert type(_num_to_read) is int
+        assert _num_to_read >= 0
+
+        if verbose:
+            print(f'popping messages from {len(queue_names)} shards <{",".join(queue_names)}> '
+                  f'(total {_num_to_read})')
+
+        self._log({'function':       'read_jsons_sharded',
+                   'queue_names':    queue_names,
+                   'n':              n,
+                   '_num_to_read':   _num_to_read,
+                   'prefetch_count': prefetch_count,
                    })
 
-        # estimator = RemainingTimeEstimator()
-        estimators = dict()
-        for queue_name in queue_names:
-            estimators[queue_name] = RemainingTimeEstimator(name=queue_name)
+        if _num_to_read == 0:
+            return
 
-        while True:
-            total_count = 0
+        # dedicated channel so the qos setting doesn't leak into the pool, and closing it requeues unacked messages
+        with self._pool.channel(dedicated=True) as rmq_channel, _trace_scope():
+            rmq_channel.basic_qos(prefetch_count=prefetch_count)
 
-            # update all estimators individually
+            deliveries = collections.deque()
+            consumer_tags = []
             for queue_name in queue_names:
-                queue_count = self.get_count(queue_name)
-                assert queue_count >= 0
-                total_count += queue_count
-
-                # ignore empty queues
-                if queue_count == 0:
-                    if queue_name not in _completed:
-                        print(f'<{queue_name}> is empty (elapsed {format_seconds(time.time() - _time_start)})')
-                        _completed.add(queue_name)
-                        del estimators[queue_name]
-                    continue
-
-                # queues that somehow got refilled
-                if queue_name in _completed:
-                    warnings.warn(f'<{queue_name}> unexpectedly refilled!')
-                    _completed.remove(queue_name)
-                    estimators[queue_name] = RemainingTimeEstimator(name=queue_name)
-
-                # update estimator
-                estimators[queue_name].update(queue_count)
-
-            # completed?
-            if total_count == 0:
-                break
+                def on_message(channel, method_frame, header_frame, body, queue_name=queue_name):
+                    deliveries.append((queue_name, method_frame.delivery_tag, header_frame, body))
+
+                consumer_tags.append(rmq_channel.basic_consume(queue=queue_name, on_message_callback=on_message))
+
+            try:
+                last_message_time = time.time()
+                while _num_to_read > 0:
+                    if not deliveries:
+                        # returns as soon as a delivery has been dispatched
+                        rmq_channel.connection.process_data_events(time_limit=1)
+                        if not deliveries:
+                            if time.time() - last_message_time >= timeout_seconds:
+                                warnings.warn(f'no messages received for {timeout_seconds} seconds, '
+                                              f'ending read early')
+                                break
+                            continue
+                        last_message_time = time.time()
+
+                    queue_name, delivery_tag, header_frame, body = deliveries.popleft()
+                    _on_received(queue_name, header_frame, body)
+                    yield self._decode(header_frame, body)
+
+                    # caller has finished handling the message
+                    rmq_channel.basic_ack(delivery_tag)
+                    _num_to_read -= 1
+
+            finally:
+                if rmq_channel.is_open:
+                    for consumer_tag in consumer_tags:
+                        rmq_channel.basic_cancel(consumer_tag)
+
+    @metrics.instrumented('rmq')
+    def dump_queue(self, queue_name, path, n=None, remove=False, resume=False, block_size=1000, timeout_seconds=60,
+                   max_unacked=100000, verbose=True):
+        """
+        stream raw message bodies and properties into a compressed dump file (format described in rmq_dump)
+        *   if `remove` is set, messages are acked once the block containing them is fsynced,
+            so resuming an interrupted dump just appends the rest of the queue
+        *   otherwise the queue is left intact, and resuming skips as many messages as are already in the file
+            (which assumes the head of the queue hasn't changed in the meantime)
+        *   but that holds every message it reads unacked until the end, in the broker's memory, and the broker closes
+            the channel once a delivery has been unacked for its `consumer_timeout` (30 minutes by default),
+            so it refuses to hold more than `max_unacked` messages (including the ones skipped when resuming)
+            *   if the channel is closed anyway, everything is requeued and the dump file can be resumed
+            *   for bigger queues, use `remove` (and restore_queue the dump), or dump the first `n` messages
+        *   at most `2 * block_size` messages are prefetched at a time, so memory use doesn't grow with the queue
+        *   stops early if no message arrives for `timeout_seconds`
+
+        :param resume: continue an interrupted dump at `path`, if not set an existing `path` is an error
+        :param n: max number of records in the dump file (including any from a resumed dump)
+        :param max_unacked: max number of messages a dump without `remove` may hold unacked
+        :return: number of records in the dump file
+        """
+        path = os.path.abspath(path)
+        if not resume and os.path.exists(path):
+            raise FileExistsError(f'<{path}> already exists, use resume=True to continue that dump')
+
+        self._log({'function':   'dump_queue',
+                   'queue_name': queue_name,
+                   'path':       path,
+                   'n':          n,
+                   'remove':     remove,
+                   'resume':     resume,
+                   })
+
+        # a non-destructive dump holds the first n messages (skipped or not) of the queue unacked, resumed or not
+        if not remove:
+            _num_to_hold = self.get_count(queue_name) if n is None else min(self.get_count(queue_name), n)
+            if _num_to_hold > max_unacked:
+                raise ValueError(f'a non-destructive dump of {_num_to_hold} messages would hold them all unacked, '
+                                 f'use remove=True, set n, or raise max_unacked (currently {max_unacked})')
+
+        with rmq_dump.DumpWriter(path, resume=resume) as writer:
+            n_skip = 0 if remove else writer.n_records
+            _num_to_read = self.get_count(queue_name)
+            if n is not None:
+                _num_to_read = min(_num_to_read, n - writer.n_records + n_skip)
 
-            # print estimated time remaining
             if verbose:
-                if time.time() >= _next_print_time:
+                print(f'dumping {max(0, _num_to_read - n_skip)} messages from <{queue_name}> to <{path}> '
+                      f'({writer.n_records} already dumped)')
+
+            if _num_to_read <= n_skip:
+                return writer.n_records
+
+            # dedicated channel so the qos setting doesn't leak into the pool, and closing it requeues unacked messages
+            with self._pool.channel(dedicated=True) as rmq_channel, _trace_scope():
+                prefetch_count = 2 * block_size
+                rmq_channel.basic_qos(prefetch_count=prefetch_count)
+
+                records = []
+                last_delivery_tag = None
+                n_seen = 0
+                quiet = False
+                while n_seen < _num_to_read and not quiet:
+                    n_consumed = 0
+                    for method_frame, header_frame, body in rmq_channel.consume(queue=queue_name,
+                                                                                inactivity_timeout=timeout_seconds):
+                        # queue went quiet
+                        if body is None:
+                            warnings.warn(f'no messages received for {timeout_seconds} seconds, ending dump early')
+                            quiet = True
+                            break
+                        _on_received(queue_name, header_frame, body)
+
+                        n_seen += 1
+                        n_consumed += 1
+                        last_delivery_tag = method_frame.delivery_tag
+                        if n_seen > n_skip:
+                            records.append((header_frame, body))
+
+                        if len(records) >= block_size or n_seen >= _num_to_read:
+                            if records:
+                                writer.write_block(records)
+                                if remove:
+                                    rmq_channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+                                records = []
+
+                        if n_seen >= _num_to_read:
+                            break
+
+                        # messages held unacked by a non-destructive dump use up this consumer's prefetch for good,
+                        # so a new consumer (which gets a prefetch of its own) takes over, and they stay unacked
+                        if not remove and n_consumed >= prefetch_count:
+                            break
+
+                    rmq_channel.cancel()
+
+                if records:
+                    writer.write_block(records)
+                    if remove:
+                        rmq_channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+
+                # put everything back where it was
+                if not remove and last_delivery_tag is not None:
+                    rmq_channel.basic_nack(delivery_tag=last_delivery_tag, multiple=True, requeue=True)
 
-                    # eta is the worst case estimate
-                    furthest_estimate = float('nan')
-                    for estimator in estimators.values():
-                        furthest_estimate = max(estimator.get_estimate(), furthest_estimate)  # put the nan last
+            if verbose:
+                print(f'dumped {writer.n_records} messages from <{queue_name}> to <{path}>')
+
+            return writer.n_records
+
+    @metrics.instrumented('rmq')
+    def restore_queue(self, path, queue_name, window=1000, max_retries=3, verbose=True):
+        """
+        publish every record in a dump file (see dump_queue) to a queue, with its original properties
+        uses pipelined publisher confirms, so the restore is at-least-once
+
+        :return: dict of published/confirmed/nacked/resent/failed counts
+        """
+        path = os.path.abspath(path)
 
-                    # stuff to print
-                    unfinished_queues = sorted(queue_name for queue_name in queue_names if queue_name not in _completed)
-                    eta = '<?>' if math.isnan(furthest_estimate) else format_seconds(min(_eta_max, furthest_estimate))
+        self._log({'function':   'restore_queue',
+                   'queue_name': queue_name,
+                   'path':       path,
+                   })
 
-                    # print info
-                    print(f'waiting for <{",".join(unfinished_queues)}> to be empty... '
-                          f'(elapsed {format_seconds(time.time() - _time_start)}, len={total_count}, remaining {eta})')
+        if verbose:
+            print(f'restoring messages from <{path}> to <{queue_name}>')
+
+        with self._pool.channel(dedicated=True) as rmq_channel:
+            publisher = RPublisher(rmq_channel, window=window, max_retries=max_retries)
+            for properties, body in rmq_dump.read_records(path):
+                publisher.publish(exchange=self.exchange,
+                                  routing_key=queue_name,
+                                  body=body,
+                                  properties=properties)
+            publisher.flush()
+
+        stats = publisher.stats()
+        if stats['failed']:
+            warnings.warn(f'{stats["failed"]} messages were nacked {max_retries + 1} times by the broker')
+        if verbose:
+            print(f'restored {stats["confirmed"]} messages to <{queue_name}>')
+
+        return stats
+
+    @metrics.instrumented('rmq')
+    def move(self, src_queue_name, dst_queue_name, n=None, filter=None, window=1000, max_retries=3,
+             timeout_seconds=10, verbose=True):
+        """
+        forward raw messages (bodies and properties) from one queue to another over a single connection
+        *   up to `window` messages are prefetched from the source and in flight to the destination
+        *   a source message is acked only after the destination has confirmed its copy
+        *   if `filter` is given, messages are decoded and only moved if `filter(json_obj)` is truthy,
+            the rest are left in the source queue (in their original order)
+            *   to keep their place, skipped messages stay unacked until the move ends,
+                so a long filtered move is subject to the broker's `consumer_timeout` (30 minutes by default)
+        *   stops early if no message arrives for `timeout_seconds`
+
+        :return: number of messages moved
+        """
+        assert src_queue_name != dst_queue_name
 
-                    _next_print_time = time.time() + _print_seconds
+        # how many to read from mq
+        _num_to_read = self.get_count(src_queue_name)
+        if n is not None:
+            _num_to_read = min(n, _num_to_read)
+
+        if verbose:
+            print(f'moving {"filtered " if filter is not None else ""}messages from <{src_queue_name}> '
+                  f'to <{dst_queue_name}> (total {_num_to_read})')
+
+        self._log({'function':       'move',
+                   'src_queue_name': src_queue_name,
+                   'dst_queue_name': dst_queue_name,
+                   'n':              n,
+                   '_num_to_read':   _num_to_read,
+                   'filter':         filter is not None,
+                   })
+
+        if _num_to_read == 0:
+            return 0
+
+        # one connection, with separate channels for consuming and for publishing in confirm mode
+        with self._pool.channel(dedicated=True) as consume_channel, _trace_scope():
+            publish_channel = consume_channel.connection.channel()
+            try:
+                publisher = RPublisher(publish_channel, window=window, max_retries=max_retries)
+
+                def ack_confirmed():
+                    # acks are fire-and-forget frames, so queue them all up and flush the socket once
+                    confirmed_tags = publisher.pop_confirmed()
+                    for delivery_tag in confirmed_tags[:-1]:
+                        consume_channel._impl.basic_ack(delivery_tag)
+                    if confirmed_tags:
+                        consume_channel.basic_ack(confirmed_tags[-1])
+
+                # prefetch_count is a 16 bit field
+                prefetch_count = min(window, 65535)
+                consume_channel.basic_qos(prefetch_count=prefetch_count)
+
+                n_seen = 0
+                n_skipped = 0
+                quiet = False
+                while n_seen < _num_to_read and not quiet:
+                    n_consumer_skipped = 0
+                    for method_frame, header_frame, body in consume_channel.consume(queue=src_queue_name,
+                                                                                    inactivity_timeout=timeout_seconds):
+                        # queue went quiet
+                        if body is None:
+                            warnings.warn(f'no messages received for {timeout_seconds} seconds, ending move early')
+                            quiet = True
+                            break
+                        _on_received(src_queue_name, header_frame, body)
+
+                        n_seen += 1
+                        if filter is None or filter(self._decode(header_frame, body)):
+                            # traced messages keep their trace, but dwell in the destination starts now
+                            if current_trace() is not None:
+                                header_frame.headers['x-publish-ts'] = int(time.time() * 1e6)
+                            publisher.publish(exchange=self.exchange,
+                                              routing_key=dst_queue_name,
+                                              body=body,
+                                              properties=header_frame,
+                                              tag=method_frame.delivery_tag)
+                        else:
+                            n_skipped += 1
+                            n_consumer_skipped += 1
+
+                        ack_confirmed()
+
+                        if n_seen >= _num_to_read:
+                            break
+
+                        # skipped messages use up this consumer's prefetch for good, so once they fill half of it
+                        # a new consumer (which gets a prefetch of its own) takes over, and they stay unacked
+                        if n_consumer_skipped >= max(1, prefetch_count // 2):
+                            break
+
+                    consume_channel.cancel()
+
+                publisher.flush()
+                ack_confirmed()
+
+            finally:
+                # unconfirmed and skipped messages are requeued on the source when the consuming channel closes
+                if publish_channel.is_open:
+                    publish_channel.close()
+
+        stats = publisher.stats()
+        if stats['failed']:
+            warnings.warn(f'{stats["failed"]} messages were nacked {max_retries + 1} times by the broker '
+                          f'and left in <{src_queue_name}>')
+        if verbose:
+            print(f'moved {stats["confirmed"]} messages from <{src_queue_name}> to <{dst_queue_name}> '
+                  f'({n_skipped} skipped by filter)')
+
+        return stats['confirmed']
+
+    @metrics.instrumented('rmq')
+    def declare_stream(self, queue_name, max_length_bytes=None, max_age=None, max_segment_size_bytes=None):
+        """
+        declare a stream queue: an append-only log that consumers read from an offset without removing anything
+        *   `max_length_bytes` and `max_age` (e.g. '7D', '12h') set retention, old segments are dropped first
+        *   `max_segment_size_bytes` sets the size of the segment files retention works on
+        """
+        arguments = {'x-queue-type': 'stream'}
+        if max_length_bytes is not None:
+            arguments['x-max-length-bytes'] = max_length_bytes
+        if max_age is not None:
+            arguments['x-max-age'] = max_age
+        if max_segment_size_bytes is not None:
+            arguments['x-stream-max-segment-size-bytes'] = max_segment_size_bytes
+
+        self._log({'function':   'declare_stream',
+                   'queue_name': queue_name,
+                   'arguments':  arguments,
+                   })
+
+        with self._pool.channel() as rmq_channel:
+            with metrics.timer(_metric_rpc_seconds, method='queue_declare'):
+                rmq_channel.queue_declare(queue=queue_name,
+                                          durable=True,
+                                          exclusive=False,
+                                          auto_delete=False,
+                                          arguments=arguments)
+
+    def write_stream(self, queue_name, json_iterator, window=5000, batch_size=100000, max_retries=3, verbose=True):
+        """
+        append to a stream queue, i.e. write_jsons_confirmed with a larger in-flight window,
+        since the broker confirms stream writes in chunks rather than message by message
+        """
+        return self.write_jsons_confirmed(queue_name,
+                                          json_iterator,
+                                          window=window,
+                                          batch_size=batch_size,
+                                          max_retries=max_retries,
+                                          verbose=verbose)
+
+    def read_stream(self, queue_name, offset=None, consumer_name=None, offsets_path='rmq_offsets.json', n=None,
+                    prefetch_count=1000, timeout_seconds=10, commit_every=1000, with_offsets=False, verbose=True):
+        """
+        read a stream queue from an offset, yielding json objects (or `(offset, json_obj)` if `with_offsets`)
+        *   `offset` is 'first', 'last' (start of the last chunk), 'next' (only new messages),
+            an offset number, or a datetime (messages written since then, to chunk granularity)
+        *   if `consumer_name` is given, the offset of each message is committed to a local json file once the caller
+            has handled it (every `commit_every` messages, and when reading stops), and a later read with the same
+            `consumer_name` and no `offset` resumes right after it
+        *   reading never changes the stream, so any number of readers can scan it in parallel
+        *   a stream never runs dry, so reading stops after `n` messages or once none arrive for `timeout_seconds`
+        """
+        offset_store = None
+        if consumer_name is not None:
+            offset_store = rmq_offsets.OffsetStore(offsets_path)
+            if offset is None:
+                committed_offset = offset_store.get(self.virtual_host, queue_name, consumer_name)
+                if committed_offset is not None:
+                    offset = committed_offset + 1
+        if offset is None:
+            offset = 'first'
+
+        if verbose:
+            print(f'reading stream <{queue_name}> from offset {offset}'
+                  f'{"" if consumer_name is None else f" as <{consumer_name}>"}')
+
+        self._log({'function':      'read_stream',
+                   'queue_name':    queue_name,
+                   'offset':        offset,
+                   'consumer_name': consumer_name,
+                   'n':             n,
+                   })
+
+        # dedicated channel so the qos setting doesn't leak into the pool (streams require a prefetch limit)
+        with self._pool.channel(dedicated=True) as rmq_channel:
+            rmq_channel.basic_qos(prefetch_count=prefetch_count)
+
+            n_read = 0
+            last_offset = None
+            committed_offset = None
+            try:
+                for method_frame, header_frame, body in rmq_channel.consume(queue=queue_name,
+                                                                            arguments={'x-stream-offset': offset},
+                                                                            inactivity_timeout=timeout_seconds):
+                    if body is None:
+                        break
+                    _count_messages('in', queue_name, body)
+
+                    message_offset = header_frame.headers['x-stream-offset']
+                    json_obj = self._decode(header_frame, body)
+                    yield (message_offset, json_obj) if with_offsets else json_obj
+
+                    # caller has finished handling the message
+                    last_offset = message_offset
+                    n_read += 1
+
+                    # acks don't remove anything from a stream, they only grant the consumer more credit
+                    if n_read % max(1, prefetch_count // 2) == 0:
+                        rmq_channel.basic_ack(delivery_tag=method_frame.delivery_tag, multiple=True)
+
+                    if offset_store is not None and n_read % commit_every == 0:
+                        offset_store.commit(self.virtual_host, queue_name, consumer_name, last_offset)
+                        committed_offset = last_offset
+
+                    if n is not None and n_read >= n:
+                        break
+
+            finally:
+                if offset_store is not None and last_offset is not None and last_offset != committed_offset:
+                    offset_store.commit(self.virtual_host, queue_name, consumer_name, last_offset)
+                if rmq_channel.is_open:
+                    rmq_channel.cancel()
+
+    @metrics.instrumented('rmq')
+    def wait_until_queues_empty(self,
+                                queue_names: Union[str, Iterable[str]],
+                                verbose: Union[bool, int, float] = True,
+                                on_empty: Optional[Callable[[str, float], None]] = None,
+                                min_sleep_seconds: float = 0.5,
+                                max_sleep_seconds: float = 60):
+        """
+        block until all queues are empty
+        the polling interval adapts to the estimated time remaining, between `min_sleep_seconds` and `max_sleep_seconds`
+        if `on_empty` is given, it is called with (queue_name, elapsed_seconds) as soon as each queue is seen empty
+        with an `admin`, the management api's (lagging) counts are only used for the estimates,
+        and a queue is only reported empty (or refilled) after a fresh count over amqp agrees
+        """
+        if isinstance(queue_names, str):
+            queue_names = [queue_names]
+
+        self._log({'function':    'wait_until_queues_ready',
+                   'queue_names': queue_names,
+                   })
+
+        # the broker refreshes its stats every 5 seconds (by default), and the admin caches them on top of that
+        tracker = EmptyQueuesTracker(queue_names,
+                                     verbose=verbose,
+                                     min_sleep_seconds=min_sleep_seconds,
+                                     max_sleep_seconds=max_sleep_seconds,
+                                     stats_lag_seconds=5 + self.admin.snapshot_ttl if self.admin is not None else 0)
+
+        while True:
+            # polled repeatedly, so slightly stale counts from the management api are fine for estimating
+            # (queues declared since the broker last refreshed its stats aren't in them yet)
+            estimate_counts = dict()
+            if self.admin is not None:
+                snapshot_index = self.admin.snapshot().index
+                estimate_counts = self.get_counts([queue_name for queue_name in tracker.queue_names
+                                                   if queue_name in snapshot_index], fresh=False)
+
+            # but not for deciding a queue is empty: count the ones that look (or may by now be) empty or refilled
+            queue_counts = dict(estimate_counts)
+            recount_queue_names = tracker.queue_names_to_recount(estimate_counts)
+            if recount_queue_names:
+                queue_counts.update(self.get_counts(recount_queue_names))
+
+            for queue_name, elapsed_seconds in tracker.update(queue_counts):
+                if on_empty is not None:
+                    on_empty(queue_name, elapsed_seconds)
+
+            if tracker.is_done:
+                break
 
             # wait a while and then continue
-            time.sleep(_sleep_seconds)
+            time.sleep(tracker.sleep_seconds())
 
+    @metrics.instrumented('rmq')
     def wait_until_queues_stabilized(self, queue_names, sleep_seconds=30, verbose=True):
         _time_start = time.time()
 
@@ -0,0 +1,206 @@
+"""
+queue dump file format, written by RMQ.dump_queue and read by RMQ.restore_queue
+
+    file   := MAGIC block*
+    block  := uint32 compressed_length, zlib(record*)
+    record := uint32 properties_length, properties, uint32 body_length, body
+    properties := uint32 amqp_length, amqp_properties, floats_json
+
+bodies are stored as raw bytes (never decoded), properties in their AMQP wire encoding,
+so header values keep their types (timestamps, byte arrays, decimals, e.g. in `x-death`)
+pika can't encode float header values (and decodes AMQP doubles as ints), so in `amqp_properties` floats are
+replaced by voids and listed in `floats_json` ([[path of keys and indexes into the headers, value], ...]) instead,
+and restored messages are published with their floats as AMQP doubles
+each block is compressed independently, so a dump that was interrupted mid-block can be truncated
+back to its last complete block and resumed
+"""
+import json
+import os
+import struct
+import zlib
+
+import pika
+
+MAGIC = b'RMQDUMP2'
+
+_uint32 = struct.Struct('>I')
+
+
+def _find_floats(value, path=()):
+    if type(value) is float:
+        yield list(path), value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from _find_floats(item, path + (key,))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from _find_floats(item, path + (index,))
+
+
+def _encode_value(pieces, value, float_type):
+    # like pika.data.encode_value, plus floats as AMQP doubles (float_type='d') or voids ('V')
+    if type(value) is float:
+        pieces.append(struct.pack('>cd', b'd', value) if float_type == 'd' else b'V')
+    elif isinstance(value, dict):
+        pieces.append(b'F')
+        _encode_table(pieces, value, float_type)
+    elif isinstance(value, list):
+        array_pieces = []
+        for item in value:
+            _encode_value(array_pieces, item, float_type)
+        array_data = b''.join(array_pieces)
+        pieces.append(struct.pack('>cI', b'A', len(array_data)))
+        pieces.append(array_data)
+    else:
+        pika.data.encode_value(pieces, value)
+
+
+def _encode_table(pieces, table, float_type):
+    table_pieces = []
+    for key, value in table.items():
+        pika.data.encode_short_string(table_pieces, key)
+        _encode_value(table_pieces, value, float_type)
+    table_data = b''.join(table_pieces)
+    pieces.append(_uint32.pack(len(table_data)))
+    pieces.append(table_data)
+
+
+def _encode_amqp(properties, float_type):
+    if properties.headers is None or not any(_find_floats(properties.headers)):
+        return b''.join(pika.BasicProperties.encode(properties))
+
+    # encode everything else with pika, then swap the (empty) header table for one with the floats in it
+    data = b''.join(pika.BasicProperties(**{**vars(properties), 'headers': {}}).encode())
+    offset = 2 + sum(1 + len(value.encode('utf8') if isinstance(value, str) else value)
+                     for value in (properties.content_type, properties.content_encoding) if value is not None)
+    assert data[offset:offset + _uint32.size] == _uint32.pack(0)
+    table_pieces = []
+    _encode_table(table_pieces, properties.headers, float_type)
+    return data[:offset] + b''.join(table_pieces) + data[offset + _uint32.size:]
+
+
+class DumpedProperties(pika.BasicProperties):
+    """
+    message properties read from a dump, which can be republished even if their headers contain floats
+    """
+
+    def encode(self):
+        return [_encode_amqp(self, float_type='d')]
+
+
+def encode_properties(properties):
+    if properties is None:
+        properties = pika.BasicProperties()
+    amqp_data = _encode_amqp(properties, float_type='V')
+    floats = list(_find_floats(properties.headers)) if properties.headers is not None else []
+    return _uint32.pack(len(amqp_data)) + amqp_data + (json.dumps(floats).encode('utf8') if floats else b'')
+
+
+def decode_properties(data):
+    amqp_length, = _uint32.unpack_from(data)
+    properties = DumpedProperties()
+    properties.decode(data[_uint32.size:_uint32.size + amqp_length])
+
+    floats_json = data[_uint32.size + amqp_length:]
+    if floats_json:
+        for path, value in json.loads(floats_json):
+            container = properties.headers
+            for key in path[:-1]:
+                container = container[key]
+            container[path[-1]] = value
+    return properties
+
+
+def _iter_blocks(f):
+    """
+    yields (end_offset, records) for each complete block, stops quietly at a truncated block
+    """
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError(f'not a queue dump file (magic={magic!r})')
+
+    while True:
+        header = f.read(_uint32.size)
+        if len(header) < _uint32.size:
+            return
+
+        compressed = f.read(_uint32.unpack(header)[0])
+        try:
+            data = zlib.decompress(compressed)
+        except zlib.error:
+            return  # truncated (or corrupted) trailing block
+
+        records = []
+        offset = 0
+        while offset < len(data):
+            properties_length, = _uint32.unpack_from(data, offset)
+            offset += _uint32.size
+            properties = decode_properties(data[offset:offset + properties_length])
+            offset += properties_length
+
+            body_length, = _uint32.unpack_from(data, offset)
+            offset += _uint32.size
+            records.append((properties, data[offset:offset + body_length]))
+            offset += body_length
+
+        yield f.tell(), records
+
+
+def read_records(path):
+    """
+    yields (properties, body) for every record in a dump file
+    """
+    with open(path, mode='rb') as f:
+        for _, records in _iter_blocks(f):
+            yield from records
+
+
+class DumpWriter:
+    def __init__(self, path, resume=False, compression_level=6):
+        self.path = os.path.abspath(path)
+        self.compression_level = compression_level
+        self.n_records = 0
+
+        # keep every complete block, drop a partially written trailing block
+        if resume and os.path.exists(self.path):
+            end_offset = len(MAGIC)
+            with open(self.path, mode='rb') as f:
+                for end_offset, records in _iter_blocks(f):
+                    self.n_records += len(records)
+            self.f = open(self.path, mode='r+b')
+            self.f.truncate(end_offset)
+            self.f.seek(end_offset)
+
+        else:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            self.f = open(self.path, mode='wb')
+            self.f.write(MAGIC)
+
+    def write_block(self, records):
+        """
+        write and fsync a block of (properties, body) records, after which they are safe to ack
+        """
+        chunks = []
+        for properties, body in records:
+            properties_data = encode_properties(properties)
+            chunks.append(_uint32.pack(len(properties_data)))
+            chunks.append(properties_data)
+            chunks.append(_uint32.pack(len(body)))
+            chunks.append(body)
+
+        compressed = zlib.compress(b''.join(chunks), self.compression_level)
+        self.f.write(_uint32.pack(len(compressed)))
+        self.f.write(compressed)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.n_records += len(records)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,19 +1,66 @@
+import concurrent.futures
 import json
+import threading
+import time
+import urllib.parse
 import warnings
 
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+
+# snapshot column -> path in the /api/queues json
+SNAPSHOT_COLUMNS = {
+    'messages_ready':          ('messages_ready',),
+    'messages_unacknowledged': ('messages_unacknowledged',),
+    'consumers':               ('consumers',),
+    'publish_rate':            ('message_stats', 'publish_details', 'rate'),
+    'deliver_rate':            ('message_stats', 'deliver_get_details', 'rate'),
+    'memory':                  ('memory',),
+}
+
+
+def _get_path(json_obj, path, default=0):
+    # stats like message_stats are missing entirely for queues that haven't seen any traffic yet
+    for key in path:
+        if not isinstance(json_obj, dict) or key not in json_obj:
+            return default
+        json_obj = json_obj[key]
+    return json_obj
 
 
 class RMQAdmin:
-    def __init__(self, ip_address, port, virtual_host, username, password, name=None):
-        self.ip_address = ip_address,
-        self.port = port,
-        self.virtual_host = virtual_host,
+    def __init__(self, ip_address, port, virtual_host, username, password, name=None, max_connections=16,
+                 max_retries=3, backoff_seconds=0.5, snapshot_ttl=5):
+        self.ip_address = ip_address
+        self.port = port
+        self.virtual_host = virtual_host
         self.username = username
         self.password = password
         self.exchange = 'amq.default'
         self.name = name
+        self.max_connections = max_connections
+        self.snapshot_ttl = snapshot_ttl
+
+        self._snapshot = None
+        self._snapshot_time = float('-inf')
+        self._snapshot_lock = threading.Lock()
+
+        # one keep-alive session, retrying (with exponential backoff) on connection errors and overloaded brokers
+        # publishing is retried too, so a retried publish may be delivered twice (i.e. at-least-once)
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_seconds,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=None,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, max_retries=retry)
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(self.username, self.password)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def __str__(self):
         if self.name is None:
@@ -21,25 +68,67 @@ class RMQAdmin:
         else:
             return f'RMQadmin<[{self.name}]={self.username}@{self.ip_address}:{self.port}/{self.virtual_host}>'
 
-    def _api_get(self, api_path):
+    def close(self):
+        self.session.close()
+
+    @property
+    def _vhost(self):
+        # the default vhost is '/', which has to be url-encoded as a path segment
+        return urllib.parse.quote(self.virtual_host, safe='')
+
+    def _api_get(self, api_path, params=None):
         assert api_path.startswith('/api/')
 
-        r = requests.get(f'http://{self.ip_address}:{self.port}/{api_path[1:]}',
-                         auth=HTTPBasicAuth(self.username, self.password))
+        r = self.session.get(f'http://{self.ip_address}:{self.port}/{api_path[1:]}', params=params)
 
         return r.json()
 
     def _api_post(self, api_path, post_json_payload):
         assert api_path.startswith('/api/')
 
-        r = requests.get(f'http://{self.ip_address}:{self.port}/{api_path[1:]}',
-                         auth=HTTPBasicAuth(self.username, self.password),
-                         json=post_json_payload)
+        r = self.session.post(f'http://{self.ip_address}:{self.port}/{api_path[1:]}', json=post_json_payload)
 
         return r.json()
 
     def get_queue_info(self, queue_name):
-        return self._api_get(f'/api/queues/{self.virtual_host}/{queue_name}')
+        return self._api_get(f'/api/queues/{self._vhost}/{urllib.parse.quote(queue_name, safe="")}')
+
+    def snapshot(self, max_age_seconds=None, page_size=500):
+        """
+        one table of every queue in the vhost, fetched from /api/queues with only the needed columns
+        callers within `max_age_seconds` (default `snapshot_ttl`) of the last fetch share the same snapshot
+        note that the broker itself only refreshes these stats every few seconds
+
+        :return: DataFrame indexed by queue name, with a column per SNAPSHOT_COLUMNS entry
+        """
+        if max_age_seconds is None:
+            max_age_seconds = self.snapshot_ttl
+
+        with self._snapshot_lock:
+            if time.time() - self._snapshot_time <= max_age_seconds:
+                return self._snapshot
+
+            columns = ['name'] + ['.'.join(path) for path in SNAPSHOT_COLUMNS.values()]
+            rows = []
+            page = 1
+            while True:
+                result = self._api_get(f'/api/queues/{self._vhost}', params={'columns':   ','.join(columns),
+                                                                            'page':      page,
+                                                                            'page_size': page_size,
+                                                                            })
+                for item in result['items']:
+                    row = {'name': item['name']}
+                    for column, path in SNAPSHOT_COLUMNS.items():
+                        row[column] = _get_path(item, path)
+                    rows.append(row)
+
+                if page >= result.get('page_count', 1):
+                    break
+                page += 1
+
+            self._snapshot = pd.DataFrame(rows, columns=['name', *SNAPSHOT_COLUMNS]).set_index('name')
+            self._snapshot_time = time.time()
+            return self._snapshot
 
     def write_json(self, queue_name, json_obj):
         payload = {'properties':       {},
@@ -47,14 +136,39 @@ class RMQAdmin:
                    'payload':          json.dumps(json_obj, ensure_ascii=False),
                    'payload_encoding': 'string',
                    }
-        return self._api_post(f'/api/exchanges/{self.virtual_host}/{self.exchange}/publish', payload)
+        return self._api_post(f'/api/exchanges/{self._vhost}/{self.exchange}/publish', payload)
+
+    def write_jsons(self, queue_name, json_iterator, max_in_flight=None):
+        """
+        publish concurrently over the session's connection pool, with at most `max_in_flight` requests at once
+
+        :return: number of messages the broker reported as routed
+        """
+        if max_in_flight is None:
+            max_in_flight = self.max_connections
+
+        n_written = 0
+        n_routed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_in_flight) as executor:
+            in_flight = set()
+            for json_obj in json_iterator:
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = concurrent.futures.wait(in_flight,
+                                                              return_when=concurrent.futures.FIRST_COMPLETED)
+                    n_routed += sum(bool(future.result().get('routed', False)) for future in done)
+
+                in_flight.add(executor.submit(self.write_json, queue_name, json_obj))
+                n_written += 1
+
+            n_routed += sum(bool(future.result().get('routed', False)) for future in in_flight)
+
+        if n_routed < n_written:
+            warnings.warn(f'{n_written - n_routed} of {n_written} messages were not routed to <{queue_name}>')
 
-    def write_jsons(self, queue_name, json_iterator):
-        for json_obj in json_iterator:
-            self.write_json(json_obj)
+        return n_routed
 
     def is_alive(self):
-        result = self._api_get(f'/api/aliveness-test/{self.virtual_host}')
+        result = self._api_get(f'/api/aliveness-test/{self._vhost}')
         return result.get('status', None) == 'ok'
 
     def health_check(self):
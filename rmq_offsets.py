@@ -0,0 +1,46 @@
+"""
+local store of stream consumer offsets, used by RMQ.read_stream to resume where a named consumer left off
+
+the store is one json file of {"<virtual_host>/<queue_name>/<consumer_name>": last_handled_offset},
+rewritten atomically (write to a temp file, then rename) so a crash never leaves it half-written
+"""
+import json
+import os
+import threading
+
+
+class OffsetStore:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(virtual_host, queue_name, consumer_name):
+        return f'{virtual_host}/{queue_name}/{consumer_name}'
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, mode='rt', encoding='utf8') as f:
+            return json.load(f)
+
+    def get(self, virtual_host, queue_name, consumer_name):
+        """
+        :return: last offset committed by this consumer, or None if it has never read the stream
+        """
+        with self._lock:
+            return self._load().get(self._key(virtual_host, queue_name, consumer_name))
+
+    def commit(self, virtual_host, queue_name, consumer_name, offset):
+        with self._lock:
+            offsets = self._load()
+            offsets[self._key(virtual_host, queue_name, consumer_name)] = offset
+
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            tmp_path = self.path + '.partial'
+            with open(tmp_path, mode='wt', encoding='utf8') as f:
+                json.dump(offsets, f, indent=4, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
@@ -1,12 +1,109 @@
+import codecs
+import concurrent.futures
 import datetime
+import hashlib
 import json
 import os
+import posixpath
+import queue
+import select
+import shlex
+import socket
+import threading
 import time
 import warnings
 
 import pandas as pd
 import paramiko
 
+import metrics
+import operation_log
+
+_metric_connect_seconds = metrics.REGISTRY.histogram('ssh_connect_seconds',
+                                                     'time to open and authenticate an ssh connection')
+_metric_commands = metrics.REGISTRY.counter('ssh_commands_total',
+                                            'commands executed, by exit status ("unknown" if not waited for)')
+_metric_sftp_bytes = metrics.REGISTRY.counter('ssh_sftp_bytes_total',
+                                              'bytes transferred over sftp (direction="get" or "put")')
+_metric_sftp_bytes_per_second = metrics.REGISTRY.histogram('ssh_sftp_bytes_per_second',
+                                                           'throughput of each sftp transfer',
+                                                           buckets=[2 ** i for i in range(10, 31, 2)])
+
+
+# size of each pipelined read/write within a chunk
+_SFTP_BLOCK_SIZE = 1024 * 1024
+
+# openssh's default MaxSessions, the most channels open at once over one connection; transfers leave room for the
+# shared sftp session and a command (e.g. remote hashing) on top of their own channels
+_MAX_SESSIONS = 10
+_MAX_TRANSFER_CHANNELS = _MAX_SESSIONS - 2
+
+
+# written into the local directory by SSH.sync, and never synced itself
+SYNC_MANIFEST_NAME = '.ssh_sync_manifest.json'
+
+
+def _is_sync_artifact(relative_path):
+    # the cache, and leftovers of an interrupted copy (resumed by the next sync, not synced themselves)
+    return (relative_path in (SYNC_MANIFEST_NAME, SYNC_MANIFEST_NAME + '.tmp')
+            or relative_path.endswith(('.partial', '.partial.manifest', '.partial.manifest.tmp')))
+
+
+def _is_utf8(path):
+    # names that aren't valid utf8 are decoded with surrogateescape, but paramiko can't send them
+    try:
+        path.encode('utf8')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _local_manifest(local_dir):
+    """
+    :return: dict of relative path ('/'-separated) -> [size, mtime, None] for every regular file under `local_dir`
+    """
+    manifest = dict()
+    for root, dir_names, file_names in os.walk(local_dir):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(path, local_dir).replace(os.sep, '/')
+            if _is_sync_artifact(relative_path) or os.path.islink(path):
+                continue
+            stat = os.stat(path)
+            manifest[relative_path] = [stat.st_size, int(stat.st_mtime), None]
+    return manifest
+
+
+def _arg_batches(args, max_command_bytes=64 * 1024):
+    """
+    split shell arguments into as few batches as fit within the shell's limit on a single command
+    """
+    batch = []
+    n_bytes = 0
+    for arg in args:
+        arg_bytes = len(os.fsencode(arg)) + 1
+        if batch and n_bytes + arg_bytes > max_command_bytes:
+            yield batch
+            batch = []
+            n_bytes = 0
+        batch.append(arg)
+        n_bytes += arg_bytes
+    if batch:
+        yield batch
+
+
+def _sha256_file(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _observe_sftp_transfer(direction, n_bytes, seconds):
+    _metric_sftp_bytes.inc(n_bytes, direction=direction)
+    _metric_sftp_bytes_per_second.observe(n_bytes / max(seconds, 1e-9), direction=direction)
+
 
 class SSHConnection:
 
@@ -18,45 +115,237 @@ class SSHConnection:
         self.ssh_conn = None
         self.timeout = timeout
 
-    def __enter__(self):
+    def connect(self):
         self.ssh_conn = paramiko.SSHClient()
         self.ssh_conn.load_system_host_keys()
         self.ssh_conn.set_missing_host_key_policy(paramiko.AutoAddPolicy)
-        self.ssh_conn.connect(hostname=self.ip_address,
-                              port=self.port,
-                              username=self.username,
-                              password=self.password,
-                              timeout=self.timeout)
+        with metrics.timer(_metric_connect_seconds):
+            self.ssh_conn.connect(hostname=self.ip_address,
+                                  port=self.port,
+                                  username=self.username,
+                                  password=self.password,
+                                  timeout=self.timeout,
+                                  banner_timeout=self.timeout,
+                                  auth_timeout=self.timeout)
         return self.ssh_conn
 
+    def __enter__(self):
+        return self.connect()
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.ssh_conn is not None:
             self.ssh_conn.close()
             self.ssh_conn = None
 
 
+class SSHCommand:
+    """
+    a command running on its own channel, whose stdout and stderr are read incrementally as they arrive
+    *   iterating yields `('stdout' | 'stderr', text)`, either complete lines (without the newline) or decoded chunks
+    *   both streams are drained as data arrives, so a command can't block on a full stderr pipe
+    *   at most `max_bytes` of output are read, after which the channel is closed and `truncated` is set
+    *   `exit_status` is set once the output has been read to eof (it stays None if truncated)
+    """
+
+    def __init__(self, channel, lines=True, max_bytes=None, encoding='utf8', chunk_size=64 * 1024,
+                 max_line_length=1024 * 1024, poll_seconds=1.0):
+        self.channel = channel
+        self.lines = lines
+        self.max_bytes = max_bytes
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.max_line_length = max_line_length
+        self.poll_seconds = poll_seconds
+
+        self.exit_status = None
+        self.n_bytes = 0
+        self.truncated = False
+
+    def iter_chunks(self):
+        """
+        yields `('stdout' | 'stderr', bytes)` as data arrives
+        """
+        channel = self.channel
+        try:
+            while True:
+                # checked before reading: once eof is in, all of the output is already buffered
+                # (the exit status can arrive before the last of the output, so it doesn't mean we're done)
+                finished = channel.eof_received or channel.closed
+
+                chunks = []
+                if channel.recv_ready():
+                    chunks.append(('stdout', channel.recv(self.chunk_size)))
+                if channel.recv_stderr_ready():
+                    chunks.append(('stderr', channel.recv_stderr(self.chunk_size)))
+
+                for stream_name, data in chunks:
+                    if self.max_bytes is not None and self.n_bytes + len(data) > self.max_bytes:
+                        data = data[:self.max_bytes - self.n_bytes]
+                        self.truncated = True
+                    self.n_bytes += len(data)
+                    if data:
+                        yield stream_name, data
+                    if self.truncated:
+                        return
+
+                if not chunks:
+                    if finished:
+                        self.exit_status = channel.recv_exit_status()
+                        _metric_commands.inc(exit_status=self.exit_status)
+                        return
+
+                    select.select([channel], [], [], self.poll_seconds)
+
+        finally:
+            channel.close()
+
+    def __iter__(self):
+        decoders = {stream_name: codecs.getincrementaldecoder(self.encoding)(errors='replace')
+                    for stream_name in ('stdout', 'stderr')}
+        partial_lines = {'stdout': '', 'stderr': ''}
+
+        for stream_name, data in self.iter_chunks():
+            text = decoders[stream_name].decode(data)
+            if not self.lines:
+                if text:
+                    yield stream_name, text
+                continue
+
+            *complete_lines, partial_lines[stream_name] = (partial_lines[stream_name] + text).split('\n')
+            for line in complete_lines:
+                yield stream_name, line
+
+            # very long lines are yielded in pieces, to keep memory bounded
+            if len(partial_lines[stream_name]) > self.max_line_length:
+                yield stream_name, partial_lines[stream_name]
+                partial_lines[stream_name] = ''
+
+        for stream_name in ('stdout', 'stderr'):
+            text = partial_lines[stream_name] + decoders[stream_name].decode(b'', final=True)
+            if text:
+                yield stream_name, text
+
+    def wait(self):
+        """
+        discard the output, and return the exit status
+        """
+        for _ in self.iter_chunks():
+            pass
+        return self.exit_status
+
+    def close(self):
+        self.channel.close()
+
+
 class SSH:
-    def __init__(self, ip_address, port, username, password, name=None, logfile='ssh.log'):
+    """
+    keeps one authenticated ssh transport open (with keepalives), running each command on a new channel over it,
+    and one sftp session for file transfers; both are transparently reopened if the connection drops
+    """
+
+    def __init__(self, ip_address, port, username, password, name=None, logfile='ssh.log', keepalive_seconds=30,
+                 timeout=30, test_connection=True):
         self.ip_address = ip_address
         self.port = port
         self.username = username
         self.password = password
         self.logfile = logfile
         self.name = name
-        self.log_separator = '--'  # compatible with jdump files
+        self.keepalive_seconds = keepalive_seconds
+        self.timeout = timeout
+        self.n_connections_opened = 0
+        self._can_hash_remotely = None  # checked on first use
 
-        try:
-            with SSHConnection(self.ip_address, self.port, self.username, self.password, timeout=30) as ssh_conn:
-                stdin, stdout, stderr = ssh_conn.exec_command('echo 123')
+        self._ssh_conn = None
+        self._sftp_conn = None
+        self._lock = threading.Lock()  # guards the two connections above, never held while connecting
+        self._connect_lock = threading.Lock()  # one connect at a time
+        self._n_closes = 0  # a connect that finishes after close() is discarded
+
+        # otherwise the connection is opened on first use
+        if test_connection:
+            try:
+                stdin, stdout, stderr = self._exec_command('echo 123')
                 out = stdout.read()
                 assert out.strip().decode('ascii') == '123', out
 
-        except Exception:
-            print('SSH connection test failed')
-            raise
+            except Exception:
+                print('SSH connection test failed')
+                raise
 
         self._log({'function': 'init'})
 
+    def close(self):
+        with self._lock:
+            sftp_conn, ssh_conn = self._sftp_conn, self._ssh_conn
+            self._sftp_conn = self._ssh_conn = None
+            self._n_closes += 1
+        if sftp_conn is not None:
+            sftp_conn.close()
+        if ssh_conn is not None:
+            ssh_conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _get_ssh_conn(self, failed_conn=None):
+        # `failed_conn` is replaced even if it looks usable, unless another thread has replaced it already
+        # (comparing against the current connection instead would close the replacement, and everything running on it)
+        def usable(ssh_conn):
+            transport = ssh_conn.get_transport() if ssh_conn is not None else None
+            return transport is not None and transport.is_active()
+
+        ssh_conn = self._ssh_conn
+        if ssh_conn is not failed_conn and usable(ssh_conn):
+            return ssh_conn
+
+        with self._connect_lock:
+            with self._lock:
+                # another thread may have reconnected while this one waited
+                if self._ssh_conn is not failed_conn and usable(self._ssh_conn):
+                    return self._ssh_conn
+                stale_conns = [self._sftp_conn, self._ssh_conn]
+                self._sftp_conn = self._ssh_conn = None
+                n_closes = self._n_closes
+            for stale_conn in stale_conns:
+                if stale_conn is not None:
+                    stale_conn.close()
+
+            # connecting can take up to `timeout`, so it happens outside self._lock and close() never waits for it
+            new_conn = SSHConnection(self.ip_address, self.port, self.username, self.password,
+                                     timeout=self.timeout).connect()
+            new_conn.get_transport().set_keepalive(self.keepalive_seconds)
+            # commands are a few small request/reply packets, which nagle's algorithm would hold back
+            new_conn.get_transport().sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            with self._lock:
+                if self._n_closes == n_closes:
+                    self._ssh_conn = new_conn
+                    self.n_connections_opened += 1
+                    return new_conn
+
+            new_conn.close()
+            raise paramiko.SSHException(f'{self} was closed while connecting')
+
+    def _exec_command(self, command):
+        # a transport can look active until it's used, so a failed channel open gets one retry on a new connection
+        # (a failed connect is not retried)
+        ssh_conn = self._get_ssh_conn()
+        try:
+            return ssh_conn.exec_command(command)
+        except (paramiko.SSHException, EOFError, OSError):
+            return self._get_ssh_conn(failed_conn=ssh_conn).exec_command(command)
+
+    def _get_sftp_conn(self):
+        ssh_conn = self._get_ssh_conn()
+        with self._lock:
+            if self._sftp_conn is None or self._sftp_conn.get_channel().closed:
+                self._sftp_conn = ssh_conn.open_sftp()
+            return self._sftp_conn
+
     def __str__(self):
         if self.name is None:
             return f'SSH<{self.username}@{self.ip_address}:{self.port}>'
@@ -73,16 +362,9 @@ class SSH:
         }
 
         if self.logfile is not None:
-            for _ in range(5):
-                try:
-                    with open(self.logfile, mode='at', encoding='utf8', newline='\n') as f:
-                        f.write(json.dumps(json_data, indent=4, sort_keys=True, ensure_ascii=False) + '\n')
-                        if self.log_separator:
-                            f.write(self.log_separator + '\n')
-                    break
-                except IOError:
-                    time.sleep(1)
+            operation_log.get_logger(self.logfile).log(json_data)
 
+    @metrics.instrumented('ssh')
     def execute(self, command, wait_for_output=True):
         out = None
         err = None
@@ -91,30 +373,36 @@ class SSH:
                    'command':  command,
                    })
 
-        # run command and (maybe) get output
-        with SSHConnection(self.ip_address, self.port, self.username, self.password) as ssh_conn:
-            stdin, stdout, stderr = ssh_conn.exec_command(command)
+        # run command on a new channel and (maybe) get output
+        stdin, stdout, stderr = self._exec_command(command)
 
-            if wait_for_output:
-                out = stdout.read()
-
-                try:
-                    out = out.decode('utf8')
-                except UnicodeDecodeError:
-                    print('could not decode stdout as utf8')
+        if wait_for_output:
+            # read both streams as data arrives, so neither can fill up and block the command
+            chunks = {'stdout': [], 'stderr': []}
+            try:
+                for stream_name, data in SSHCommand(stdout.channel).iter_chunks():
+                    chunks[stream_name].append(data)
+            except paramiko.SSHException:
+                print('could not read output')
 
-                try:
-                    err = stderr.read().rstrip()
-                except paramiko.SSHException:
-                    print('could not read stderr')
-                    err = b''
+            out = b''.join(chunks['stdout'])
+            try:
+                out = out.decode('utf8')
+            except UnicodeDecodeError:
+                print('could not decode stdout as utf8')
 
-                try:
-                    err = err.decode('utf8')
-                except paramiko.SSHException:
-                    print('could not decode stderr as utf8')
+            err = b''.join(chunks['stderr']).rstrip()
+            try:
+                err = err.decode('utf8')
+            except UnicodeDecodeError:
+                print('could not decode stderr as utf8')
 
-            elif 'nohup' not in command:
+        else:
+            # nobody will read the output, and an unread channel stalls the command once its window fills up
+            # (like dropping the connection used to, closing the channel hangs up on commands not run with nohup)
+            stdout.channel.close()
+            _metric_commands.inc(exit_status='unknown')
+            if 'nohup' not in command:
                 print('usage of `nohup` recommended for long-running commands')
 
         # warn on error
@@ -124,6 +412,20 @@ class SSH:
         # return output
         return out
 
+    def execute_stream(self, command, lines=True, max_bytes=None, encoding='utf8'):
+        """
+        start a command and return an SSHCommand, which yields `('stdout' | 'stderr', text)` as output arrives
+        e.g. `for stream_name, line in ssh.execute_stream('tail -n 1000000 big.log'): ...`, then `.exit_status`
+        """
+        self._log({'function':  'execute_stream',
+                   'command':   command,
+                   'max_bytes': max_bytes,
+                   })
+
+        stdin, stdout, stderr = self._exec_command(command)
+        return SSHCommand(stdout.channel, lines=lines, max_bytes=max_bytes, encoding=encoding)
+
+    @metrics.instrumented('ssh')
     def kill(self, pids):
         if type(pids) is not list:
             pids = [pids]
@@ -137,6 +439,7 @@ class SSH:
 
         self.execute(f'kill -9 {" ".join(map(str, pids))}')
 
+    @metrics.instrumented('ssh')
     def ps_ef(self, cmd_grep_patterns=None, kill=False, grep_case=True):
         headers = ['User', 'PID', 'Parent PID', 'CPU%', 'Start Time', 'TTY', 'Running Time', 'Command']
 
@@ -188,10 +491,12 @@ class SSH:
         # done
         return df
 
+    @metrics.instrumented('ssh')
     def process_running(self, cmd_grep_patterns, grep_case=True):
         rows, cols = self.ps_ef(cmd_grep_patterns, grep_case=grep_case).shape
         return rows or False
 
+    @metrics.instrumented('ssh')
     def exists(self, remote_path):
         remote_path = str(remote_path)
         assert remote_path.startswith('/')
@@ -208,12 +513,14 @@ class SSH:
             else:
                 path_exists = False  # UserWarning will have been raised
 
-            for warning in caught_warnings:
-                if path_exists or warning.category != UserWarning:
-                    warnings.warn(warning)
+        # re-raise outside the catch block, otherwise each re-raised warning is caught and appended again
+        for warning in caught_warnings:
+            if path_exists or warning.category != UserWarning:
+                warnings.warn(warning.message, warning.category)
 
         return path_exists
 
+    @metrics.instrumented('ssh')
     def mkdir(self, remote_path, parents=True):
         remote_path = str(remote_path)
         assert remote_path.startswith('/'), 'remote path must be absolute'
@@ -227,6 +534,7 @@ class SSH:
         else:
             return self.execute(f'mkdir "{remote_path}"')
 
+    @metrics.instrumented('ssh')
     def mv(self, remote_path, new_remote_path):
         remote_path = str(remote_path)
         assert remote_path.startswith('/')
@@ -237,6 +545,7 @@ class SSH:
 
         return self.execute(f'mv "{remote_path}" "{new_remote_path}"')
 
+    @metrics.instrumented('ssh')
     def rm(self, remote_path, recursive=False, force=True):
         remote_path = str(remote_path)
         assert remote_path.startswith('/')
@@ -261,6 +570,7 @@ class SSH:
 
         return self.execute(rm_command)
 
+    @metrics.instrumented('ssh')
     def tar_gz(self, remote_target, remote_output_path):
         remote_target = str(remote_target)
         remote_output_path = str(remote_output_path)
@@ -294,7 +604,237 @@ class SSH:
             self.mv(tmp_path, remote_output_path)
             return remote_output_path
 
-    def scp_remote_to_local(self, remote_path, local_path, overwrite=False, verbose=True):
+    def can_hash_remotely(self):
+        """
+        whether the remote host has dd, seq and sha256sum, which verifying transfers needs
+        (they're in coreutils, but minimal hosts, e.g. busybox-based ones, can lack some of them)
+        """
+        if self._can_hash_remotely is None:
+            out = self.execute('command -v dd && command -v seq && command -v sha256sum')
+            self._can_hash_remotely = len([line for line in (out or '').split('\n') if line.strip()]) == 3
+        return self._can_hash_remotely
+
+    def _remote_chunk_sha256s(self, remote_path, size, chunk_size):
+        # hashed on the remote host, so verification doesn't transfer the file a second time
+        n_chunks = max(1, -(-size // chunk_size))
+        out = self.execute(f'for i in $(seq 0 {n_chunks - 1}); do '
+                           f'dd if={shlex.quote(remote_path)} bs={chunk_size} skip=$i count=1 2>/dev/null '
+                           f'| sha256sum; done')
+        if isinstance(out, bytes):
+            out = out.decode('utf8', errors='replace')
+        sha256s = [line.split()[0] for line in (out or '').split('\n') if line.strip()]
+
+        # e.g. no sha256sum, seq or dd on the remote host: fail rather than silently skip verification
+        if len(sha256s) != n_chunks or not all(len(sha256) == 64 for sha256 in sha256s):
+            raise IOError(f'could not hash <{remote_path}> on the remote host, got {len(sha256s)} of {n_chunks} '
+                          f'chunk hashes (are dd, seq and sha256sum installed?), use verify=False to skip')
+        return sha256s
+
+    def _transfer_chunks(self, direction, src_path, dst_path, size, chunk_size, parallel, manifest, save_manifest):
+        """
+        copy every chunk not yet in `manifest['done']`, `parallel` chunks at a time, each over its own sftp channel
+        the sha256 of each chunk is recorded in the manifest (and the manifest saved) as soon as it is written
+
+        :return: number of bytes copied
+        """
+        n_chunks = max(1, -(-size // chunk_size))
+        todo = [i for i in range(n_chunks) if str(i) not in manifest['done']]
+        if not todo:
+            return 0
+        parallel = min(parallel, _MAX_TRANSFER_CHANNELS)
+
+        transport = self._get_ssh_conn().get_transport()
+        sftp_conns = queue.Queue()
+        for _ in range(min(parallel, len(todo))):
+            sftp_conns.put(paramiko.SFTPClient.from_transport(transport))
+        manifest_lock = threading.Lock()
+
+        def copy_chunk(i):
+            offset = i * chunk_size
+            end = min(size, offset + chunk_size)
+            digest = hashlib.sha256()
+
+            sftp_conn = sftp_conns.get()
+            try:
+                if direction == 'get':
+                    # readv pipelines the read requests, instead of waiting a round trip for each one
+                    with sftp_conn.open(src_path, 'rb') as src_f, open(dst_path, 'r+b') as dst_f:
+                        dst_f.seek(offset)
+                        blocks = [(o, min(_SFTP_BLOCK_SIZE, end - o)) for o in range(offset, end, _SFTP_BLOCK_SIZE)]
+                        for data in (src_f.readv(blocks) if blocks else []):
+                            digest.update(data)
+                            dst_f.write(data)
+                        # on disk before the manifest says so, or a crash could lose a chunk that counts as done
+                        dst_f.flush()
+                        os.fsync(dst_f.fileno())
+                else:
+                    # pipelined writes don't wait for each one to be acknowledged, close() waits for all of them
+                    with open(src_path, 'rb') as src_f, sftp_conn.open(dst_path, 'r+b') as dst_f:
+                        dst_f.set_pipelined(True)
+                        src_f.seek(offset)
+                        dst_f.seek(offset)
+                        for o in range(offset, end, _SFTP_BLOCK_SIZE):
+                            data = src_f.read(min(_SFTP_BLOCK_SIZE, end - o))
+                            digest.update(data)
+                            dst_f.write(data)
+            finally:
+                sftp_conns.put(sftp_conn)
+
+            with manifest_lock:
+                manifest['done'][str(i)] = digest.hexdigest()
+                save_manifest(manifest)
+            return end - offset
+
+        executor = concurrent.futures.ThreadPoolExecutor(parallel)
+        try:
+            futures = [executor.submit(copy_chunk, i) for i in todo]
+            return sum(future.result() for future in concurrent.futures.as_completed(futures))
+        finally:
+            # if a chunk failed, queued chunks are dropped, chunks in progress finish and are kept for resuming
+            executor.shutdown(wait=True, cancel_futures=True)
+            while not sftp_conns.empty():
+                sftp_conns.get().close()
+
+    def _ranged_transfer(self, direction, remote_path, local_path, tmp_path, parallel, chunk_size, resume, verify,
+                         verbose, sftp_conn=None):
+        """
+        copy a file into `tmp_path` in chunks (see _transfer_chunks), resuming from a previous attempt if its manifest
+        (stored next to `tmp_path`) matches the source's size and mtime, and optionally verifying every chunk's sha256
+        against one computed on the remote host, re-copying chunks that don't match
+        `sftp_conn` (by default the shared session) is used for the manifest, and must not be in use by another thread
+        `verify=None` verifies only if the remote host can compute the hashes
+        """
+        if sftp_conn is None:
+            sftp_conn = self._get_sftp_conn()
+        if verify is None:
+            verify = self.can_hash_remotely()
+            if not verify:
+                warnings.warn(f'{self} lacks dd, seq or sha256sum, copying <{remote_path}> without verifying it')
+        manifest_path = tmp_path + '.manifest'
+
+        if direction == 'get':
+            src_path, dst_path = remote_path, tmp_path
+            src_stat = sftp_conn.stat(remote_path)
+
+            def load_manifest():
+                with open(manifest_path, mode='rt', encoding='utf8') as f:
+                    return json.load(f)
+
+            def save_manifest(manifest_dict):
+                with open(manifest_path + '.tmp', mode='wt', encoding='utf8') as f:
+                    json.dump(manifest_dict, f)
+                os.replace(manifest_path + '.tmp', manifest_path)
+
+            def prepare_destination(size):
+                with open(tmp_path, mode='r+b' if os.path.exists(tmp_path) else 'wb') as f:
+                    f.truncate(size)
+
+            def remove_manifest():
+                if os.path.exists(manifest_path):
+                    os.remove(manifest_path)
+
+        else:
+            src_path, dst_path = local_path, tmp_path
+            src_stat = os.stat(local_path)
+
+            def load_manifest():
+                with sftp_conn.open(manifest_path, 'r') as f:
+                    return json.loads(f.read())
+
+            def save_manifest(manifest_dict):
+                with sftp_conn.open(manifest_path, 'w') as f:
+                    f.write(json.dumps(manifest_dict))
+
+            def prepare_destination(size):
+                try:
+                    tmp_size = sftp_conn.stat(tmp_path).st_size
+                except IOError:
+                    sftp_conn.open(tmp_path, 'w').close()
+                    tmp_size = 0
+                # some servers implement truncate by rewriting the file, so leave a resumable file alone
+                if tmp_size != size:
+                    sftp_conn.truncate(tmp_path, size)
+
+            def remove_manifest():
+                try:
+                    sftp_conn.remove(manifest_path)
+                except IOError:
+                    pass
+
+        size = src_stat.st_size
+        source = {'size': size, 'mtime': int(src_stat.st_mtime), 'chunk_size': chunk_size}
+
+        manifest = None
+        if resume:
+            try:
+                manifest = load_manifest()
+            except (IOError, ValueError):
+                pass
+            if manifest is not None and manifest.get('source') != source:
+                manifest = None  # source changed since, or different chunking
+        if manifest is None:
+            manifest = {'source': source, 'done': dict()}
+
+        if verbose and manifest['done']:
+            print(f'resuming: {len(manifest["done"])} of {max(1, -(-size // chunk_size))} chunks already copied')
+
+        prepare_destination(size)
+
+        # downloaded chunks are hashed from disk again, in case any were lost from the page cache in a crash
+        if direction == 'get' and manifest['done']:
+            with open(tmp_path, mode='rb') as f:
+                for i, sha256 in list(manifest['done'].items()):
+                    f.seek(int(i) * chunk_size)
+                    if hashlib.sha256(f.read(min(chunk_size, size - int(i) * chunk_size))).hexdigest() != sha256:
+                        del manifest['done'][i]
+        save_manifest(manifest)
+
+        # when downloading, the source is hashed on the remote host while it is being copied
+        hash_executor = concurrent.futures.ThreadPoolExecutor(1)
+        source_sha256s = None
+        if verify and direction == 'get':
+            source_sha256s = hash_executor.submit(self._remote_chunk_sha256s, remote_path, size, chunk_size)
+
+        time_start = time.perf_counter()
+        try:
+            n_bytes = self._transfer_chunks(direction, src_path, dst_path, size, chunk_size, parallel, manifest,
+                                            save_manifest)
+        finally:
+            hash_executor.shutdown(wait=False)
+
+        if verify:
+            for attempt in range(2):
+                if source_sha256s is not None:
+                    remote_sha256s = source_sha256s.result()
+                else:
+                    remote_sha256s = self._remote_chunk_sha256s(tmp_path, size, chunk_size)
+                bad_chunks = [i for i, sha256 in enumerate(remote_sha256s) if manifest['done'].get(str(i)) != sha256]
+                if not bad_chunks:
+                    break
+                if attempt > 0:
+                    raise IOError(f'{len(bad_chunks)} chunks failed checksum verification twice: {bad_chunks}')
+
+                warnings.warn(f'{len(bad_chunks)} chunks failed checksum verification, copying them again')
+                for i in bad_chunks:
+                    del manifest['done'][str(i)]
+                save_manifest(manifest)
+                n_bytes += self._transfer_chunks(direction, src_path, dst_path, size, chunk_size, parallel, manifest,
+                                                 save_manifest)
+
+        _observe_sftp_transfer(direction, n_bytes, time.perf_counter() - time_start)
+        remove_manifest()
+
+    @metrics.instrumented('ssh')
+    def scp_remote_to_local(self, remote_path, local_path, overwrite=False, verbose=True, parallel=4,
+                            chunk_size=64 * 1024 * 1024, resume=True, verify=None):
+        """
+        copy a remote file in a single sftp stream if it is smaller than `chunk_size`,
+        otherwise in `chunk_size` chunks, `parallel` at a time over separate sftp channels
+        an interrupted chunked copy leaves its `.partial` file (and a manifest of finished chunks) to be resumed
+        by the next call
+        if `verify` is set, every chunk's sha256 is checked against one computed on the remote host
+        (by default, only if the remote host has the tools to do so, see can_hash_remotely)
+        """
         remote_path = str(remote_path)
         local_path = os.path.abspath(local_path)
 
@@ -311,7 +851,7 @@ class SSH:
 
         # temp path
         tmp_path = local_path + '.partial'
-        if os.path.exists(tmp_path):
+        if os.path.exists(tmp_path) and not resume:
             os.remove(tmp_path)
 
         # make dir
@@ -329,23 +869,39 @@ class SSH:
                    })
 
         # scp to temp path
-        with SSHConnection(self.ip_address, self.port, self.username, self.password) as ssh_conn:
-            ftp_conn = ssh_conn.open_sftp()
-            try:
-                ftp_conn.get(remote_path, tmp_path)
-            except paramiko.SSHException:
-                print('could not retrieve file')
-
-            ftp_conn.close()
+        try:
+            sftp_conn = self._get_sftp_conn()
+            size = sftp_conn.stat(remote_path).st_size
+            if size < chunk_size:
+                time_start = time.perf_counter()
+                sftp_conn.get(remote_path, tmp_path)
+                _observe_sftp_transfer('get', size, time.perf_counter() - time_start)
+            else:
+                self._ranged_transfer('get', remote_path, local_path, tmp_path, parallel, chunk_size, resume, verify,
+                                      verbose)
+            succeeded = True
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            print(f'could not retrieve file ({e!r}), run again to resume')
+            succeeded = False
 
         # rename and return if scp succeeded
-        if os.path.exists(tmp_path):
+        if succeeded:
             if os.path.exists(local_path):
                 os.remove(local_path)
             os.rename(tmp_path, local_path)
             return local_path
 
-    def scp_local_to_remote(self, local_path, remote_path, overwrite=False, verbose=True):
+    @metrics.instrumented('ssh')
+    def scp_local_to_remote(self, local_path, remote_path, overwrite=False, verbose=True, parallel=4,
+                            chunk_size=64 * 1024 * 1024, resume=True, verify=None):
+        """
+        copy a local file in a single sftp stream if it is smaller than `chunk_size`,
+        otherwise in `chunk_size` chunks, `parallel` at a time over separate sftp channels
+        an interrupted chunked copy leaves its `.partial` file (and a manifest of finished chunks) to be resumed
+        by the next call
+        if `verify` is set, every chunk's sha256 is checked against one computed on the remote host
+        (by default, only if the remote host has the tools to do so, see can_hash_remotely)
+        """
         remote_path = str(remote_path)
         local_path = os.path.abspath(local_path)
 
@@ -362,7 +918,7 @@ class SSH:
 
         # temp path
         tmp_path = remote_path + '.partial'
-        if self.exists(tmp_path):
+        if not resume and self.exists(tmp_path):
             self.rm(tmp_path)
 
         # make dir
@@ -381,18 +937,259 @@ class SSH:
                    })
 
         # scp to temp path
-        with SSHConnection(self.ip_address, self.port, self.username, self.password) as ssh_conn:
-            ftp_conn = ssh_conn.open_sftp()
-            try:
-                ftp_conn.put(local_path, tmp_path)
-            except paramiko.SSHException:
-                print('could not transmit file')
-
-            ftp_conn.close()
+        try:
+            size = os.path.getsize(local_path)
+            if size < chunk_size:
+                time_start = time.perf_counter()
+                self._get_sftp_conn().put(local_path, tmp_path)
+                _observe_sftp_transfer('put', size, time.perf_counter() - time_start)
+            else:
+                self._ranged_transfer('put', remote_path, local_path, tmp_path, parallel, chunk_size, resume, verify,
+                                      verbose)
+            succeeded = True
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            print(f'could not transmit file ({e!r}), run again to resume')
+            succeeded = False
 
         # rename and return if scp succeeded
-        if self.exists(tmp_path):
+        if succeeded:
             if self.exists(remote_path):
                 self.rm(remote_path)
             self.mv(tmp_path, remote_path)
             return remote_path
+
+    def _remote_manifest(self, remote_dir):
+        # one command lists the whole tree, nul-separated so that any file name survives
+        out = self.execute(f'cd {shlex.quote(remote_dir)} 2>/dev/null && find . -type f -printf "%s\\t%T@\\t%P\\0"')
+        # output is returned undecoded if any name isn't valid utf8
+        if isinstance(out, bytes):
+            out = out.decode('utf8', errors='surrogateescape')
+        manifest = dict()
+        for record in (out or '').split('\0'):
+            if record:
+                size, mtime, path = record.split('\t', 2)
+                if not _is_sync_artifact(path):
+                    manifest[path] = [int(size), int(float(mtime)), None]
+        return manifest
+
+    def _remote_sha256s(self, remote_dir, paths):
+        # hashed on the remote host, in as few commands as fit within the shell's limit on a single argument
+        sha256s = dict()
+        for batch in _arg_batches([shlex.quote(path) for path in paths]):
+            out = self.execute(f'cd {shlex.quote(remote_dir)} && sha256sum -- {" ".join(batch)}')
+            for line in (out or '').split('\n'):
+                if line and not line.startswith('\\'):  # names with newlines or backslashes are escaped
+                    sha256s[line[66:]] = line[:64]
+        return sha256s
+
+    @metrics.instrumented('ssh')
+    def sync(self, local_dir, remote_dir, direction='up', delete=False, checksum=False, parallel=4,
+             chunk_size=64 * 1024 * 1024, verbose=True):
+        """
+        make `remote_dir` match `local_dir` (direction='up') or the other way around (direction='down'),
+        copying only files that are new or changed
+        *   both trees are listed with size and mtime, the remote one in a single command,
+            and a file counts as changed if either differs (or, if `checksum` is set, if its size or sha256 differs)
+        *   copied files keep their mtime, so the next sync sees them as unchanged
+        *   up to `parallel` files are copied at once, then files of at least `chunk_size` are copied one at a time,
+            in resumable chunks (`parallel` at a time)
+        *   files are copied to a `.partial` file and renamed into place
+        *   if `delete` is set, files that only exist in the destination are removed (empty directories are kept)
+        *   the listings and hashes are cached in `local_dir/.ssh_sync_manifest.json`,
+            so only files whose size or mtime changed since the last sync are hashed again
+
+        :return: dict of copied/deleted/unchanged file counts, bytes copied and seconds taken
+        """
+        assert direction in {'up', 'down'}
+        local_dir = os.path.abspath(local_dir)
+        remote_dir = str(remote_dir).rstrip('/') or '/'
+        assert remote_dir.startswith('/'), 'remote path must be absolute'
+        if direction == 'up':
+            assert os.path.isdir(local_dir), f'local dir <{local_dir}> does not exist'
+
+        self._log({'function':   'sync',
+                   'local_dir':  local_dir,
+                   'remote_dir': remote_dir,
+                   'direction':  direction,
+                   'delete':     delete,
+                   'checksum':   checksum,
+                   })
+
+        time_start = time.time()
+        cache_path = os.path.join(local_dir, SYNC_MANIFEST_NAME)
+        cache_key = f'{self.username}@{self.ip_address}:{self.port}{remote_dir}'
+        cache = dict()
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, mode='rt', encoding='utf8') as f:
+                    cache = json.load(f).get(cache_key, dict())
+            except ValueError:
+                pass
+
+        # list both sides: path -> [size, mtime, sha256 or None]
+        local_manifest = _local_manifest(local_dir)
+        remote_manifest = self._remote_manifest(remote_dir)
+
+        skipped_paths = sorted(path for path in set(local_manifest) | set(remote_manifest) if not _is_utf8(path))
+        if skipped_paths:
+            warnings.warn(f'skipping {len(skipped_paths)} files whose names are not valid utf8: '
+                          f'{[os.fsencode(path) for path in skipped_paths[:10]]}')
+            for path in skipped_paths:
+                local_manifest.pop(path, None)
+                remote_manifest.pop(path, None)
+
+        # reuse cached hashes of files whose size and mtime are unchanged, hash the rest
+        if checksum:
+            for manifest, cached_manifest in ((local_manifest, cache.get('local', dict())),
+                                              (remote_manifest, cache.get('remote', dict()))):
+                for path, (size, mtime, _) in manifest.items():
+                    cached = cached_manifest.get(path)
+                    if cached is not None and cached[:2] == [size, mtime]:
+                        manifest[path][2] = cached[2]
+
+            with concurrent.futures.ThreadPoolExecutor(parallel) as executor:
+                unhashed_paths = [path for path, entry in local_manifest.items() if entry[2] is None]
+                for path, sha256 in zip(unhashed_paths,
+                                        executor.map(_sha256_file,
+                                                     [os.path.join(local_dir, path) for path in unhashed_paths])):
+                    local_manifest[path][2] = sha256
+
+            unhashed_paths = [path for path, entry in remote_manifest.items() if entry[2] is None]
+            for path, sha256 in self._remote_sha256s(remote_dir, unhashed_paths).items():
+                if path in remote_manifest:
+                    remote_manifest[path][2] = sha256
+
+        if direction == 'up':
+            src_manifest, dst_manifest = local_manifest, remote_manifest
+        else:
+            src_manifest, dst_manifest = remote_manifest, local_manifest
+
+        def is_changed(path):
+            if path not in dst_manifest:
+                return True
+            src_size, src_mtime, src_sha256 = src_manifest[path]
+            dst_size, dst_mtime, dst_sha256 = dst_manifest[path]
+            if src_size != dst_size:
+                return True
+            if checksum:
+                return src_sha256 is None or src_sha256 != dst_sha256
+            return src_mtime != dst_mtime
+
+        changed_paths = sorted(path for path in src_manifest if is_changed(path))
+        extra_paths = sorted(set(dst_manifest) - set(src_manifest)) if delete else []
+        n_bytes = sum(src_manifest[path][0] for path in changed_paths)
+
+        if verbose:
+            print(f'syncing <{local_dir}> {"->" if direction == "up" else "<-"} <{remote_dir}>: '
+                  f'{len(changed_paths)} of {len(src_manifest)} files changed ({n_bytes:,} bytes)'
+                  f'{f", {len(extra_paths)} to delete" if delete else ""}')
+
+        # make every destination directory up front
+        dir_names = sorted({os.path.dirname(path) for path in changed_paths})
+        if direction == 'up':
+            dir_args = [shlex.quote(posixpath.join(remote_dir, dir_name)) for dir_name in dir_names]
+            for batch in _arg_batches(dir_args):
+                self.execute(f'mkdir -p -- {" ".join(batch)}')
+        else:
+            for dir_name in dir_names:
+                os.makedirs(os.path.join(local_dir, dir_name), exist_ok=True)
+
+        def copy_file(path, sftp_conn, ranged):
+            local_path = os.path.join(local_dir, path)
+            remote_path = posixpath.join(remote_dir, path)
+            size, mtime, _ = src_manifest[path]
+            tmp_path = (remote_path if direction == 'up' else local_path) + '.partial'
+
+            if ranged:
+                self._ranged_transfer('put' if direction == 'up' else 'get', remote_path, local_path, tmp_path,
+                                      parallel, chunk_size, True, checksum, False, sftp_conn=sftp_conn)
+            elif direction == 'up':
+                sftp_conn.put(local_path, tmp_path)
+            else:
+                sftp_conn.get(remote_path, tmp_path)
+
+            if direction == 'up':
+                sftp_conn.utime(tmp_path, (mtime, mtime))
+                sftp_conn.posix_rename(tmp_path, remote_path)
+            else:
+                os.utime(tmp_path, (mtime, mtime))
+                os.replace(tmp_path, local_path)
+
+            # the destination now matches the source
+            dst_manifest[path] = list(src_manifest[path])
+
+        # copy small files, each worker with its own sftp channel (an sftp session can't be shared between threads)
+        small_paths = [path for path in changed_paths if src_manifest[path][0] < chunk_size]
+        large_paths = [path for path in changed_paths if src_manifest[path][0] >= chunk_size]
+        n_workers = min(parallel, _MAX_TRANSFER_CHANNELS, len(small_paths))
+
+        transport = self._get_ssh_conn().get_transport()
+        sftp_conns = queue.Queue()
+        for _ in range(n_workers):
+            sftp_conns.put(paramiko.SFTPClient.from_transport(transport))
+
+        def copy_small_file(path):
+            sftp_conn = sftp_conns.get()
+            try:
+                copy_file(path, sftp_conn, ranged=False)
+            finally:
+                sftp_conns.put(sftp_conn)
+
+        time_copy_start = time.perf_counter()
+        try:
+            if small_paths:
+                with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+                    for _ in executor.map(copy_small_file, small_paths):
+                        pass
+        finally:
+            while not sftp_conns.empty():
+                sftp_conns.get().close()
+        if small_paths:
+            _observe_sftp_transfer('put' if direction == 'up' else 'get',
+                                   sum(src_manifest[path][0] for path in small_paths),
+                                   time.perf_counter() - time_copy_start)
+
+        # then large files one at a time, each copied `parallel` chunks at a time (and recording its own transfer)
+        if large_paths:
+            sftp_conn = paramiko.SFTPClient.from_transport(transport)
+            try:
+                for path in large_paths:
+                    copy_file(path, sftp_conn, ranged=True)
+            finally:
+                sftp_conn.close()
+
+        # delete files that only exist in the destination
+        if direction == 'up':
+            rm_args = [shlex.quote(posixpath.join(remote_dir, path)) for path in extra_paths]
+            for batch in _arg_batches(rm_args):
+                self.execute(f'rm -f -- {" ".join(batch)}')
+        else:
+            for path in extra_paths:
+                os.remove(os.path.join(local_dir, path))
+        for path in extra_paths:
+            del dst_manifest[path]
+
+        # remember both sides for the next sync
+        os.makedirs(local_dir, exist_ok=True)
+        all_caches = dict()
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, mode='rt', encoding='utf8') as f:
+                    all_caches = json.load(f)
+            except ValueError:
+                pass
+        all_caches[cache_key] = {'local': local_manifest, 'remote': remote_manifest}
+        with open(cache_path + '.tmp', mode='wt', encoding='utf8') as f:
+            json.dump(all_caches, f)
+        os.replace(cache_path + '.tmp', cache_path)
+
+        result = {'copied':    len(changed_paths),
+                  'deleted':   len(extra_paths),
+                  'unchanged': len(src_manifest) - len(changed_paths),
+                  'bytes':     n_bytes,
+                  'seconds':   time.time() - time_start,
+                  }
+        if verbose:
+            print(f'synced {result["copied"]} files ({n_bytes:,} bytes) and deleted {result["deleted"]} '
+                  f'in {result["seconds"]:.1f} seconds')
+        return result
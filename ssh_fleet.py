@@ -0,0 +1,163 @@
+import concurrent.futures
+import os
+import time
+import warnings
+
+import pandas as pd
+
+from ssh_controller import SSH
+
+
+class SSHFleet:
+    """
+    runs the same SSH operation on many hosts at once, in a bounded thread pool
+    *   each operation returns when every host has finished or hit its `timeout_seconds`,
+        so it takes about as long as the slowest host rather than the sum of all of them
+    *   hosts that raise or time out don't fail the whole operation, they are reported in `failures`
+        (a timed-out host has its connection closed, which aborts whatever it was blocked on)
+    """
+
+    def __init__(self, hosts, max_workers=16, timeout_seconds=60, logfile='ssh.log'):
+        """
+        :param hosts: SSH instances, or dicts of SSH arguments (ip_address, port, username, password, name)
+                      which are connected lazily, i.e. in parallel by the first operation,
+                      with `timeout_seconds` as their connect timeout unless they set `timeout`
+        """
+        self.hosts = dict()  # host name -> SSH
+        for host in hosts:
+            if not isinstance(host, SSH):
+                host = SSH(**{'logfile': logfile, 'timeout': timeout_seconds, **host, 'test_connection': False})
+            host_name = host.name if host.name is not None else f'{host.ip_address}:{host.port}'
+            assert host_name not in self.hosts, f'duplicate host <{host_name}>'
+            self.hosts[host_name] = host
+
+        self.max_workers = max_workers
+        self.timeout_seconds = timeout_seconds
+        self.failures = dict()  # host name -> exception, from the last operation
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def __str__(self):
+        return f'SSHFleet<{",".join(self.hosts)}>'
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for ssh in self.hosts.values():
+            ssh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def map(self, func, timeout_seconds=None):
+        """
+        run `func(host_name, ssh)` for every host concurrently
+
+        :return: dict of host name to result, for the hosts that succeeded (failures are in `self.failures`)
+        """
+        if timeout_seconds is None:
+            timeout_seconds = self.timeout_seconds
+
+        start_times = dict()  # host name -> when its call started running (it may wait for a worker first)
+
+        def run(host_name, ssh):
+            start_times[host_name] = time.time()
+            return func(host_name, ssh)
+
+        futures = {self._executor.submit(run, host_name, ssh): host_name for host_name, ssh in self.hosts.items()}
+        results = dict()
+        self.failures = dict()
+
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=0.1)
+            for future in done:
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    self.failures[futures[future]] = e
+
+            for future in list(pending):
+                host_name = futures[future]
+                if host_name in start_times and time.time() - start_times[host_name] > timeout_seconds:
+                    pending.discard(future)
+                    self.failures[host_name] = TimeoutError(f'no result after {timeout_seconds} seconds')
+                    self.hosts[host_name].close()
+
+        if self.failures:
+            warnings.warn(f'{len(self.failures)} of {len(self.hosts)} hosts failed: '
+                          + ', '.join(f'<{host_name}> {e!r}' for host_name, e in sorted(self.failures.items())))
+
+        return results
+
+    def execute(self, command, timeout_seconds=None):
+        """
+        :return: DataFrame with the host, output, and error (None if it succeeded) of each host
+        """
+        results = self.map(lambda host_name, ssh: ssh.execute(command), timeout_seconds=timeout_seconds)
+        return pd.DataFrame([{'host':   host_name,
+                              'output': results.get(host_name),
+                              'error':  repr(self.failures[host_name]) if host_name in self.failures else None,
+                              } for host_name in self.hosts], columns=['host', 'output', 'error'])
+
+    def ps_ef(self, cmd_grep_patterns=None, kill=False, grep_case=True, timeout_seconds=None):
+        """
+        :return: every host's `ps_ef` rows in one DataFrame, with a host column in front
+        """
+        results = self.map(lambda host_name, ssh: ssh.ps_ef(cmd_grep_patterns, kill=kill, grep_case=grep_case),
+                           timeout_seconds=timeout_seconds)
+        dfs = [df.assign(host=host_name) for host_name, df in results.items()]
+        if not dfs:
+            return pd.DataFrame(columns=['host'])
+        df = pd.concat(dfs, ignore_index=True)
+        return df[['host'] + [column for column in df.columns if column != 'host']]
+
+    def kill(self, pids_by_host, timeout_seconds=None):
+        """
+        :param pids_by_host: dict of host name to pid or list of pids, or a DataFrame with host and PID columns
+                             (e.g. from `ps_ef(...)`)
+        """
+        if isinstance(pids_by_host, pd.DataFrame):
+            pids_by_host = pids_by_host.groupby('host')['PID'].apply(list).to_dict()
+
+        unknown_host_names = set(pids_by_host) - set(self.hosts)
+        assert not unknown_host_names, f'unknown hosts: <{",".join(sorted(unknown_host_names))}>'
+
+        def kill(host_name, ssh):
+            if host_name in pids_by_host:
+                pids = pids_by_host[host_name]
+                ssh.kill([int(pid) for pid in pids] if pd.api.types.is_list_like(pids) else pids)
+
+        self.map(kill, timeout_seconds=timeout_seconds)
+
+    def scp_local_to_remote(self, local_path, remote_path, overwrite=False, timeout_seconds=None):
+        """
+        copy one local file to the same path on every host
+
+        :return: dict of host name to remote path, for the hosts where the copy succeeded
+        """
+        results = self.map(lambda host_name, ssh: ssh.scp_local_to_remote(local_path, remote_path,
+                                                                           overwrite=overwrite,
+                                                                           verbose=False),
+                           timeout_seconds=timeout_seconds)
+        return {host_name: path for host_name, path in results.items() if path is not None}
+
+    def scp_remote_to_local(self, remote_path, local_dir, overwrite=False, timeout_seconds=None):
+        """
+        copy the same remote file from every host into `local_dir/<host name>/<file name>`
+
+        :return: dict of host name to local path, for the hosts where the copy succeeded
+        """
+        def scp(host_name, ssh):
+            local_path = os.path.join(local_dir, host_name.replace(':', '_'), os.path.basename(remote_path))
+            return ssh.scp_remote_to_local(remote_path, local_path, overwrite=overwrite, verbose=False)
+
+        # hosts create their own subdirectories concurrently, so the shared parent has to exist first
+        os.makedirs(local_dir, exist_ok=True)
+        results = self.map(scp, timeout_seconds=timeout_seconds)
+        return {host_name: path for host_name, path in results.items() if path is not None}
@@ -0,0 +1,71 @@
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+def test_counter_text_format():
+    registry = metrics.MetricsRegistry()
+    counter = registry.counter('messages_total', 'messages seen')
+    counter.inc(direction='out', queue='a')
+    counter.inc(2, queue='a', direction='out')
+    counter.inc(queue='say "hi"\n\\')
+
+    assert counter.get(direction='out', queue='a') == 3
+    assert registry.dump() == ('# HELP messages_total messages seen\n'
+                               '# TYPE messages_total counter\n'
+                               'messages_total{direction="out",queue="a"} 3\n'
+                               'messages_total{queue="say \\"hi\\"\\n\\\\"} 1\n')
+
+
+def test_histogram_text_format():
+    registry = metrics.MetricsRegistry()
+    histogram = registry.histogram('seconds', 'durations', buckets=(1, 0.5))
+    for value in [0.25, 0.5, 0.75, 2]:
+        histogram.observe(value, operation='op')
+
+    assert histogram.get_count(operation='op') == 4
+    assert registry.dump() == ('# HELP seconds durations\n'
+                               '# TYPE seconds histogram\n'
+                               'seconds_bucket{operation="op",le="0.5"} 2\n'  # buckets are inclusive
+                               'seconds_bucket{operation="op",le="1"} 3\n'
+                               'seconds_bucket{operation="op",le="+Inf"} 4\n'
+                               'seconds_sum{operation="op"} 3.5\n'
+                               'seconds_count{operation="op"} 4\n')
+
+
+def test_metrics_are_shared_by_name():
+    registry = metrics.MetricsRegistry()
+    assert registry.counter('total', 'a') is registry.counter('total', 'b')
+    with pytest.raises(AssertionError):
+        registry.histogram('total', 'a')
+
+
+def test_instrumented_records_durations_and_errors():
+    registry = metrics.MetricsRegistry()
+
+    @metrics.instrumented('test', registry=registry)
+    def operation(fail):
+        if fail:
+            raise KeyError(fail)
+
+    operation(False)
+    with pytest.raises(KeyError):
+        operation(True)
+
+    assert registry.histogram('test_operation_seconds', '').get_count(operation='operation') == 2
+    assert registry.counter('test_operation_errors_total', '').get(operation='operation', error='KeyError') == 1
+
+
+def test_http_server():
+    registry = metrics.MetricsRegistry()
+    registry.counter('total', 'things').inc()
+    server = registry.start_http_server(0, host='127.0.0.1')
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert response.read().decode('utf8') == registry.dump()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,45 @@
+import json
+import os
+
+import operation_log
+
+
+def read_lines(path):
+    with open(path, encoding='utf8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_records_are_written_in_order(tmp_path):
+    logger = operation_log.OperationLogger(str(tmp_path / 'ops.log'))
+    for i in range(1000):
+        logger.log({'i': i, 'text': 'naïve', 'path': tmp_path})
+    assert logger.flush(timeout=5)
+
+    records = read_lines(tmp_path / 'ops.log')
+    assert [record['i'] for record in records] == list(range(1000))
+    assert records[0]['text'] == 'naïve' and records[0]['path'] == str(tmp_path)  # non-json values as str
+
+
+def test_rotation(tmp_path):
+    path = str(tmp_path / 'ops.log')
+    logger = operation_log.OperationLogger(path, max_bytes=1000, backup_count=2)
+    for i in range(100):
+        logger.log({'i': i, 'padding': 'x' * 50})
+        assert logger.flush(timeout=5)  # one record per write, so each write can rotate
+
+    assert sorted(os.listdir(tmp_path)) == ['ops.log', 'ops.log.1', 'ops.log.2']
+    assert all(os.path.getsize(os.path.join(tmp_path, name)) <= 1000 for name in os.listdir(tmp_path))
+    records = read_lines(path + '.2') + read_lines(path + '.1') + read_lines(path)
+    assert [record['i'] for record in records] == list(range(100 - len(records), 100))
+
+
+def test_full_queue_drops_records(tmp_path):
+    logger = operation_log.OperationLogger(str(tmp_path / 'ops.log'), max_pending=0)
+    logger.log({'i': 0})
+    assert logger.n_dropped == 1
+
+
+def test_one_logger_per_file(tmp_path):
+    path = str(tmp_path / 'ops.log')
+    assert operation_log.get_logger(path) is operation_log.get_logger(os.path.relpath(path))
+    assert operation_log.get_logger(path) is not operation_log.get_logger(path + '.other')
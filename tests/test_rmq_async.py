@@ -0,0 +1,67 @@
+import asyncio
+import contextlib
+
+import pytest
+
+import rmq_async
+
+
+class FakeExchange:
+    def __init__(self):
+        self.n_published = 0
+        self.n_cancelled = 0
+
+    async def publish(self, message, routing_key):
+        self.n_published += 1
+        if self.n_published == 3:
+            raise ConnectionError('publish failed')
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            self.n_cancelled += 1
+            raise
+
+
+class FakeChannel:
+    def __init__(self):
+        self.default_exchange = FakeExchange()
+
+
+def test_write_jsons_cancels_pending_publishes_on_failure(monkeypatch):
+    rmq = rmq_async.AsyncRMQ('127.0.0.1', 5672, '/', 'guest', 'guest', logfile=None)
+    channel = FakeChannel()
+
+    @contextlib.asynccontextmanager
+    async def fake_channel():
+        yield channel
+
+    monkeypatch.setattr(rmq, '_channel', fake_channel)
+
+    async def write_then_check():
+        with pytest.raises(ConnectionError):
+            await rmq.write_jsons('queue', ({'value': i} for i in range(10)), window=5)
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(write_then_check()) == []
+    assert channel.default_exchange.n_published == 5
+    assert channel.default_exchange.n_cancelled == 4
+
+
+def test_wait_until_queues_empty_awaits_on_empty(monkeypatch):
+    rmq = rmq_async.AsyncRMQ('127.0.0.1', 5672, '/', 'guest', 'guest', logfile=None)
+    counts = {'a': [2, 1, 0, 0], 'b': [1, 0, 0, 0]}
+
+    async def fake_get_counts(queue_names):
+        return {queue_name: counts[queue_name].pop(0) for queue_name in queue_names}
+
+    monkeypatch.setattr(rmq, 'get_counts', fake_get_counts)
+
+    emptied = []
+
+    async def on_empty(queue_name, elapsed_seconds):
+        await asyncio.sleep(0)
+        emptied.append(queue_name)
+
+    asyncio.run(rmq.wait_until_queues_empty(['a', 'b'], verbose=False, on_empty=on_empty,
+                                            min_sleep_seconds=0.01, max_sleep_seconds=0.01))
+    assert emptied == ['b', 'a']
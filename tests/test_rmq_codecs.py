@@ -0,0 +1,49 @@
+import zlib
+
+import pytest
+
+import rmq_codecs
+
+JSON_OBJ = {'text': 'naïve café', 'number': 12345678901234567890, 'float': 0.5, 'list': [1, None, True]}
+
+
+def available(serializer='json', compression=None):
+    missing = [name for name, module in [('orjson', rmq_codecs.orjson),
+                                         ('msgpack', rmq_codecs.msgpack),
+                                         ('lz4', rmq_codecs.lz4)]
+               if module is None and name in (serializer, compression)]
+    return pytest.param(serializer, compression, marks=pytest.mark.skipif(bool(missing), reason=f'needs {missing}'))
+
+
+@pytest.mark.parametrize('serializer,compression', [available(serializer, compression)
+                                                    for serializer in ['json', 'orjson', 'msgpack']
+                                                    for compression in [None, 'zlib', 'lz4']])
+def test_round_trip(serializer, compression):
+    codec = rmq_codecs.Codec(serializer, compression)
+    body = codec.encode(JSON_OBJ)
+    assert rmq_codecs.decode(body, codec.content_type, codec.content_encoding) == JSON_OBJ
+
+
+def test_raw_round_trip():
+    codec = rmq_codecs.Codec('raw', 'zlib')
+    assert rmq_codecs.decode(codec.encode(b'\x00\xff'), codec.content_type, codec.content_encoding) == b'\x00\xff'
+    assert rmq_codecs.decode(codec.encode('text'), codec.content_type, codec.content_encoding) == b'text'
+
+
+def test_decode_defaults_to_json():
+    # written before codecs existed, or by other clients
+    assert rmq_codecs.decode(b'{"a": 1}') == {'a': 1}
+    assert rmq_codecs.decode(b'{"a": 1}', 'text/plain; charset=utf-8', 'utf-8') == {'a': 1}
+    assert rmq_codecs.decode(zlib.compress(b'[1]'), 'Application/JSON', 'zlib') == [1]
+
+
+def test_decode_rejects_unknown_properties():
+    with pytest.raises(ValueError):
+        rmq_codecs.decode(b'{}', 'application/xml')
+    with pytest.raises(ValueError):
+        rmq_codecs.decode(b'{}', 'application/json', 'gzip')
+
+
+def test_json_is_strict():
+    with pytest.raises(ValueError):
+        rmq_codecs.Codec('json').encode({'nan': float('nan')})
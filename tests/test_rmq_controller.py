@@ -0,0 +1,822 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+import pika
+import pytest
+
+import rmq_controller
+import rmq_dump
+
+
+class FakeChannel:
+    """
+    the parts of a pika channel used by RMQ's reads and counts, delivering from an in-memory queue
+    unacked messages are requeued (at the front) by a nack, like the broker does
+    """
+
+    is_open = True
+
+    def __init__(self, bodies, delivery_seconds=0.0, headers=None):
+        self.ready = collections.deque(bodies)
+        self.headers = headers
+        self.unacked = dict()  # delivery tag -> body
+        self.acked = []
+        self.delivery_seconds = delivery_seconds
+        self.next_delivery_tag = 1
+        self.prefetch_count = 0  # unlimited until basic_qos is called
+        self.max_prefetched = 0
+        self.connection = FakeConnection()
+        self._impl = self  # acks can be sent without flushing
+
+        self._consumer_of = dict()  # delivery tag -> consumer
+        self._n_unacked_by_consumer = collections.Counter()
+        self._n_consumers = 0
+
+    def queue_declare(self, queue, durable, exclusive, auto_delete, passive):
+        return pika.frame.Method(1, pika.spec.Queue.DeclareOk(queue=queue, message_count=len(self.ready)))
+
+    def basic_qos(self, prefetch_count, global_qos=False):
+        pika.spec.Basic.Qos(prefetch_count=prefetch_count).encode()  # raises if it doesn't fit
+        self.prefetch_count = prefetch_count
+
+    def consume(self, queue, inactivity_timeout=None, arguments=None):
+        # prefetch applies to each consumer, and a consumer's unacked messages still count after it's cancelled
+        self._n_consumers += 1
+        consumer = self._n_consumers
+        while True:
+            n_prefetched = self._n_unacked_by_consumer[consumer]
+            if not self.ready or 0 < self.prefetch_count <= n_prefetched:
+                time.sleep(inactivity_timeout)
+                yield None, None, None
+                continue
+
+            # slow deliveries leave time for the pool to break between two submits
+            time.sleep(self.delivery_seconds)
+            body = self.ready.popleft()
+            delivery_tag = self.next_delivery_tag
+            self.next_delivery_tag += 1
+            self.unacked[delivery_tag] = body
+            self._consumer_of[delivery_tag] = consumer
+            self._n_unacked_by_consumer[consumer] += 1
+            self.max_prefetched = max(self.max_prefetched, n_prefetched + 1)
+            yield (pika.spec.Basic.Deliver(delivery_tag=delivery_tag),
+                   pika.BasicProperties(content_type='application/json', headers=self.headers),
+                   body)
+
+    def cancel(self):
+        pass  # deliveries are made lazily, so none are pending
+
+    def _settle(self, delivery_tag, multiple):
+        # a multiple with delivery tag 0 settles everything outstanding
+        settled_tags = (sorted(tag for tag in self.unacked if tag <= delivery_tag or delivery_tag == 0) if multiple
+                        else [delivery_tag])
+        for tag in settled_tags:
+            self._n_unacked_by_consumer[self._consumer_of.pop(tag)] -= 1
+        return [self.unacked.pop(tag) for tag in settled_tags]
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.extend(self._settle(delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        assert requeue
+        self.ready.extendleft(reversed(self._settle(delivery_tag, multiple)))
+
+
+class FakePublishChannel:
+    """
+    the parts of a pika channel used by RPublisher, confirming every message the next time frames are processed
+    """
+
+    is_open = True
+
+    def __init__(self):
+        self.published = []
+        self._impl = self
+        self._n_confirmed = 0
+
+    def confirm_delivery(self, ack_nack_callback, callback):
+        self._on_ack_nack = ack_nack_callback
+        callback(None)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((routing_key, body))
+
+    def _flush_output(self, condition):
+        if self._n_confirmed < len(self.published):
+            self._n_confirmed = len(self.published)
+            self._on_ack_nack(pika.frame.Method(1, pika.spec.Basic.Ack(delivery_tag=self._n_confirmed,
+                                                                        multiple=True)))
+        assert condition()
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeConnection:
+    def __init__(self):
+        self.publish_channels = []
+
+    def channel(self):
+        self.publish_channels.append(FakePublishChannel())
+        return self.publish_channels[-1]
+
+
+class FakePool:
+    def __init__(self, rmq_channel):
+        self.rmq_channel = rmq_channel
+
+    @contextlib.contextmanager
+    def channel(self, dedicated=False):
+        try:
+            yield self.rmq_channel
+        finally:
+            # closing a dedicated channel requeues whatever it left unacked
+            if dedicated and getattr(self.rmq_channel, 'unacked', None):
+                self.rmq_channel.basic_nack(max(self.rmq_channel.unacked), multiple=True)
+
+    def is_blocked(self, rmq_conn):
+        return False
+
+    def close(self):
+        pass
+
+
+def fake_rmq(monkeypatch, rmq_channel):
+    monkeypatch.setattr(rmq_controller, 'RChannelPool', lambda parameters, size: FakePool(rmq_channel))
+    rmq = rmq_controller.RMQ('127.0.0.1', 5672, '/', 'guest', 'guest', logfile=None)
+    monkeypatch.setattr(rmq, 'get_count', lambda queue_name: len(rmq_channel.ready))
+    return rmq
+
+
+def double_or_die_once(json_obj):
+    # the first worker to see the marker dies without cleaning up, like a segfault or the oom killer
+    if json_obj.get('die_marker') and not os.path.exists(json_obj['die_marker']):
+        open(json_obj['die_marker'], 'w').close()
+        os._exit(1)
+    return json_obj['value'] * 2
+
+
+@pytest.mark.parametrize('delivery_seconds', [0.0, 0.5])
+def test_map_jsons_survives_a_dying_worker(monkeypatch, tmp_path, delivery_seconds):
+    die_marker = str(tmp_path / 'died')
+    messages = [{'value': 1, 'die_marker': die_marker}] + [{'value': i} for i in range(2, 5)]
+    rmq_channel = FakeChannel([json.dumps(message).encode('utf8') for message in messages],
+                              delivery_seconds=delivery_seconds)
+
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+    with pytest.warns(UserWarning, match='worker process died'):
+        results = list(rmq.map_jsons('queue', double_or_die_once, processes=1, verbose=False))
+
+    assert os.path.exists(die_marker)
+    assert results == [2, 4, 6, 8]
+    assert not rmq_channel.ready and not rmq_channel.unacked
+    assert sorted(json.loads(body)['value'] for body in rmq_channel.acked) == [1, 2, 3, 4]
+
+
+def test_dump_queue_holds_the_queue_with_bounded_prefetch(monkeypatch, tmp_path):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(25)]
+    rmq_channel = FakeChannel(bodies)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+    path = str(tmp_path / 'queue.dump')
+
+    assert rmq.dump_queue('queue', path, block_size=4, timeout_seconds=1, verbose=False) == 25
+    assert [body for _, body in rmq_dump.read_records(path)] == bodies
+    assert rmq_channel.max_prefetched <= 8
+    assert list(rmq_channel.ready) == bodies and not rmq_channel.unacked and not rmq_channel.acked
+
+    with pytest.raises(FileExistsError):
+        rmq.dump_queue('queue', path, verbose=False)
+
+
+class TimingOutChannel(FakeChannel):
+    """
+    a channel the broker closes after `n_deliveries`, like it does once a delivery exceeds the consumer_timeout
+    """
+
+    def __init__(self, bodies, n_deliveries):
+        super().__init__(bodies)
+        self.n_deliveries = n_deliveries
+
+    def consume(self, queue, inactivity_timeout=None, arguments=None):
+        for delivery in super().consume(queue, inactivity_timeout, arguments):
+            if self.n_deliveries is not None and self.next_delivery_tag > self.n_deliveries:
+                raise pika.exceptions.ChannelClosedByBroker(406, 'PRECONDITION_FAILED - delivery acknowledgement '
+                                                                 'on channel 1 timed out')
+            yield delivery
+
+
+def test_dump_queue_leaves_the_queue_intact_when_the_broker_closes_the_channel(monkeypatch, tmp_path):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(25)]
+    rmq_channel = TimingOutChannel(bodies, n_deliveries=10)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+    path = str(tmp_path / 'queue.dump')
+
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        rmq.dump_queue('queue', path, block_size=4, timeout_seconds=1, verbose=False)
+    assert list(rmq_channel.ready) == bodies and not rmq_channel.unacked and not rmq_channel.acked
+
+    # the blocks written before the channel closed are kept
+    rmq_channel.n_deliveries = None
+    assert rmq.dump_queue('queue', path, resume=True, block_size=4, timeout_seconds=1, verbose=False) == 25
+    assert [body for _, body in rmq_dump.read_records(path)] == bodies
+    assert list(rmq_channel.ready) == bodies
+
+    with pytest.raises(ValueError):
+        rmq.dump_queue('queue', str(tmp_path / 'too_big.dump'), max_unacked=20, verbose=False)
+    assert not os.path.exists(tmp_path / 'too_big.dump')
+    assert rmq.dump_queue('queue', str(tmp_path / 'head.dump'), n=20, max_unacked=20, verbose=False) == 20
+
+def test_dump_queue_remove(monkeypatch, tmp_path):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(25)]
+    rmq_channel = FakeChannel(bodies)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+    path = str(tmp_path / 'queue.dump')
+
+    assert rmq.dump_queue('queue', path, n=10, remove=True, block_size=4, verbose=False) == 10
+    assert rmq.dump_queue('queue', path, remove=True, resume=True, block_size=4, verbose=False) == 25
+    assert [body for _, body in rmq_dump.read_records(path)] == bodies
+    assert rmq_channel.acked == bodies and not rmq_channel.ready and not rmq_channel.unacked
+
+
+class LaggingAdmin:
+    """
+    a management api whose count for the queue drains from `initial_count` by `step` per snapshot
+    """
+    snapshot_ttl = 0
+
+    def __init__(self, initial_count, step):
+        self.counts = []
+        self.next_count = initial_count
+        self.step = step
+
+    def snapshot(self):
+        # a queue declared since the broker last refreshed its stats isn't listed yet
+        if self.next_count is None:
+            return pd.DataFrame({'messages_ready': []}, index=pd.Index([], name='name'))
+        self.counts.append(self.next_count)
+        self.next_count = max(0, self.next_count - self.step)
+        return pd.DataFrame({'messages_ready': [self.counts[-1]]}, index=pd.Index(['queue'], name='name'))
+
+
+def wait_until_empty(rmq):
+    empty_after = []
+    rmq.wait_until_queues_empty('queue', verbose=False,
+                                on_empty=lambda queue_name, seconds: empty_after.append(seconds),
+                                min_sleep_seconds=0.01, max_sleep_seconds=0.01)
+    return empty_after
+
+
+def test_wait_until_queues_empty_confirms_empty_over_amqp(monkeypatch):
+    rmq_channel = FakeChannel([b'{}'] * 3)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+    rmq.admin = LaggingAdmin(0, 0)  # already says empty
+
+    monkeypatch.setattr(rmq_controller.time, 'sleep', lambda seconds: rmq_channel.ready.pop() and None)
+    assert len(wait_until_empty(rmq)) == 1
+    assert not rmq_channel.ready
+
+
+def test_wait_until_queues_empty_on_a_queue_not_in_the_stats_yet(monkeypatch):
+    rmq_channel = FakeChannel([b'{}'] * 3)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+    rmq.admin = LaggingAdmin(None, 0)
+
+    monkeypatch.setattr(rmq_controller.time, 'sleep', lambda seconds: rmq_channel.ready.pop() and None)
+    assert len(wait_until_empty(rmq)) == 1
+    assert not rmq_channel.ready
+
+
+class AlmostDoneEstimator:
+    def __init__(self, name=None):
+        pass
+
+    def update(self, num_remaining):
+        pass
+
+    def get_estimate(self):
+        return 1.0
+
+
+def test_wait_until_queues_empty_does_not_wait_for_the_stats(monkeypatch):
+    rmq = fake_rmq(monkeypatch, FakeChannel([]))
+    rmq.admin = LaggingAdmin(1000, 10)  # still draining, in the stats
+    monkeypatch.setattr(rmq_controller, 'RemainingTimeEstimator', AlmostDoneEstimator)
+
+    assert len(wait_until_empty(rmq)) == 1
+    assert rmq.admin.counts[-1] > 0
+
+
+def test_wait_until_queues_empty_estimates_from_fresh_counts_when_taken(monkeypatch):
+    rmq_channel = FakeChannel([b'{}'] * 3)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+    rmq.admin = LaggingAdmin(0, 0)  # says empty, but the fresh count says otherwise
+
+    updates = []
+    monkeypatch.setattr(AlmostDoneEstimator, 'update', lambda estimator, num_remaining: updates.append(num_remaining))
+    monkeypatch.setattr(rmq_controller, 'RemainingTimeEstimator', AlmostDoneEstimator)
+    monkeypatch.setattr(rmq_controller.time, 'sleep', lambda seconds: rmq_channel.ready.pop() and None)
+
+    assert len(wait_until_empty(rmq)) == 1
+    assert updates == [3, 2, 1]
+
+
+def test_move_with_filter_skipping_more_than_a_prefetch_count_can_hold(monkeypatch):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(70000)]
+    rmq_channel = FakeChannel(bodies)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+
+    assert rmq.move('src', 'dst', filter=lambda json_obj: json_obj['value'] % 10000 == 0, window=100,
+                    verbose=False) == 7
+    assert [body for _, body in rmq_channel.connection.publish_channels[0].published] == bodies[::10000]
+    assert rmq_channel.acked == bodies[::10000]
+    assert rmq_channel.max_prefetched <= 100
+    assert list(rmq_channel.ready) == [body for i, body in enumerate(bodies) if i % 10000]
+
+
+def test_peek_and_sample_more_than_a_prefetch_count_can_hold(monkeypatch):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(70000)]
+    rmq_channel = FakeChannel(bodies)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+
+    assert rmq.peek('queue', n=70000, verbose=False) == [{'value': i} for i in range(70000)]
+    assert list(rmq_channel.ready) == bodies
+
+    sample = rmq.sample('queue', n=7000, verbose=False)
+    assert len(sample) == 7000 and sample == sorted(sample, key=lambda json_obj: json_obj['value'])
+    assert list(rmq_channel.ready) == bodies and not rmq_channel.acked
+
+    with pytest.raises(ValueError):
+        rmq.peek('queue', n=70000, offset='first', verbose=False)
+
+
+def test_read_jsons_returns_once_n_messages_are_read(monkeypatch):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(5)]
+    rmq_channel = FakeChannel(bodies)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+
+    # the fake sleeps out the whole inactivity timeout on an empty queue, so waiting for one more delivery would show
+    start_time = time.time()
+    assert list(rmq.read_jsons('queue', n=3, auto_ack=True, timeout_seconds=3, verbose=False)) == \
+           [{'value': i} for i in range(3)]
+    assert list(rmq.read_jsons('queue', auto_ack=True, timeout_seconds=3, verbose=False)) == \
+           [{'value': i} for i in range(3, 5)]
+    assert time.time() - start_time < 1
+    assert rmq_channel.acked == bodies and not rmq_channel.ready
+
+
+class FakeBlockingConnection:
+    def __init__(self, parameters):
+        self.is_open = True
+        self.channels = []
+
+    def channel(self):
+        self.channels.append(FakePublishChannel())
+        return self.channels[-1]
+
+    def add_on_connection_blocked_callback(self, callback):
+        pass
+
+    def add_on_connection_unblocked_callback(self, callback):
+        pass
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+def test_channel_pool_reuses_connections(monkeypatch):
+    monkeypatch.setattr(rmq_controller.pika, 'BlockingConnection', FakeBlockingConnection)
+    pool = rmq_controller.RChannelPool(pika.ConnectionParameters(heartbeat=0), size=2)
+
+    for _ in range(3):
+        with pool.channel() as rmq_channel:
+            first_channel = rmq_channel
+    assert pool.n_connections_opened == 1
+
+    # a channel closed by the broker is reopened on the same connection
+    first_channel.close()
+    with pool.channel() as rmq_channel:
+        assert rmq_channel is not first_channel
+    assert pool.n_connections_opened == 1
+
+    # extra connections are opened on demand, but only `size` are kept
+    with pool.channel() as channel_1, pool.channel() as channel_2, pool.channel() as channel_3:
+        assert len({channel_1, channel_2, channel_3}) == 3
+    assert pool.n_connections_opened == 3 and len(pool._idle) == 2
+
+    # a dropped connection is replaced on checkout
+    for rmq_conn, _ in pool._idle:
+        rmq_conn.is_open = False
+    with pool.channel():
+        pass
+    assert pool.n_connections_opened == 4
+
+    # a dedicated channel is a fresh one, closed afterwards
+    with pool.channel(dedicated=True) as rmq_channel:
+        assert rmq_channel.is_open
+    assert not rmq_channel.is_open
+    pool.close()
+    assert not pool._idle
+
+
+class NackingPublishChannel(FakePublishChannel):
+    """
+    confirms one message at a time, nacking the bodies in `nack_counts` that many times before acking them
+    """
+
+    def __init__(self, nack_counts):
+        super().__init__()
+        self.nack_counts = collections.Counter(nack_counts)
+        self.max_in_flight = 0
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        super().basic_publish(exchange, routing_key, body, properties)
+        self.max_in_flight = max(self.max_in_flight, len(self.published) - self._n_confirmed)
+
+    def _flush_output(self, condition):
+        while not condition():
+            assert self._n_confirmed < len(self.published), 'waiting for a confirm that will never come'
+            routing_key, body = self.published[self._n_confirmed]
+            self._n_confirmed += 1
+            if self.nack_counts[body]:
+                self.nack_counts[body] -= 1
+                method = pika.spec.Basic.Nack(delivery_tag=self._n_confirmed)
+            else:
+                method = pika.spec.Basic.Ack(delivery_tag=self._n_confirmed)
+            self._on_ack_nack(pika.frame.Method(1, method))
+
+
+def test_publisher_keeps_a_window_and_resends_nacked_messages():
+    rmq_channel = NackingPublishChannel({b'4': 1, b'7': 2})
+    publisher = rmq_controller.RPublisher(rmq_channel, window=3, max_retries=1)
+    for i in range(10):
+        publisher.publish(exchange='', routing_key='queue', body=str(i).encode('utf8'), tag=i)
+    publisher.flush()
+
+    assert rmq_channel.max_in_flight == 3
+    assert [body for _, body in rmq_channel.published].count(b'4') == 2
+    assert publisher.stats() == {'published':         12,
+                                 'confirmed':         9,
+                                 'nacked':            3,
+                                 'resent':            2,
+                                 'failed':            1,
+                                 'throttled_seconds': 0.0,
+                                 }
+    assert publisher.failed == [('queue', b'7')]
+    assert sorted(publisher.pop_confirmed()) == [0, 1, 2, 3, 4, 5, 6, 8, 9]
+    assert publisher.pop_confirmed() == []
+
+
+def test_publisher_limits_unconfirmed_bytes():
+    rmq_channel = NackingPublishChannel({})
+    publisher = rmq_controller.RPublisher(rmq_channel, window=100, max_unconfirmed_bytes=10)
+    for i in range(5):
+        publisher.publish(exchange='', routing_key='queue', body=b'x' * 4)
+
+    # a publish waits while the unconfirmed bodies are at the budget, so the last one can overshoot it
+    assert rmq_channel.max_in_flight == 3
+    publisher.flush()
+    assert publisher.stats()['confirmed'] == 5
+
+
+def test_publisher_multiple_ack_settles_everything_up_to_the_tag():
+    rmq_channel = FakePublishChannel()  # confirms everything published so far with one multiple ack
+    publisher = rmq_controller.RPublisher(rmq_channel, window=2)
+    for i in range(5):
+        publisher.publish(exchange='', routing_key='queue', body=b'x', tag=i)
+    publisher.flush()
+
+    assert publisher.stats()['confirmed'] == 5 and not publisher._unconfirmed
+    assert publisher.pop_confirmed() == [0, 1, 2, 3, 4]
+
+
+def test_read_json_batches_acks_each_batch_once_it_was_handled(monkeypatch):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(10)]
+    rmq_channel = FakeChannel(bodies)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+
+    batches = rmq.read_json_batches('queue', batch_size=4, timeout_seconds=1, verbose=False)
+    assert next(batches) == [{'value': i} for i in range(4)]
+    assert not rmq_channel.acked and rmq_channel.max_prefetched <= 8
+
+    assert next(batches) == [{'value': i} for i in range(4, 8)]
+    assert rmq_channel.acked == bodies[:4]
+
+    # the partial batch at the end doesn't wait for the timeout
+    assert next(batches) == [{'value': 8}, {'value': 9}]
+    with pytest.raises(StopIteration):
+        next(batches)
+    assert rmq_channel.acked == bodies and not rmq_channel.unacked
+
+
+def test_read_json_batches_requeues_an_abandoned_batch(monkeypatch):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(10)]
+    rmq_channel = FakeChannel(bodies)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+
+    batches = rmq.read_json_batches('queue', batch_size=100, max_bytes=3 * len(bodies[0]), timeout_seconds=1,
+                                    verbose=False)
+    assert next(batches) == [{'value': i} for i in range(3)]
+    assert next(batches) == [{'value': i} for i in range(3, 6)]
+    batches.close()
+
+    assert rmq_channel.acked == bodies[:3]
+    assert list(rmq_channel.ready) == bodies[3:] and not rmq_channel.unacked
+
+
+class DrainingPublishChannel(FakePublishChannel):
+    """
+    a publish channel to a queue that a consumer drains by `n_drained_per_sleep` messages whenever the publisher sleeps
+    """
+
+    def __init__(self, n_drained_per_sleep):
+        super().__init__()
+        self.connection = self
+        self.n_drained_per_sleep = n_drained_per_sleep
+        self.n_drained = 0
+        self.n_sleeps = 0
+        self.max_depth = 0
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        super().basic_publish(exchange, routing_key, body, properties)
+        self.max_depth = max(self.max_depth, len(self.published) - self.n_drained)
+
+    def queue_declare(self, queue, durable, exclusive, auto_delete, passive):
+        return pika.frame.Method(1, pika.spec.Queue.DeclareOk(queue=queue,
+                                                               message_count=len(self.published) - self.n_drained))
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def sleep(self, duration):
+        self.n_sleeps += 1
+        self.n_drained = min(len(self.published), self.n_drained + self.n_drained_per_sleep)
+
+
+def test_write_jsons_confirmed_pauses_while_the_queue_is_deep(monkeypatch):
+    rmq_channel = DrainingPublishChannel(n_drained_per_sleep=5)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+
+    reports = rmq.write_jsons_confirmed('queue', ({'value': i} for i in range(50)), batch_size=20, max_queue_depth=10,
+                                        check_seconds=0, verbose=False)
+    assert [report['confirmed'] for report in reports] == [20, 20, 10]
+    assert [json.loads(body) for _, body in rmq_channel.published] == [{'value': i} for i in range(50)]
+    assert rmq_channel.max_depth == 10 and rmq_channel.n_sleeps == 8
+
+
+def test_write_jsons_confirmed_pauses_while_the_connection_is_blocked(monkeypatch):
+    rmq_channel = DrainingPublishChannel(n_drained_per_sleep=0)
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+
+    # the broker unblocks the connection after a while
+    monkeypatch.setattr(rmq._pool, 'is_blocked', lambda rmq_conn: rmq_channel.n_sleeps < 3)
+    reports = rmq.write_jsons_confirmed('queue', ({'value': i} for i in range(5)), check_seconds=0, verbose=False)
+    assert reports[0]['confirmed'] == 5 and rmq_channel.n_sleeps == 3
+
+
+def test_consistent_hash_ring_spreads_keys_and_remaps_few_of_them():
+    queue_names = rmq_controller.shard_queue_names('events', 4)
+    assert queue_names == ['events.0', 'events.1', 'events.2', 'events.3']
+
+    ring = rmq_controller.ConsistentHashRing(queue_names)
+    assignments = {key: ring.get(key) for key in range(10000)}
+    assert rmq_controller.ConsistentHashRing(queue_names).get(1234) == assignments[1234]
+    assert all(1500 < n_keys < 3500 for n_keys in collections.Counter(assignments.values()).values())
+
+    # a new shard only takes keys from the others, about 1/5 of them
+    bigger_ring = rmq_controller.ConsistentHashRing(queue_names + ['events.4'])
+    moved = [key for key in assignments if bigger_ring.get(key) != assignments[key]]
+    assert all(bigger_ring.get(key) == 'events.4' for key in moved)
+    assert 1000 < len(moved) < 3000
+
+
+def test_write_jsons_sharded_keeps_each_key_in_order_on_one_shard(monkeypatch):
+    rmq_channel = FakePublishChannel()
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+
+    json_objs = [{'user': i % 7, 'seq': i} for i in range(100)]
+    stats = rmq.write_jsons_sharded('events', json_objs, key=lambda json_obj: json_obj['user'], n_shards=3,
+                                    batch_size=4, verbose=False)
+    assert stats['confirmed'] == 100 and sum(stats['shards'].values()) == 100
+
+    published = collections.defaultdict(list)
+    for queue_name, body in rmq_channel.published:
+        json_obj = json.loads(body)
+        published[json_obj['user']].append((queue_name, json_obj['seq']))
+    for user, messages in published.items():
+        assert len({queue_name for queue_name, _ in messages}) == 1
+        assert [seq for _, seq in messages] == list(range(user, 100, 7))
+
+    with pytest.raises(AssertionError):
+        rmq_controller.shard_queue_names(['events.0', 'events.0'])
+
+
+class FakeStreamChannel:
+    """
+    the parts of a pika channel used by RMQ.read_stream, reading from an in-memory stream that never changes
+    """
+
+    is_open = True
+
+    def __init__(self, bodies):
+        self.bodies = list(bodies)
+        self.read_from = []
+
+    def basic_qos(self, prefetch_count, global_qos=False):
+        assert prefetch_count > 0, 'streams require a prefetch limit'
+
+    def consume(self, queue, inactivity_timeout=None, arguments=None):
+        offset = arguments['x-stream-offset']
+        offset = 0 if offset == 'first' else offset
+        self.read_from.append(offset)
+        for delivery_tag, message_offset in enumerate(range(offset, len(self.bodies)), start=1):
+            yield (pika.spec.Basic.Deliver(delivery_tag=delivery_tag),
+                   pika.BasicProperties(content_type='application/json', headers={'x-stream-offset': message_offset}),
+                   self.bodies[message_offset])
+        while True:
+            yield None, None, None
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        pass
+
+    def cancel(self):
+        pass
+
+
+def test_read_stream_resumes_after_the_last_handled_offset(monkeypatch, tmp_path):
+    rmq_channel = FakeStreamChannel([json.dumps({'value': i}).encode('utf8') for i in range(10)])
+    rmq = fake_rmq(monkeypatch, rmq_channel)
+    offsets_path = str(tmp_path / 'offsets.json')
+
+    def read(**kwargs):
+        return rmq.read_stream('stream', consumer_name='reader', offsets_path=offsets_path, commit_every=2,
+                               verbose=False, **kwargs)
+
+    assert list(read(n=3)) == [{'value': i} for i in range(3)]
+
+    # a reader that stops early still commits what it handled, but not the message it stopped at
+    stream = read(with_offsets=True)
+    assert [next(stream) for _ in range(2)] == [(3, {'value': 3}), (4, {'value': 4})]
+    stream.close()
+
+    assert list(read()) == [{'value': i} for i in range(4, 10)]
+    assert list(read()) == []
+    assert rmq_channel.read_from == [0, 3, 4, 10]
+
+    # an explicit offset ignores the committed one, and other consumers have their own
+    assert list(read(offset=8)) == [{'value': 8}, {'value': 9}]
+    assert len(list(rmq.read_stream('stream', consumer_name='other reader', offsets_path=offsets_path,
+                                    verbose=False))) == 10
+
+
+class FakeBroker:
+    """
+    a queue served to RConsumer's connections, which drops the connection after the deliveries in `drop_after`
+    (requeueing whatever it had delivered but not acked) and fails the connection attempts in `connect_errors`
+    """
+
+    def __init__(self, bodies, drop_after=(), connect_errors=()):
+        self.ready = collections.deque(bodies)
+        self.acked = []
+        self.n_delivered = 0
+        self.drop_after = set(drop_after)
+        self.connect_errors = list(connect_errors)
+        self.lock = threading.Lock()
+
+    def connect(self, parameters):
+        if self.connect_errors:
+            raise self.connect_errors.pop(0)
+        return FakeConsumerConnection(self)
+
+
+class FakeConsumerConnection:
+    """
+    a pika connection and its only channel
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.unacked = dict()  # delivery tag -> body
+        self.next_delivery_tag = 1
+        self.callbacks = collections.deque()
+        self.prefetch_count = 0
+        self.on_message = None
+
+    def channel(self):
+        return self
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback):
+        self.on_message = on_message_callback
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.append(callback)
+
+    def basic_ack(self, delivery_tag):
+        self.broker.acked.append(self.unacked.pop(delivery_tag))
+
+    def process_data_events(self, time_limit=None):
+        while self.callbacks:
+            self.callbacks.popleft()()
+
+        with self.broker.lock:
+            if self.broker.ready and len(self.unacked) < self.prefetch_count:
+                if self.broker.n_delivered in self.broker.drop_after:
+                    self.broker.drop_after.remove(self.broker.n_delivered)
+                    self.close()
+                    raise pika.exceptions.StreamLostError('connection lost')
+
+                body = self.broker.ready.popleft()
+                delivery_tag = self.next_delivery_tag
+                self.next_delivery_tag += 1
+                self.unacked[delivery_tag] = body
+                self.broker.n_delivered += 1
+                self.on_message(self, pika.spec.Basic.Deliver(delivery_tag=delivery_tag),
+                                pika.BasicProperties(content_type='application/json'), body)
+                return
+        time.sleep(0.001)
+
+    def close(self):
+        self.is_open = False
+        self.broker.ready.extendleft(self.unacked[delivery_tag] for delivery_tag in sorted(self.unacked, reverse=True))
+        self.unacked.clear()
+
+
+def test_consumer_reconnects_and_gets_requeued_messages_again(monkeypatch):
+    bodies = [json.dumps({'value': i}).encode('utf8') for i in range(10)]
+    broker = FakeBroker(bodies, drop_after=[4])
+    monkeypatch.setattr(rmq_controller.pika, 'BlockingConnection', broker.connect)
+
+    seen = []
+    with pytest.warns(UserWarning, match='reconnecting'):
+        with rmq_controller.RConsumer(None, 'queue', prefetch_count=2, backoff_seconds=0.01) as consumer:
+            while True:
+                delivery = consumer.get(timeout=0.5)
+                if delivery is None:
+                    break
+                generation, delivery_tag, header_frame, body = delivery
+                seen.append(body)
+                consumer.ack(generation, delivery_tag)
+
+    assert consumer.n_reconnects == 1 and consumer.generation == 2
+    assert set(seen) == set(bodies) and len(seen) <= 12  # at most the prefetched messages are seen twice
+    assert sorted(broker.acked) == sorted(bodies) and not broker.ready
+
+
+def test_consumer_gives_up(monkeypatch):
+    # a missing queue won't come back by retrying
+    broker = FakeBroker([], connect_errors=[pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND')])
+    monkeypatch.setattr(rmq_controller.pika, 'BlockingConnection', broker.connect)
+    with rmq_controller.RConsumer(None, 'queue') as consumer:
+        with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+            consumer.get(timeout=5)
+    assert consumer.n_reconnects == 0
+
+    # and other errors are retried up to max_reconnects times
+    broker = FakeBroker([], connect_errors=[pika.exceptions.AMQPConnectionError()] * 3)
+    monkeypatch.setattr(rmq_controller.pika, 'BlockingConnection', broker.connect)
+    with pytest.warns(UserWarning, match='reconnecting'):
+        with rmq_controller.RConsumer(None, 'queue', max_reconnects=2, backoff_seconds=0.01) as consumer:
+            with pytest.raises(pika.exceptions.AMQPConnectionError):
+                consumer.get(timeout=5)
+    assert consumer.n_reconnects == 2
+
+
+def test_trace_headers_continue_the_current_trace(monkeypatch):
+    headers = rmq_controller._trace_headers()
+    assert rmq_controller.current_trace() is None
+    assert headers['x-publish-ts'] == headers['x-trace-origin-ts']
+
+    # a message published while handling a traced message continues its trace
+    rmq = fake_rmq(monkeypatch, FakeChannel([b'{}'] * 2, headers=headers))
+    for _ in rmq.read_jsons('queue', verbose=False):
+        trace_id, origin_timestamp = rmq_controller.current_trace()
+        assert trace_id == headers['x-trace-id']
+        assert rmq_controller._trace_headers()['x-trace-origin-ts'] == headers['x-trace-origin-ts']
+    assert rmq_controller.current_trace() is None
+
+    # headers written by other tools don't count
+    rmq = fake_rmq(monkeypatch, FakeChannel([b'{}'], headers={'x-trace-id': 'abc', 'x-publish-ts': '1'}))
+    for _ in rmq.read_jsons('queue', verbose=False):
+        assert rmq_controller.current_trace() is None
+
+
+def test_a_nested_read_restores_the_outer_trace(monkeypatch):
+    headers = rmq_controller._trace_headers()
+    outer_rmq = fake_rmq(monkeypatch, FakeChannel([b'{}'] * 2, headers=headers))
+    inner_rmq = fake_rmq(monkeypatch, FakeChannel([b'{}'] * 2))
+
+    for _ in outer_rmq.read_jsons('outer', verbose=False):
+        assert len(list(inner_rmq.read_jsons('inner', n=1, verbose=False))) == 1
+        assert rmq_controller.current_trace()[0] == headers['x-trace-id']
+    assert rmq_controller.current_trace() is None
@@ -0,0 +1,63 @@
+import datetime
+import os
+import struct
+
+import pika
+import pytest
+
+import rmq_dump
+
+UTC = datetime.timezone.utc
+
+
+def test_properties_round_trip_including_floats():
+    properties = pika.BasicProperties(content_type='application/json',
+                                      delivery_mode=2,
+                                      timestamp=1700000000,
+                                      headers={'x-ratio':  0.25,
+                                               'x-count':  3,
+                                               'x-death':  [{'count':   1,
+                                                             'time':    datetime.datetime(2024, 1, 2, tzinfo=UTC),
+                                                             'weights': [1.5, 2]}],
+                                               'x-binary': b'\x00\xff'})
+    decoded = rmq_dump.decode_properties(rmq_dump.encode_properties(properties))
+    assert vars(decoded) == vars(properties)
+    assert type(decoded.headers['x-ratio']) is float
+
+    # republishing writes the floats as amqp doubles (which pika itself would decode as ints)
+    assert struct.pack('>cd', b'd', 1.5) in b''.join(decoded.encode())
+
+    assert vars(rmq_dump.decode_properties(rmq_dump.encode_properties(None))) == vars(pika.BasicProperties())
+
+
+def test_resume_truncates_a_partial_block(tmp_path):
+    path = str(tmp_path / 'dumps' / 'queue.dump')
+    records = [(pika.BasicProperties(content_type='application/json'), str(i).encode('utf8')) for i in range(6)]
+
+    with rmq_dump.DumpWriter(path) as writer:
+        writer.write_block(records[:2])
+        writer.write_block(records[2:4])
+    complete_size = os.path.getsize(path)
+
+    # interrupted halfway through writing a block
+    with open(path, mode='ab') as f:
+        f.write(b'\x00\x00\x01\x00' + b'x' * 10)
+    assert [body for _, body in rmq_dump.read_records(path)] == [b'0', b'1', b'2', b'3']
+
+    with rmq_dump.DumpWriter(path, resume=True) as writer:
+        assert writer.n_records == 4
+        assert os.path.getsize(path) == complete_size
+        writer.write_block(records[4:])
+    assert [body for _, body in rmq_dump.read_records(path)] == [body for _, body in records]
+
+    # an interrupted header is dropped too
+    with open(path, mode='ab') as f:
+        f.write(b'\x00\x00')
+    with rmq_dump.DumpWriter(path, resume=True) as writer:
+        assert writer.n_records == 6
+
+
+def test_not_a_dump_file(tmp_path):
+    (tmp_path / 'other.dump').write_bytes(b'something else')
+    with pytest.raises(ValueError):
+        list(rmq_dump.read_records(str(tmp_path / 'other.dump')))
@@ -0,0 +1,44 @@
+import pytest
+
+import benchmark
+import rmq_http
+
+
+@pytest.fixture
+def management_api():
+    stub = benchmark.StubManagementAPI(n_queues=10)
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def admin(management_api):
+    admin = rmq_http.RMQAdmin('127.0.0.1', management_api.port, '/', 'guest', 'guest', max_connections=4)
+    yield admin
+    admin.close()
+
+
+def test_write_jsons_reuses_pooled_connections(management_api, admin):
+    assert admin.write_jsons('queue', ({'value': i} for i in range(200))) == 200
+    assert management_api.n_published == 200
+    assert management_api.n_connections <= 4
+
+    assert admin.is_alive() and admin.health_check()
+    assert management_api.n_connections <= 4
+
+
+def test_write_jsons_warns_about_unrouted_messages(management_api, admin, monkeypatch):
+    monkeypatch.setattr(admin, 'write_json', lambda queue_name, json_obj: {'routed': json_obj['value'] % 2 == 0})
+    with pytest.warns(UserWarning, match='5 of 10 messages were not routed'):
+        assert admin.write_jsons('queue', ({'value': i} for i in range(10)), max_in_flight=3) == 5
+
+
+def test_snapshot_is_shared_within_its_ttl(management_api, admin):
+    snapshot = admin.snapshot()
+    assert list(snapshot.columns) == list(rmq_http.SNAPSHOT_COLUMNS)
+    assert snapshot.loc['queue-3', 'messages_ready'] == 3
+    assert snapshot.loc['queue-3', 'publish_rate'] == 1.0
+    assert snapshot.loc['queue-3', 'deliver_rate'] == 0  # no traffic yet, so the stats are missing
+
+    assert admin.snapshot() is snapshot
+    assert admin.snapshot(max_age_seconds=-1) is not snapshot
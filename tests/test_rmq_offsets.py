@@ -0,0 +1,25 @@
+import json
+import os
+
+import rmq_offsets
+
+
+def test_commit_and_get(tmp_path):
+    path = str(tmp_path / 'offsets' / 'offsets.json')
+    store = rmq_offsets.OffsetStore(path)
+    assert store.get('/', 'stream', 'reader') is None
+
+    store.commit('/', 'stream', 'reader', 10)
+    store.commit('/', 'stream', 'other reader', 20)
+    store.commit('/', 'stream', 'reader', 11)
+    store.commit('vhost', 'stream', 'reader', 30)
+
+    # a new store (e.g. after a restart) reads the same file
+    store = rmq_offsets.OffsetStore(path)
+    assert store.get('/', 'stream', 'reader') == 11
+    assert store.get('/', 'stream', 'other reader') == 20
+    assert store.get('vhost', 'stream', 'reader') == 30
+
+    assert os.listdir(tmp_path / 'offsets') == ['offsets.json']  # no temp file left behind
+    with open(path, encoding='utf8') as f:
+        assert json.load(f) == {'//stream/other reader': 20, '//stream/reader': 11, 'vhost/stream/reader': 30}
@@ -0,0 +1,147 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+import pytest
+
+import benchmark
+import ssh_controller
+
+
+@pytest.fixture
+def stub_server():
+    server = benchmark.StubSSHServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def ssh(stub_server):
+    ssh = ssh_controller.SSH('127.0.0.1', stub_server.port, stub_server.username, stub_server.password,
+                             logfile=None, test_connection=False)
+    yield ssh
+    ssh.close()
+
+
+def test_output_after_exit_status_is_not_dropped(ssh, monkeypatch):
+    # openssh can send the exit status before it has drained the command's pipes
+    def exec_exit_status_first(channel, command):
+        channel.sendall(b'first\n')
+        time.sleep(0.2)
+        channel.send_exit_status(3)
+        time.sleep(1.5)  # longer than SSHCommand's poll interval
+        channel.sendall(b'last line')
+        channel.sendall_stderr(b'late error')
+        channel.shutdown_write()
+        channel.close()
+
+    monkeypatch.setattr(benchmark._StubSSHServerInterface, '_exec', staticmethod(exec_exit_status_first))
+
+    command = ssh.execute_stream('ignored')
+    assert list(command) == [('stdout', 'first'), ('stdout', 'last line'), ('stderr', 'late error')]
+    assert command.exit_status == 3
+
+    with pytest.warns(UserWarning, match='late error'):
+        assert ssh.execute('ignored') == 'first\nlast line'
+
+
+def test_sync_copies_several_large_files(ssh, tmp_path):
+    local_dir = tmp_path / 'local'
+    remote_dir = tmp_path / 'remote'
+    local_dir.mkdir()
+    for i in range(3):
+        (local_dir / f'large_{i}.bin').write_bytes(os.urandom(100 * 1024))
+    (local_dir / 'sub').mkdir()
+    (local_dir / 'sub' / 'small.txt').write_bytes(b'small')
+
+    result = ssh.sync(local_dir, remote_dir, chunk_size=32 * 1024, verbose=False)
+    assert result['copied'] == 4
+    for path in local_dir.rglob('*'):
+        if path.is_file() and path.name != ssh_controller.SYNC_MANIFEST_NAME:
+            assert (remote_dir / path.relative_to(local_dir)).read_bytes() == path.read_bytes()
+
+    assert ssh.sync(local_dir, remote_dir, chunk_size=32 * 1024, verbose=False)['copied'] == 0
+
+
+def test_arg_batches_fit_within_max_bytes():
+    args = [f'/some/path/{i:05d}' for i in range(10000)]
+    batches = list(ssh_controller._arg_batches(args, max_command_bytes=1000))
+    assert [arg for batch in batches for arg in batch] == args
+    assert all(sum(len(arg) + 1 for arg in batch) <= 1000 for batch in batches)
+
+
+@pytest.mark.parametrize('size', [1000, 100 * 1024])
+def test_scp_round_trip(ssh, tmp_path, size):
+    data = os.urandom(size)
+    (tmp_path / 'source').write_bytes(data)
+
+    remote_path = str(tmp_path / 'remote' / 'copy')
+    assert ssh.scp_local_to_remote(tmp_path / 'source', remote_path, chunk_size=32 * 1024, verbose=False)
+    local_path = str(tmp_path / 'local' / 'copy')
+    assert ssh.scp_remote_to_local(remote_path, local_path, chunk_size=32 * 1024, verbose=False)
+
+    assert (tmp_path / 'local' / 'copy').read_bytes() == data
+    assert sorted(os.listdir(tmp_path / 'remote')) == ['copy']
+    assert sorted(os.listdir(tmp_path / 'local')) == ['copy']
+
+
+def test_scp_without_remote_hash_tools(ssh, tmp_path):
+    data = os.urandom(100 * 1024)
+    (tmp_path / 'source').write_bytes(data)
+    ssh._can_hash_remotely = False
+
+    with pytest.warns(UserWarning, match='without verifying'):
+        assert ssh.scp_remote_to_local(str(tmp_path / 'source'), tmp_path / 'copy', chunk_size=32 * 1024,
+                                       verbose=False)
+    assert (tmp_path / 'copy').read_bytes() == data
+
+
+def test_scp_resume_rehashes_chunks_from_disk(ssh, tmp_path):
+    data = os.urandom(100 * 1024)
+    (tmp_path / 'source').write_bytes(data)
+    chunk_size = 32 * 1024
+
+    # an interrupted download whose manifest says chunk 1 is done, but whose bytes never made it to disk
+    stat = os.stat(tmp_path / 'source')
+    chunk_sha256s = {str(i): hashlib.sha256(data[i * chunk_size:(i + 1) * chunk_size]).hexdigest()
+                     for i in range(2)}
+    (tmp_path / 'copy.partial').write_bytes(data[:chunk_size] + bytes(len(data) - chunk_size))
+    (tmp_path / 'copy.partial.manifest').write_text(json.dumps({
+        'source': {'size': stat.st_size, 'mtime': int(stat.st_mtime), 'chunk_size': chunk_size},
+        'done':   chunk_sha256s,
+    }))
+
+    assert ssh.scp_remote_to_local(str(tmp_path / 'source'), tmp_path / 'copy', chunk_size=chunk_size,
+                                   verify=False, verbose=False)
+    assert (tmp_path / 'copy').read_bytes() == data
+
+
+def test_commands_and_transfers_share_one_connection(ssh, stub_server, tmp_path):
+    (tmp_path / 'local.txt').write_bytes(b'hello')
+
+    # commands from several threads each get a channel on the same transport
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(lambda i: ssh.execute(f'echo {i}'), range(32))) == [f'{i}\n' for i in range(32)]
+    ssh.scp_local_to_remote(tmp_path / 'local.txt', tmp_path / 'remote.txt', verbose=False)
+    assert ssh.exists(str(tmp_path / 'remote.txt'))
+    assert stub_server.n_connections == 1 and ssh.n_connections_opened == 1
+
+    # a dropped connection is replaced on next use
+    ssh._ssh_conn.get_transport().close()
+    assert ssh.execute('echo 123') == '123\n'
+    ssh.scp_remote_to_local(tmp_path / 'remote.txt', tmp_path / 'copy.txt', verbose=False)
+    assert (tmp_path / 'copy.txt').read_bytes() == b'hello'
+    assert stub_server.n_connections == 2 and ssh.n_connections_opened == 2
+
+
+def test_a_failed_connection_is_replaced_once(ssh, stub_server):
+    failed_conn = ssh._get_ssh_conn()
+    replacement_conn = ssh._get_ssh_conn(failed_conn=failed_conn)
+    assert replacement_conn is not failed_conn
+
+    # another thread that saw the same connection fail uses the replacement, instead of closing it too
+    assert ssh._get_ssh_conn(failed_conn=failed_conn) is replacement_conn
+    assert ssh.execute('echo 123') == '123\n'
+    assert stub_server.n_connections == 2 and ssh.n_connections_opened == 2
@@ -0,0 +1,27 @@
+import pandas as pd
+import pytest
+
+import ssh_controller
+import ssh_fleet
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    killed = dict()
+    monkeypatch.setattr(ssh_controller.SSH, 'kill', lambda ssh, pids: killed.setdefault(ssh.name, []).append(pids))
+    fleet = ssh_fleet.SSHFleet([{'ip_address': '127.0.0.1', 'port': 22, 'username': 'user', 'password': 'password',
+                                 'name': name} for name in ('a', 'b', 'c')], logfile=None)
+    fleet.killed = killed
+    yield fleet
+    fleet.close()
+
+
+def test_kill_dict(fleet):
+    fleet.kill({'a': [101, 102], 'b': 103})
+    assert fleet.killed == {'a': [[101, 102]], 'b': [103]}
+
+
+def test_kill_ps_ef_dataframe(fleet):
+    df = pd.DataFrame({'host': ['a', 'b', 'a'], 'PID': [101, 103, 102], 'Command': ['x', 'y', 'z']})
+    fleet.kill(df)
+    assert fleet.killed == {'a': [[101, 102]], 'b': [[103]]}